@@ -8,17 +8,21 @@ from django.conf.urls import url
 from django.template.context import RequestContext
 from django.shortcuts import render_to_response, get_object_or_404
 
+from trimco.settings import EDITOR_WINDOW_SIZE
 from corpora.models import *
 from corpora.utils.elan_to_html import ElanToHTML
-from corpora.utils.standartizator import Standartizator
+from corpora.utils.editor_sessions import editor_sessions
+from corpora.utils.standartizator import get_standartizator
 from corpora.utils.annotation_menu import annotation_menu
 from corpora.utils.word_list import insert_manual_annotation_in_mongo
-from corpora.search_engine.search_backend import search, saved_recording_to_db
+from corpora.utils.jobs import enqueue_job, get_job_status
+from corpora.utils.locks import RecordingLocked, is_lock_alive
+from corpora.search_engine.search_backend import search, search_count
 from corpora.search_engine.db_to_html import html_to_db
 from corpora.utils.audio_cutter import cut_audio_from_request
 from morphology.models import Dialect
 
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
 from reversion.admin import VersionAdmin
 
@@ -27,10 +31,12 @@ class HttpResponseConflict(HttpResponse):
     status_code = 409  # Conflict
 
 
-CONFLICT_RESPONSE = HttpResponseConflict(
-    'Another request is currently running. Try to reload the page in several seconds. <br>'
-    'If the error persists, please contact developers and describe the problem.'
-)
+def conflict_response(error):
+    return HttpResponseConflict(
+        'The recording %s is currently saved or annotated by %s. Try again in several seconds. <br>'
+        'If the error persists, please contact developers and describe the problem.'
+        % (error.elan, error.holder or 'another user')
+    )
 
 
 @admin.register(Recording)
@@ -44,6 +50,7 @@ class RecordingAdmin(VersionAdmin):
 
     editor_template = 'editor.html'
     search_template = 'search.html'
+    job_template = 'job.html'
     fields = (
         'string_id',
         ('audio','data'),
@@ -87,13 +94,13 @@ class RecordingAdmin(VersionAdmin):
         return ', '.join([a.string_id for a in obj.to_speakers.all()])
 
     def get_urls(self):
-        self.processing_request = False
         urls = super(RecordingAdmin, self).get_urls()
         my_urls = [
             url(r'\d+/edit/$', self.admin_site.admin_view(self.edit)),
             url(r'\d+/auto/$', self.admin_site.admin_view(self.auto_annotate)),
             url(r'\d+/grammar/$', self.admin_site.admin_view(self.reannotate_grammar)),
             url(r'^reannotate_grammar_all/$', self.admin_site.admin_view(self.reannotate_grammar_all_unchecked)),
+            url(r'^jobs/(\d+)/$', self.admin_site.admin_view(self.job_status)),
             url(r'^search/$', self.admin_site.admin_view(self.search)),
             url(r'^ajax/$', self.ajax_dispatcher, name='ajax'),
             url(r'^ajax_search/$', self.ajax_search_dispatcher, name='ajax_search'),
@@ -103,22 +110,21 @@ class RecordingAdmin(VersionAdmin):
 
     @transaction.atomic
     def edit(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
-        self.processing_request = True
-
         try:
-            self.recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
-            self.elan_converter = ElanToHTML(self.recording_obj)
-            self.elan_converter.build_page()
+            recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
+            session = editor_sessions.get(request.user.pk, recording_obj)
+            with session.lock:
+                session.converter.reload_elan_if_changed()
+                first = 0
+                if request.GET.get('time'):  # ms, the editor is opened at the annotation spoken at that time
+                    first = session.converter.find_block(int(request.GET['time']))
+                session.converter.build_html_window(first, EDITOR_WINDOW_SIZE)
+                html = session.converter.html
             annot_menu_select, annot_menu_checkboxes = annotation_menu.build_annotation_menu()
 
-            self.standartizator = Standartizator(self.recording_obj.to_dialect)
-
             context = {
-                'ctext': self.elan_converter.html,
-                'audio_path': self.recording_obj.audio.name,
+                'ctext': html,
+                'audio_path': recording_obj.audio.name,
                 'media': self.media['js'],
                 'annot_menu_select': annot_menu_select,
                 'annot_menu_checkboxes': annot_menu_checkboxes,
@@ -126,20 +132,13 @@ class RecordingAdmin(VersionAdmin):
             }
 
         except Exception:
-            self.processing_request = False
             print(traceback.format_exc())
             raise Exception(traceback.format_exc())
 
-        self.processing_request = False
         return render_to_response(self.editor_template, context_instance=RequestContext(request, context))
 
     @transaction.atomic
     def search(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
-        self.processing_request = True
-
         try:
             annot_menu_select, annot_menu_checkboxes = annotation_menu.build_annotation_menu()
             dialects = [(x.id, x.abbreviation) for x in Dialect.objects.all()]
@@ -155,153 +154,113 @@ class RecordingAdmin(VersionAdmin):
             }
 
         except Exception:
-            self.processing_request = False
             print(traceback.format_exc())
             raise Exception(traceback.format_exc())
 
-        self.processing_request = False
         return render_to_response(self.search_template, context_instance=RequestContext(request, context))
 
-    @transaction.atomic
-    def auto_annotate(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
-        self.processing_request = True
-
-        try:
-            self.recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
-            self.elan_converter = ElanToHTML(self.recording_obj, mode='auto-annotation')
-            self.elan_converter.build_page()
-
-            annot_menu_select, annot_menu_checkboxes = annotation_menu.build_annotation_menu()
-
-            context = {
-                'ctext': self.elan_converter.html,
-                'audio_path': self.recording_obj.audio.name,
-                'media': self.media['js'],
-                'annot_menu_select': annot_menu_select,
-                'annot_menu_checkboxes': annot_menu_checkboxes,
-                'auto_annotation_option': True
-            }
-
-        except Exception:
-            self.processing_request = False
-            print(traceback.format_exc())
-            raise Exception(traceback.format_exc())
+    def render_job(self, request, job, title, redirect_url=''):
+        context = {
+            'title': title,
+            'status_url': '/admin/corpora/recording/jobs/%s/' % job.pk,
+            'redirect_url': redirect_url,
+        }
+        return render_to_response(self.job_template, context_instance=RequestContext(request, context))
 
-        self.processing_request = False
-        return render_to_response(self.editor_template, context_instance=RequestContext(request, context))
+    def auto_annotate(self, request):
+        recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
+        job = enqueue_job('auto-annotation', recording_id=recording_obj.pk)
+        return self.render_job(
+            request, job, 'Auto normalization and annotation of ' + recording_obj.string_id,
+            redirect_url='/admin/corpora/recording/%s/edit/' % recording_obj.pk
+        )
 
-    @transaction.atomic
     def reannotate_grammar(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
+        recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
+        job = enqueue_job('auto-grammar', recording_id=recording_obj.pk)
+        return self.render_job(
+            request, job, 'Auto annotation of grammar in ' + recording_obj.string_id,
+            redirect_url='/admin/corpora/recording/%s/edit/' % recording_obj.pk
+        )
 
-        self.processing_request = True
+    def reannotate_grammar_all_unchecked(self, request):
+        job = enqueue_job('reannotate-grammar-all')
+        return self.render_job(request, job, 'Reannotation of grammar in unchecked recordings')
 
+    def job_status(self, request, job_id):
         try:
-            self.recording_obj = get_object_or_404(Recording, id=request.path.split('/')[-3])
-            self.elan_converter = ElanToHTML(self.recording_obj, mode='auto-grammar')
-            self.elan_converter.build_page()
-
-            annot_menu_select, annot_menu_checkboxes = annotation_menu.build_annotation_menu()
-
-            context = {
-                'ctext': self.elan_converter.html,
-                'audio_path': self.recording_obj.audio.name,
-                'media': self.media['js'],
-                'annot_menu_select': annot_menu_select,
-                'annot_menu_checkboxes': annot_menu_checkboxes,
-                'auto_annotation_option': True
-            }
-
-        except Exception:
-            self.processing_request = False
-            print(traceback.format_exc())
-            raise Exception(traceback.format_exc())
-
-        self.processing_request = False
-        return render_to_response(self.editor_template, context_instance=RequestContext(request, context))
-
-    def reannotate_grammar_all_unchecked(self, _):
-        unchecked_recs = Recording.objects.filter(auto_annotated=True, checked=False)
-        reannotated = []
-
-        for rec in unchecked_recs:
-            clean_rec = rec.data.path.rsplit('/', 1)[-1]
-            elan_converter = ElanToHTML(rec)
-            elan_converter.make_backup()
-
-            try:
-                elan_converter.reannotate_elan(do_standartization=False)
-                elan_converter.change_status_and_save()
-                print('Reannotated and saved', rec.data.path)
-                reannotated.append(clean_rec)
-            except Exception as e:
-                reannotated.append(clean_rec + ' ERROR ' + str(e))
-                print('ERROR in ' + rec.data.path)
-                print(e)
-
-        return HttpResponse('Reannotated:<br>' + '<br>'.join(reannotated))
+            return HttpResponse(json.dumps(get_job_status(job_id)), content_type='application/json')
+        except Job.DoesNotExist:
+            raise Http404('No job ' + job_id)
 
     @csrf_exempt
     def ajax_dispatcher(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
         response = {}
-        self.processing_request = True
 
         try:
-            self.recording_obj = get_object_or_404(Recording, id=request.META['HTTP_REFERER'].split('/')[-3])
-            self.standartizator = Standartizator(self.recording_obj.to_dialect)
+            recording_obj = get_object_or_404(Recording, id=request.META['HTTP_REFERER'].split('/')[-3])
+            standartizator = get_standartizator(recording_obj.to_dialect)
 
             if request.POST['request_type'] == 'trt_annot_req':
                 if request.POST['request_data[mode]'] == 'manual':
-                    manual_words = self.standartizator.get_manual_standartizations(request.POST['request_data[trt]'])
+                    manual_words = standartizator.get_manual_standartizations(request.POST['request_data[trt]'])
                     response['result'] = manual_words or [request.POST['request_data[nrm]']]
 
                 elif request.POST['request_data[mode]'] == 'auto':
-                    response['result'] = self.standartizator.get_auto_standartization(request.POST['request_data[trt]'])
+                    response['result'] = standartizator.get_auto_standartization(request.POST['request_data[trt]'])
 
             elif request.POST['request_type'] == 'annot_suggest_req':
                 ann = [request.POST['request_data[trt]'], request.POST['request_data[nrm]']]
-                response['result'] = self.standartizator.get_annotation_options_list(ann)
+                response['result'] = standartizator.get_annotation_options_list(ann)
+
+            elif request.POST['request_type'] == 'editor_window':
+                # blocks by index (first, count), see load_editor_window in trimco.js
+                session = editor_sessions.get(request.user.pk, recording_obj)
+                with session.lock:
+                    session.converter.reload_elan_if_changed()
+                    html, first, last = session.converter.build_window(
+                        int(request.POST['request_data[first]']),
+                        min(int(request.POST['request_data[count]']), EDITOR_WINDOW_SIZE)
+                    )
+                    total = len(session.converter.get_blocks())
+                response['result'] = {'html': html, 'first': first, 'last': last, 'total': total}
 
             elif request.POST['request_type'] == 'save_elan_req':
-                self.elan_converter.save_html_to_elan(request.POST['request_data[html]'])
-                saved_recording_to_db(
-                    eaf_path=self.recording_obj.data.path,
-                    audio_path=self.recording_obj.audio.name,
-                    html=request.POST['request_data[html]'],
-                    dialect=self.recording_obj.to_dialect.id
-                )
+                session = editor_sessions.get(request.user.pk, recording_obj)
+                with session.lock:
+                    session.converter.save_html_to_elan(
+                        request.POST['request_data[html]'], owner=request.user.get_username()
+                    )
+
+            elif request.POST['request_type'] == 'save_elan_patch':
+                # only annotations changed since the last save are sent, see get_changes_patch in trimco.js
+                patch = json.loads(request.POST['request_data[patch]'])
+                if patch:
+                    session = editor_sessions.get(request.user.pk, recording_obj)
+                    with session.lock:
+                        session.converter.save_patch_to_elan(patch, owner=request.user.get_username())
 
             elif request.POST['request_type'] == 'save_annotation':
                 insert_manual_annotation_in_mongo(
-                    model=str(self.standartizator.model),
+                    model=str(standartizator.model),
                     word=request.POST['request_data[trt]'],
                     standartization=request.POST['request_data[nrm]'],
                     lemma=request.POST['request_data[lemma]'],
                     grammar=request.POST['request_data[annot]']
                 )
 
+        except RecordingLocked as e:
+            return conflict_response(e)
+
         except Exception:
-            self.processing_request = False
             print(traceback.format_exc())
             raise Exception(traceback.format_exc())
 
-        self.processing_request = False
         return HttpResponse(json.dumps(response))
 
     @csrf_exempt
     def ajax_search_dispatcher(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
         response = {}
-        self.processing_request = True
 
         if request.POST['request_type'] == 'search':
             try:
@@ -312,7 +271,10 @@ class RecordingAdmin(VersionAdmin):
                 prev_page_info = request.POST.get('request_data[prev_page_info]', '')
                 prev_page_info = json.loads(prev_page_info) if prev_page_info != '' else {}
 
-                response['result'], response['page_info'], response['total_pages'] = search(
+                (
+                    response['result'], response['page_info'],
+                    response['total_pages'], response['count_status']
+                ) = search(
                     dialect=request.POST.getlist('request_data[dialect][]', []),
                     transcription=request.POST['request_data[transcription]'],
                     standartization=request.POST['request_data[standartization]'],
@@ -323,32 +285,46 @@ class RecordingAdmin(VersionAdmin):
                     total_pages=total_pages
                 )
             except Exception:
-                self.processing_request = False
                 print(traceback.format_exc())
                 raise Exception(traceback.format_exc())
 
-            self.processing_request = False
+            return HttpResponse(json.dumps(response))
+
+        if request.POST['request_type'] == 'search_count':
+            try:
+                response['total_pages'], response['count_status'] = search_count(
+                    dialect=request.POST.getlist('request_data[dialect][]', []),
+                    transcription=request.POST['request_data[transcription]'],
+                    standartization=request.POST['request_data[standartization]'],
+                    lemma=request.POST['request_data[lemma]'],
+                    annotation=request.POST['request_data[annotations]']
+                )
+            except Exception:
+                print(traceback.format_exc())
+                raise Exception(traceback.format_exc())
+
             return HttpResponse(json.dumps(response))
 
         if request.POST['request_type'] == 'save_elan_req':
             try:
-                ElanToHTML.save_html_extracts_to_elans(request.POST['request_data[html]'])
+                ElanToHTML.save_html_extracts_to_elans(
+                    request.POST['request_data[html]'], owner=request.user.get_username()
+                )
                 html_to_db(request.POST['request_data[html]'])
+            except RecordingLocked as e:
+                return conflict_response(e)
             except Exception:
-                self.processing_request = False
                 print(traceback.format_exc())
                 raise Exception(traceback.format_exc())
 
-            self.processing_request = False
             return HttpResponse(json.dumps(response))
 
         dialect = request.POST.get('request_data[dialect]', '')
         if not dialect:
-            self.processing_request = False
             return HttpResponse(json.dumps(response))
 
         try:
-            current_standartizator = Standartizator(dialect)
+            current_standartizator = get_standartizator(dialect)
 
             if request.POST['request_type'] == 'trt_annot_req':
                 if request.POST['request_data[mode]'] == 'manual':
@@ -373,34 +349,51 @@ class RecordingAdmin(VersionAdmin):
                 )
 
         except Exception:
-            self.processing_request = False
             print(traceback.format_exc())
             raise Exception(traceback.format_exc())
 
-        self.processing_request = False
         return HttpResponse(json.dumps(response))
 
     @transaction.atomic
     def play_audio(self, request):
-        if self.processing_request:
-            return CONFLICT_RESPONSE
-
-        self.processing_request = True
         try:
             audio, err = cut_audio_from_request(request)
         except Exception:
-            self.processing_request = False
             print(traceback.format_exc())
             raise Exception(traceback.format_exc())
         if err != "":
-            self.processing_request = False
             print(err)
             raise Exception(err)
 
-        self.processing_request = False
         return audio
 
 
 @admin.register(Corpus)
 class CorpusAdmin(VersionAdmin):
     pass
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'kind', 'status', 'progress', 'total', 'created', 'started', 'finished', 'worker')
+    list_filter = ('kind', 'status')
+    readonly_fields = (
+        'kind', 'params', 'status', 'worker', 'progress', 'total', 'items', 'result', 'error',
+        'created', 'started', 'finished'
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(RecordingLock)
+class RecordingLockAdmin(admin.ModelAdmin):
+    list_display = ('elan', 'owner', 'worker', 'acquired', 'holder_alive')
+    readonly_fields = ('elan', 'owner', 'worker', 'acquired')
+
+    def holder_alive(self, obj):
+        alive = is_lock_alive(obj)
+        return 'unknown (other host)' if alive is None else alive
+
+    def has_add_permission(self, request):
+        return False
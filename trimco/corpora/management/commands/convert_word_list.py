@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from corpora.utils.word_list import convert_word_list_to_counts
+
+
+class Command(BaseCommand):
+    help = 'Converts words and standartizations from arrays of values to counter maps ' \
+           'with precomputed top values, needs to be run once after upgrading'
+
+    def handle(self, *args, **options):
+        self.stdout.write('converted %d documents' % convert_word_list_to_counts())
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from corpora.utils.db_indexes import (
+    diff_indexes, create_indexes, drop_undeclared_indexes, check_query_plans
+)
+from corpora.utils.word_list import merge_duplicate_words
+
+
+class Command(BaseCommand):
+    help = 'Creates, diffs and drops Mongo indexes declared in corpora/utils/db_indexes.py ' \
+           'and checks that no query shape is served by a collection scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--create', action='store_true',
+            help='create missing and changed indexes, duplicate words are merged first'
+        )
+        parser.add_argument('--drop', action='store_true', help='drop indexes that are not declared')
+        parser.add_argument('--check', action='store_true', help='fail if any query shape runs a COLLSCAN')
+
+    def handle(self, *args, **options):
+        if options['create']:
+            n_ops = merge_duplicate_words()
+            if n_ops:
+                self.stdout.write('merged duplicate words with %d operations' % n_ops)
+            created, replaced = create_indexes()
+            for index, name in replaced:
+                self.stdout.write('dropped %s.%s, replaced by %s' % (index.collection, name, index.name))
+            for index in created:
+                self.stdout.write('created %s.%s' % (index.collection, index.name))
+
+        if options['drop']:
+            for collection, name in drop_undeclared_indexes():
+                self.stdout.write('dropped %s.%s' % (collection, name))
+
+        missing, changed, undeclared = diff_indexes()
+        for index in missing:
+            self.stdout.write('missing %s.%s %s' % (index.collection, index.name, index.keys))
+        for index in changed:
+            self.stdout.write('changed %s.%s %s' % (index.collection, index.name, index.keys))
+        for collection, name in undeclared:
+            self.stdout.write('undeclared %s.%s' % (collection, name))
+        if not (missing or changed or undeclared):
+            self.stdout.write('indexes are in sync')
+
+        if options['check']:
+            failed = check_query_plans()
+            if failed:
+                raise CommandError('\n'.join(
+                    'COLLSCAN in "%s" on %s: %s' % (shape.description, shape.collection, ' > '.join(map(str, stages)))
+                    for shape, stages in failed
+                ))
+            self.stdout.write('no collection scans in query plans')
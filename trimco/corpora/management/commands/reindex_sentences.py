@@ -0,0 +1,59 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from corpora.models import Recording
+from corpora.search_engine.reindex import reindex_recordings, BatchError
+
+
+class Command(BaseCommand):
+    help = 'Parses changed EAF files of recordings in parallel, writes changed sentences of indexed recordings ' \
+           'and sentences of new ones in bounded batches to the search backend, removes sentences of deleted recordings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of parsing processes')
+        parser.add_argument('--batch-size', type=int, default=1000, help='number of sentences per insert')
+        parser.add_argument('--clear', action='store_true', help='delete all sentences and reindex every recording')
+
+    def get_recordings(self):
+        recordings = Recording.objects.exclude(data='').exclude(data=None)
+        for data, audio, dialect in recordings.values_list('data', 'audio', 'to_dialect_id').iterator():
+            yield data.rsplit('/', 1)[-1], (audio or '').rsplit('/', 1)[-1], dialect
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        n_recordings = n_sentences = n_errors = n_unchanged = 0
+
+        for report in reindex_recordings(
+                self.get_recordings(), options['workers'], options['batch_size'], options['clear']
+        ):
+            if isinstance(report, BatchError):
+                n_errors += 1
+                self.stderr.write('ERROR writing batch of %s: %s' % (', '.join(report.elans), report.error))
+                continue
+
+            if report.status == 'failed':
+                n_errors += 1
+                self.stderr.write('ERROR %s: %s' % (report.elan, report.error))
+                continue
+
+            if report.status == 'unchanged':
+                n_unchanged += 1
+                continue
+
+            if report.status == 'deleted':
+                self.stdout.write('%s: deleted %d sentences' % (report.elan, report.n_sentences))
+                continue
+
+            n_recordings += 1
+            n_sentences += report.n_sentences
+            self.stdout.write('%s: %d sentences in %.2fs (%.0f/s)' % (
+                report.elan, report.n_sentences, report.seconds,
+                report.n_sentences / report.seconds if report.seconds else 0
+            ))
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write('%d recordings, %d sentences in %.1fs (%.0f sentences/s), %d unchanged, %d errors' % (
+            n_recordings, n_sentences, elapsed, n_sentences / elapsed if elapsed else 0, n_unchanged, n_errors
+        ))
@@ -0,0 +1,32 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+
+from corpora.utils.jobs import run_worker, requeue_abandoned_jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs queued jobs (auto-annotation, reannotation of unchecked recordings, retraining of models) ' \
+           'in worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='number of worker processes')
+        parser.add_argument('--once', action='store_true', help='exit when there are no queued jobs')
+
+    def handle(self, *args, **options):
+        n_requeued = requeue_abandoned_jobs()
+        if n_requeued:
+            self.stdout.write('requeued %d jobs of killed workers' % n_requeued)
+
+        if options['workers'] <= 1:
+            run_worker(options['once'])
+            return
+
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(options['once'],))
+            for _ in range(options['workers'])
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('corpora', '0012_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordingLock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('elan', models.CharField(max_length=255, unique=True)),
+                ('owner', models.CharField(blank=True, max_length=150)),
+                ('worker', models.CharField(max_length=50)),
+                ('acquired', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Recording lock',
+                'verbose_name_plural': 'Recording locks',
+            },
+        ),
+    ]
@@ -129,3 +129,62 @@ class Corpus(models.Model):
 
     class Meta:
         verbose_name_plural = 'Corpora'
+
+
+class Job(models.Model):
+    """
+    long operation which is run by worker processes of `manage.py run_jobs` (see corpora/utils/jobs.py)
+    instead of the request that started it
+    """
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    kind = models.CharField(max_length=30)
+    params = models.TextField(default='{}')  # json
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued', db_index=True)
+    worker = models.CharField(max_length=50, blank=True)
+
+    progress = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    # json list of {'recording', 'seconds', 'error'}, one item per processed recording
+    items = models.TextField(default='[]')
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '{} #{}: {}'.format(self.kind, self.pk, self.status)
+
+    def seconds(self):
+        if self.started is None:
+            return None
+        return ((self.finished or timezone.now()) - self.started).total_seconds()
+
+    class Meta:
+        verbose_name = 'Job'
+        verbose_name_plural = 'Jobs'
+        ordering = ('-created',)
+
+
+class RecordingLock(models.Model):
+    """
+    lock of an EAF file which is currently written, see corpora/utils/locks.py
+    """
+    elan = models.CharField(max_length=255, unique=True)
+    owner = models.CharField(max_length=150, blank=True)  # user or job holding the lock
+    worker = models.CharField(max_length=50)  # host:pid
+    acquired = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '{} locked by {}'.format(self.elan, self.owner or self.worker)
+
+    class Meta:
+        verbose_name = 'Recording lock'
+        verbose_name_plural = 'Recording locks'
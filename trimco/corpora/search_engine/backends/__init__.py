@@ -0,0 +1,28 @@
+"""
+Storage engines behind search_backend.search and saved_recording_to_db.
+The engine is chosen with SEARCH_BACKEND setting: 'mongo' (default) or 'sqlite'.
+"""
+
+from trimco.settings import SEARCH_BACKEND, SEARCH_SQLITE_PATH
+
+
+_BACKEND = None
+
+
+def create_search_backend(name=SEARCH_BACKEND):
+    if name == 'mongo':
+        from .mongo import MongoSearchBackend
+        return MongoSearchBackend()
+
+    if name == 'sqlite':
+        from .sqlite import SQLiteSearchBackend
+        return SQLiteSearchBackend(SEARCH_SQLITE_PATH)
+
+    raise ValueError('Unknown search backend: ' + str(name))
+
+
+def get_search_backend():
+    global _BACKEND
+    if _BACKEND is None:
+        _BACKEND = create_search_backend()
+    return _BACKEND
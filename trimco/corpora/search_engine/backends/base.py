@@ -0,0 +1,123 @@
+from collections import defaultdict
+
+from trimco.settings import MONGODB_LIMIT
+
+
+def get_sentence_key(sentence):
+    return sentence['tier'], sentence['audio']['start'], sentence['audio']['end']
+
+
+def diff_sentences(stored, sentences):
+    """
+    stored are sentences of a recording with `_id` and `hash` as they are in the backend,
+    sentences are new sentences of the recording with `hash`.
+    returns (new sentences, [(_id, sentence)] of changed ones, _ids of removed ones),
+    sentences with the same key are matched in order of their _ids
+    """
+    stored_by_key = defaultdict(list)
+    for item in sorted(stored, key=lambda x: x['_id']):
+        stored_by_key[get_sentence_key(item)].append(item)
+
+    inserted, updated = [], []
+    for sentence in sentences:
+        same_key = stored_by_key.get(get_sentence_key(sentence))
+        if not same_key:
+            inserted.append(sentence)
+            continue
+
+        item = same_key.pop(0)
+        if item.get('hash') != sentence['hash']:
+            updated.append((item['_id'], sentence))
+
+    deleted = [item['_id'] for items in stored_by_key.values() for item in items]
+    return inserted, updated, deleted
+
+
+class SearchBackend:
+    """
+    Stores sentences in the format of elan_to_db.process_one_tier together with their tokens.
+
+    Queries returned by compile_query are opaque for the rest of the code.
+    Sentences returned by find_sentences have `_id` and are sorted by
+    (elan, audio.start, tier, _id), which is a unique key of a sentence.
+    """
+    name = None
+
+    def compile_query(self, dialect, transcription, standartization, lemma, annotation):
+        """
+        returns None for an empty query
+        """
+        raise NotImplementedError
+
+    def count(self, query, cap=None):
+        """
+        returns (count, capped), counting stops after cap sentences if cap is given
+        """
+        raise NotImplementedError
+
+    def find_sentences(self, query, key=None, after=True, limit=MONGODB_LIMIT, keys_only=False):
+        """
+        sentences strictly after (or before, in reverse order) the sort key,
+        with keys_only only fields of the sort key are returned
+        """
+        raise NotImplementedError
+
+    def parse_id(self, raw_id):
+        """
+        restores `_id` of a sentence from its string representation
+        """
+        raise NotImplementedError
+
+    def has_recording(self, elan):
+        raise NotImplementedError
+
+    def delete_recording(self, elan):
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        deletes all sentences and tokens
+        """
+        raise NotImplementedError
+
+    def insert_sentences(self, sentences):
+        """
+        inserts sentences and their tokens, sets `_id` of each sentence
+        """
+        raise NotImplementedError
+
+    def sync_recording(self, elan, sentences):
+        """
+        makes stored sentences of the recording equal to sentences
+        writing only the ones that were inserted, changed or deleted,
+        returns (n_inserted, n_updated, n_deleted)
+        """
+        raise NotImplementedError
+
+    def update_sentences_words(self, updates):
+        """
+        updates are (elan, tier, start, end, words),
+        replaces words, html fragments and tokens of the sentences in one batch,
+        sentences whose words did not change are not written.
+        returns number of sentences changed
+        """
+        raise NotImplementedError
+
+    def store_html(self, html_by_id):
+        raise NotImplementedError
+
+    def get_write_generation(self):
+        """
+        counter that changes after every write to sentences, used to invalidate search caches
+        """
+        raise NotImplementedError
+
+    def bump_write_generation(self):
+        raise NotImplementedError
+
+    def get_manifest(self):
+        """
+        returns the store of 'sentences' parts of manifest entries (see utils/manifest.py),
+        it has get, get_all, set_part, unset_part and unset_part_everywhere of MongoManifest
+        """
+        raise NotImplementedError
@@ -0,0 +1,233 @@
+from collections import namedtuple
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, UpdateOne, InsertOne, ReplaceOne, DeleteOne
+
+from trimco.settings import MONGODB_LIMIT
+from corpora.utils.db_utils import SENTENCE_COLLECTION, TOKEN_COLLECTION, META_COLLECTION
+from corpora.utils.format_utils import ANNOTATION_TAG_SEP
+from corpora.utils.manifest import MONGO_MANIFEST
+from ..db_to_html import sentence_to_html
+from ..elan_to_db import insert_sentences_in_mongo, get_sentence_hash
+from ..token_index import (
+    index_sentences, count_sentences,
+    remove_sentences_from_index, remove_elan_from_index
+)
+from .base import SearchBackend, diff_sentences
+
+
+# sentences are sorted by recording and time, tier and id make the sort key unique
+ASCENDING_SORT = [('elan', ASCENDING), ('audio.start', ASCENDING), ('tier', ASCENDING), ('_id', ASCENDING)]
+DESCENDING_SORT = [(field, DESCENDING) for field, _ in ASCENDING_SORT]
+SORT_KEY_PROJECTION = {field: True for field, _ in ASCENDING_SORT}
+
+# the same key in tokens of the token index, which are read in this order for word-level queries
+TOKEN_SORT_FIELDS = ['elan', 'audio_start', 'tier', 'sentence']
+
+SENTENCES_GENERATION_ID = 'sentences_generation'
+
+# query of sentences with tokens matching the filter, see MongoSearchBackend.find_sentence_keys
+TokenQuery = namedtuple('TokenQuery', ['filter'])
+
+
+def keyset_query(key, after=True, fields=None):
+    """
+    matches sentences (or tokens with TOKEN_SORT_FIELDS) strictly after (or before) the sort key
+    """
+    op = '$gt' if after else '$lt'
+    fields = fields or [field for field, _ in ASCENDING_SORT]
+    return {
+        '$or': [
+            dict(zip(fields[:i], key[:i]), **{fields[i]: {op: key[i]}})
+            for i in range(len(fields))
+        ]
+    }
+
+
+class MongoSearchBackend(SearchBackend):
+    name = 'mongo'
+
+    def compile_query(self, dialect, transcription, standartization, lemma, annotation):
+        token_query = {}
+
+        if transcription:
+            token_query['transcription'] = transcription.lower()
+
+        if standartization:
+            token_query['standartization'] = standartization.lower()
+
+        if annotation:
+            annotation = annotation.lower().replace(ANNOTATION_TAG_SEP, ' ')
+            ann_parts = annotation.split()
+            token_query['tags'] = {'$all': ann_parts}
+
+        if lemma:
+            token_query['lemma'] = lemma.lower()
+
+        dialect_query = None
+        if dialect and any(d for d in dialect):
+            dialect_query = {'$in': [int(d) for d in dialect]}
+
+        if not token_query:
+            if dialect_query is None:
+                return
+            return {'dialect': dialect_query}
+
+        if dialect_query is not None:
+            token_query['dialect'] = dialect_query
+
+        # word-level filters are resolved through the token index,
+        # sentences are then fetched by their ids only, one page at a time
+        return TokenQuery(token_query)
+
+    def count(self, query, cap=None):
+        if isinstance(query, TokenQuery):
+            if cap is None:
+                return count_sentences(query.filter), False
+
+            # tokens are read in the sort order until cap + 1 sentences are seen,
+            # grouping all matching tokens first would cost the same as the exact count
+            count = len(self.find_sentence_keys(query.filter, limit=cap + 1))
+            return min(count, cap), count > cap
+
+        if cap is None:
+            return SENTENCE_COLLECTION.count_documents(query), False
+
+        count = SENTENCE_COLLECTION.count_documents(query, limit=cap + 1)
+        return min(count, cap), count > cap
+
+    @staticmethod
+    def find_sentence_keys(token_filter, key=None, after=True, limit=MONGODB_LIMIT):
+        """
+        sort keys of at most limit sentences with tokens matching the filter, strictly after (or before) the key.
+        tokens are read in the order of the sort key through an index and reading stops after limit sentences,
+        so the cost of a page does not depend on the number of matching tokens
+        """
+        if key is not None:
+            token_filter = {'$and': [keyset_query(key, after, TOKEN_SORT_FIELDS), token_filter]}
+
+        direction = ASCENDING if after else DESCENDING
+        tokens = TOKEN_COLLECTION.find(
+            token_filter, projection=dict({field: True for field in TOKEN_SORT_FIELDS}, _id=False)
+        ).sort([(field, direction) for field in TOKEN_SORT_FIELDS])
+
+        keys = []
+        try:
+            for token in tokens:
+                token_key = tuple(token[field] for field in TOKEN_SORT_FIELDS)
+                if keys and keys[-1] == token_key:
+                    continue  # tokens of one sentence are adjacent
+                keys.append(token_key)
+                if len(keys) >= limit:
+                    break
+        finally:
+            tokens.close()
+        return keys
+
+    def find_sentences(self, query, key=None, after=True, limit=MONGODB_LIMIT, keys_only=False):
+        if isinstance(query, TokenQuery):
+            keys = self.find_sentence_keys(query.filter, key, after, limit)
+            if keys_only:
+                return [
+                    {'elan': elan, 'audio': {'start': start}, 'tier': tier, '_id': _id}
+                    for elan, start, tier, _id in keys
+                ]
+
+            sentences = {
+                sentence['_id']: sentence
+                for sentence in SENTENCE_COLLECTION.find({'_id': {'$in': [_id for _, _, _, _id in keys]}})
+            }
+            return [sentences[_id] for _, _, _, _id in keys if _id in sentences]
+
+        if key is not None:
+            query = {'$and': [keyset_query(key, after), query]}
+
+        results = SENTENCE_COLLECTION.find(query, projection=SORT_KEY_PROJECTION if keys_only else None)
+        results = results.sort(ASCENDING_SORT if after else DESCENDING_SORT)
+        return results.limit(limit)
+
+    def parse_id(self, raw_id):
+        return ObjectId(raw_id)
+
+    def has_recording(self, elan):
+        return SENTENCE_COLLECTION.find_one({'elan': elan}, projection=['_id']) is not None
+
+    def delete_recording(self, elan):
+        SENTENCE_COLLECTION.delete_many({'elan': elan})
+        remove_elan_from_index(elan)
+
+    def clear(self):
+        SENTENCE_COLLECTION.delete_many({})
+        TOKEN_COLLECTION.delete_many({})
+
+    def insert_sentences(self, sentences):
+        insert_sentences_in_mongo(sentences)
+
+    def sync_recording(self, elan, sentences):
+        stored = SENTENCE_COLLECTION.find({'elan': elan}, projection=['tier', 'audio.start', 'audio.end', 'hash'])
+        inserted, updated, deleted = diff_sentences(stored, sentences)
+
+        requests = []
+        for sentence in inserted:
+            sentence['_id'] = ObjectId()
+            requests.append(InsertOne(sentence))
+        for _id, sentence in updated:
+            sentence['_id'] = _id
+            requests.append(ReplaceOne({'_id': _id}, sentence))
+        requests.extend(DeleteOne({'_id': _id}) for _id in deleted)
+
+        if requests:
+            SENTENCE_COLLECTION.bulk_write(requests, ordered=False)
+            remove_sentences_from_index([_id for _id, _ in updated] + deleted)
+            index_sentences(inserted + [sentence for _, sentence in updated])
+
+        return len(inserted), len(updated), len(deleted)
+
+    def update_sentences_words(self, updates):
+        if not updates:
+            return 0
+
+        words_by_key = {(elan, tier, start, end): words for elan, tier, start, end, words in updates}
+        filter_query = {'$or': [
+            {'elan': elan, 'audio.start': start, 'tier': tier, 'audio.end': end}
+            for elan, tier, start, end in words_by_key
+        ]}
+
+        sentences = []
+        requests = []
+        for sentence in SENTENCE_COLLECTION.find(filter_query, projection={'words': False, 'html': False}):
+            key = sentence['elan'], sentence['tier'], sentence['audio']['start'], sentence['audio']['end']
+            sentence['words'] = words_by_key[key]
+            sentence_hash = get_sentence_hash(sentence)
+            if sentence_hash == sentence.get('hash'):
+                continue
+            requests.append(UpdateOne({'_id': sentence['_id']}, {'$set': {
+                'words': sentence['words'],
+                'html': sentence_to_html(sentence),
+                'hash': sentence_hash
+            }}))
+            sentences.append(sentence)
+
+        if requests:
+            SENTENCE_COLLECTION.bulk_write(requests, ordered=False)
+            remove_sentences_from_index([sentence['_id'] for sentence in sentences])
+            index_sentences(sentences)
+
+        return len(sentences)
+
+    def store_html(self, html_by_id):
+        if html_by_id:
+            SENTENCE_COLLECTION.bulk_write(
+                [UpdateOne({'_id': _id}, {'$set': {'html': html}}) for _id, html in html_by_id.items()],
+                ordered=False
+            )
+
+    def get_write_generation(self):
+        generation = META_COLLECTION.find_one({'_id': SENTENCES_GENERATION_ID})
+        return generation['value'] if generation is not None else 0
+
+    def bump_write_generation(self):
+        META_COLLECTION.update_one({'_id': SENTENCES_GENERATION_ID}, {'$inc': {'value': 1}}, upsert=True)
+
+    def get_manifest(self):
+        return MONGO_MANIFEST
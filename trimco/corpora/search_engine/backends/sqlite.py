@@ -0,0 +1,370 @@
+"""
+Search backend for deployments without Mongo:
+sentences and tokens are stored in normalized SQLite tables.
+
+Transcriptions, standartizations and lemmata of tokens are looked up
+through B-tree indexes, grammatical tags through an FTS5 index.
+Every tag is indexed as a single hex-encoded term, so that FTS5 matches
+whole tags exactly, like `$all` does in Mongo, whatever characters they contain.
+"""
+
+import json
+import sqlite3
+import threading
+
+from trimco.settings import MONGODB_LIMIT
+from corpora.utils.format_utils import ANNOTATION_TAG_SEP
+from corpora.utils.manifest import MANIFEST_PARTS
+from ..db_to_html import sentence_to_html
+from ..elan_to_db import get_sentence_hash
+from .base import SearchBackend, diff_sentences
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sentences (
+    id INTEGER PRIMARY KEY,
+    elan TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    speaker TEXT NOT NULL,
+    dialect INTEGER,
+    audio_file TEXT NOT NULL,
+    audio_start INTEGER NOT NULL,
+    audio_end INTEGER NOT NULL,
+    words TEXT NOT NULL,
+    html TEXT,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS sentences_sort_key ON sentences (elan, audio_start, tier, id);
+CREATE INDEX IF NOT EXISTS sentences_dialect_sort_key ON sentences (dialect, elan, audio_start, tier, id);
+
+CREATE TABLE IF NOT EXISTS tokens (
+    id INTEGER PRIMARY KEY,
+    sentence_id INTEGER NOT NULL,
+    dialect INTEGER,
+    transcription TEXT NOT NULL,
+    standartization TEXT,
+    lemma TEXT,
+    tags TEXT
+);
+CREATE INDEX IF NOT EXISTS tokens_transcription ON tokens (transcription, dialect);
+CREATE INDEX IF NOT EXISTS tokens_standartization ON tokens (standartization, dialect);
+CREATE INDEX IF NOT EXISTS tokens_lemma ON tokens (lemma, dialect);
+CREATE INDEX IF NOT EXISTS tokens_sentence ON tokens (sentence_id);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS tokens_fts USING fts5(tags, content='tokens', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS tokens_fts_insert AFTER INSERT ON tokens BEGIN
+    INSERT INTO tokens_fts (rowid, tags) VALUES (new.id, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS tokens_fts_delete AFTER DELETE ON tokens BEGIN
+    INSERT INTO tokens_fts (tokens_fts, rowid, tags) VALUES ('delete', old.id, old.tags);
+END;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS manifest (
+    elan TEXT PRIMARY KEY,
+    entry TEXT NOT NULL
+);
+'''
+
+SORT_KEY = ('elan', 'audio_start', 'tier', 'id')
+SENTENCE_FIELDS = (
+    'id', 'elan', 'tier', 'speaker', 'dialect', 'audio_file', 'audio_start', 'audio_end', 'words', 'html', 'hash'
+)
+
+
+def fts_term(tag):
+    return tag.encode('utf-8').hex()
+
+
+def row_to_sentence(row):
+    sentence = {
+        '_id': row['id'],
+        'elan': row['elan'],
+        'tier': row['tier'],
+        'audio': {'start': row['audio_start']}
+    }
+
+    if 'words' in row.keys():
+        sentence.update({
+            'speaker': row['speaker'],
+            'dialect': row['dialect'],
+            'words': json.loads(row['words']),
+            'html': row['html'],
+            'hash': row['hash']
+        })
+        sentence['audio'].update({'file': row['audio_file'], 'end': row['audio_end']})
+
+    return sentence
+
+
+def sentence_to_row(sentence):
+    return [
+        sentence['elan'], sentence['tier'], sentence['speaker'], sentence['dialect'],
+        sentence['audio']['file'], sentence['audio']['start'], sentence['audio']['end'],
+        json.dumps(sentence['words'], ensure_ascii=False), sentence.get('html'), sentence.get('hash')
+    ]
+
+
+def sentence_to_token_rows(sentence):
+    rows = []
+    for word in sentence['words']:
+        ann = word.get('annotation')
+        rows.append((
+            sentence['_id'],
+            sentence['dialect'],
+            word['transcription'],
+            word.get('standartization'),
+            ann['lemma'] if ann is not None else None,
+            ' '.join(fts_term(tag) for tag in ann['tags']) if ann is not None else None
+        ))
+    return rows
+
+
+class SQLiteManifest:
+    """
+    manifest entries as JSON in the database of the backend, the same as documents of MongoManifest
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, elan):
+        row = self.backend.connection.execute('SELECT entry FROM manifest WHERE elan = ?', (elan,)).fetchone()
+        return json.loads(row['entry']) if row is not None else None
+
+    def get_all(self, part):
+        entries = (json.loads(row['entry']) for row in self.backend.connection.execute('SELECT entry FROM manifest'))
+        return {entry['_id']: entry for entry in entries if part in entry}
+
+    def set_part(self, elan, part, state, values):
+        with self.backend.connection:
+            entry = self.get(elan) or {'_id': elan}
+            entry.update(state)
+            entry[part] = values
+            self._put(entry)
+
+    def unset_part(self, elan, part):
+        with self.backend.connection:
+            entry = self.get(elan)
+            if entry is not None and part in entry:
+                del entry[part]
+                self._put(entry)
+
+    def unset_part_everywhere(self, part):
+        with self.backend.connection:
+            for entry in self.get_all(part).values():
+                del entry[part]
+                self._put(entry)
+
+    def _put(self, entry):
+        if not any(part in entry for part in MANIFEST_PARTS):
+            self.backend.connection.execute('DELETE FROM manifest WHERE elan = ?', (entry['_id'],))
+        else:
+            self.backend.connection.execute(
+                'INSERT OR REPLACE INTO manifest (elan, entry) VALUES (?, ?)',
+                (entry['_id'], json.dumps(entry, ensure_ascii=False))
+            )
+
+
+class SQLiteSearchBackend(SearchBackend):
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # sqlite connections can not be shared between threads
+        self.manifest = SQLiteManifest(self)
+
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.local.connection = connection
+        return connection
+
+    def compile_query(self, dialect, transcription, standartization, lemma, annotation):
+        token_conditions = []
+        token_params = []
+
+        for field, value in [('transcription', transcription), ('standartization', standartization), ('lemma', lemma)]:
+            if value:
+                token_conditions.append(field + ' = ?')
+                token_params.append(value.lower())
+
+        if annotation:
+            ann_parts = annotation.lower().replace(ANNOTATION_TAG_SEP, ' ').split()
+            token_conditions.append('id IN (SELECT rowid FROM tokens_fts WHERE tokens_fts MATCH ?)')
+            token_params.append(' AND '.join('"%s"' % fts_term(tag) for tag in ann_parts))
+
+        dialect_condition = None
+        dialect_params = []
+        if dialect and any(d for d in dialect):
+            dialect_params = [int(d) for d in dialect]
+            dialect_condition = 'dialect IN (%s)' % ', '.join('?' * len(dialect_params))
+
+        if not token_conditions:
+            if dialect_condition is None:
+                return
+            return dialect_condition, dialect_params
+
+        if dialect_condition is not None:
+            token_conditions.append(dialect_condition)
+            token_params.extend(dialect_params)
+
+        return (
+            'id IN (SELECT sentence_id FROM tokens WHERE %s)' % ' AND '.join(token_conditions),
+            token_params
+        )
+
+    def count(self, query, cap=None):
+        where, params = query
+        if cap is None:
+            sql = 'SELECT COUNT(*) FROM sentences WHERE ' + where
+            return self.connection.execute(sql, params).fetchone()[0], False
+
+        sql = 'SELECT COUNT(*) FROM (SELECT 1 FROM sentences WHERE %s LIMIT ?)' % where
+        count = self.connection.execute(sql, params + [cap + 1]).fetchone()[0]
+        return min(count, cap), count > cap
+
+    def find_sentences(self, query, key=None, after=True, limit=MONGODB_LIMIT, keys_only=False):
+        where, params = query
+        params = list(params)
+
+        if key is not None:
+            where = '(%s) AND (%s) %s (?, ?, ?, ?)' % (where, ', '.join(SORT_KEY), '>' if after else '<')
+            params.extend(key)
+
+        direction = 'ASC' if after else 'DESC'
+        sql = 'SELECT %s FROM sentences WHERE %s ORDER BY %s LIMIT ?' % (
+            ', '.join(SORT_KEY if keys_only else SENTENCE_FIELDS),
+            where,
+            ', '.join(field + ' ' + direction for field in SORT_KEY)
+        )
+        params.append(limit)
+
+        return [row_to_sentence(row) for row in self.connection.execute(sql, params)]
+
+    def parse_id(self, raw_id):
+        return int(raw_id)
+
+    def has_recording(self, elan):
+        return self.connection.execute('SELECT 1 FROM sentences WHERE elan = ? LIMIT 1', [elan]).fetchone() is not None
+
+    def delete_recording(self, elan):
+        with self.connection:
+            self.connection.execute(
+                'DELETE FROM tokens WHERE sentence_id IN (SELECT id FROM sentences WHERE elan = ?)', [elan]
+            )
+            self.connection.execute('DELETE FROM sentences WHERE elan = ?', [elan])
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM tokens')
+            self.connection.execute('DELETE FROM sentences')
+
+    def _insert_tokens(self, sentences):
+        self.connection.executemany(
+            'INSERT INTO tokens (sentence_id, dialect, transcription, standartization, lemma, tags) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [row for sentence in sentences for row in sentence_to_token_rows(sentence)]
+        )
+
+    def _insert_sentences(self, sentences):
+        for sentence in sentences:
+            cursor = self.connection.execute(
+                'INSERT INTO sentences (%s) VALUES (%s)' % (', '.join(SENTENCE_FIELDS[1:]), ', '.join('?' * (len(SENTENCE_FIELDS) - 1))),
+                sentence_to_row(sentence)
+            )
+            sentence['_id'] = cursor.lastrowid
+
+    def _delete_tokens(self, sentence_ids):
+        self.connection.executemany('DELETE FROM tokens WHERE sentence_id = ?', [(_id,) for _id in sentence_ids])
+
+    def insert_sentences(self, sentences):
+        with self.connection:
+            self._insert_sentences(sentences)
+            self._insert_tokens(sentences)
+
+    def sync_recording(self, elan, sentences):
+        stored = [
+            {'_id': row[0], 'tier': row[1], 'audio': {'start': row[2], 'end': row[3]}, 'hash': row[4]}
+            for row in self.connection.execute(
+                'SELECT id, tier, audio_start, audio_end, hash FROM sentences WHERE elan = ?', [elan]
+            )
+        ]
+        inserted, updated, deleted = diff_sentences(stored, sentences)
+
+        with self.connection:
+            self._insert_sentences(inserted)
+            for _id, sentence in updated:
+                sentence['_id'] = _id
+            self.connection.executemany(
+                'UPDATE sentences SET %s WHERE id = ?' % ', '.join(field + ' = ?' for field in SENTENCE_FIELDS[1:]),
+                [sentence_to_row(sentence) + [_id] for _id, sentence in updated]
+            )
+            self._delete_tokens([_id for _id, _ in updated] + deleted)
+            self.connection.executemany('DELETE FROM sentences WHERE id = ?', [(_id,) for _id in deleted])
+            self._insert_tokens(inserted + [sentence for _, sentence in updated])
+
+        return len(inserted), len(updated), len(deleted)
+
+    def update_sentences_words(self, updates):
+        sentences = []
+        for elan, tier, start, end, words in updates:
+            row = self.connection.execute(
+                'SELECT %s FROM sentences WHERE elan = ? AND audio_start = ? AND tier = ? AND audio_end = ?'
+                % ', '.join(SENTENCE_FIELDS),
+                [elan, start, tier, end]
+            ).fetchone()
+            if row is not None:
+                sentence = row_to_sentence(row)
+                sentence['words'] = words
+                if get_sentence_hash(sentence) != sentence['hash']:
+                    sentences.append(sentence)
+
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE sentences SET words = ?, html = ?, hash = ? WHERE id = ?',
+                [
+                    (
+                        json.dumps(sentence['words'], ensure_ascii=False), sentence_to_html(sentence),
+                        get_sentence_hash(sentence), sentence['_id']
+                    )
+                    for sentence in sentences
+                ]
+            )
+            self._delete_tokens([sentence['_id'] for sentence in sentences])
+            self._insert_tokens(sentences)
+
+        return len(sentences)
+
+    def store_html(self, html_by_id):
+        with self.connection:
+            self.connection.executemany(
+                'UPDATE sentences SET html = ? WHERE id = ?',
+                [(html, _id) for _id, html in html_by_id.items()]
+            )
+
+    def get_write_generation(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'sentences_generation'").fetchone()
+        return row[0] if row is not None else 0
+
+    def bump_write_generation(self):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('sentences_generation', 0)"
+            )
+            self.connection.execute(
+                "UPDATE meta SET value = value + 1 WHERE key = 'sentences_generation'"
+            )
+
+    def get_manifest(self):
+        return self.manifest
@@ -2,12 +2,12 @@ from decimal import Decimal
 
 from lxml import etree
 
-from corpora.utils.db_utils import SENTENCE_COLLECTION
 from corpora.utils.format_utils import (
     TECH_REGEX, get_audio_annot_div, get_annot_div,
     get_participant_tag_and_status
 )
 from corpora.utils.elan_utils import split_ann_for_db
+from .backends import get_search_backend
 
 
 def get_transcript_and_tags_dicts(words):
@@ -36,40 +36,59 @@ def get_transcript_and_tags_dicts(words):
     return ' '.join(transcript), normz_tokens_dict, annot_tokens_dict
 
 
+def get_page_key_info(item):
+    """
+    json-serializable sort key of a sentence,
+    tier and id make it unique when several tiers start at the same time
+    """
+    return {
+        'elan': item['elan'],
+        'audio_start': item['audio']['start'],
+        'tier': item['tier'],
+        'id': str(item['_id'])
+    }
+
+
+def sentence_to_html(item):
+    transcript, normz_tokens_dict, annot_tokens_dict = get_transcript_and_tags_dicts(item['words'])
+    participant, participant_status = get_participant_tag_and_status(item['speaker'], item['tier'])
+    annot_div = get_annot_div(
+        tier_name=item['tier'],
+        dialect=item['dialect'],
+        participant=participant,
+        transcript=transcript,
+        normz_tokens_dict=normz_tokens_dict,
+        annot_tokens_dict=annot_tokens_dict,
+        elan_file=item['elan']
+    )
+
+    audio_annot_div = get_audio_annot_div(item['audio']['start'], item['audio']['end'], item['audio']['file'])
+    return '<div class="annot_wrapper %s">%s%s</div>' % (participant_status, audio_annot_div, annot_div)
+
+
 def db_response_to_html(results, reverse=False):
     if results is None:
         return '<div id="no_result">Empty search query.</div>', {}
 
     item_divs = []
     page_info = {}
+    html_to_backfill = {}
 
     for i, item in enumerate(results):
         if not i:
-            page_info['min'] = {
-                'elan': item['elan'],
-                'audio_start': item['audio']['start']
-            }
-
-        transcript, normz_tokens_dict, annot_tokens_dict = get_transcript_and_tags_dicts(item['words'])
-        participant, participant_status = get_participant_tag_and_status(item['speaker'], item['tier'])
-        annot_div = get_annot_div(
-            tier_name=item['tier'],
-            dialect=item['dialect'],
-            participant=participant,
-            transcript=transcript,
-            normz_tokens_dict=normz_tokens_dict,
-            annot_tokens_dict=annot_tokens_dict,
-            elan_file=item['elan']
-        )
-
-        audio_annot_div = get_audio_annot_div(item['audio']['start'], item['audio']['end'], item['audio']['file'])
-        annot_wrapper_div = '<div class="annot_wrapper %s">%s%s</div>' % (participant_status, audio_annot_div, annot_div)
+            page_info['min'] = get_page_key_info(item)
+
+        # fragments are rendered when sentences are written, see elan_to_db and html_to_db
+        annot_wrapper_div = item.get('html')
+        if annot_wrapper_div is None:
+            annot_wrapper_div = sentence_to_html(item)
+            html_to_backfill[item['_id']] = annot_wrapper_div
         item_divs.append(annot_wrapper_div)
 
-        page_info['max'] = {
-            'elan': item['elan'],
-            'audio_start': item['audio']['start']
-        }
+        page_info['max'] = get_page_key_info(item)
+
+    if html_to_backfill:  # sentences inserted before `html` field was introduced
+        get_search_backend().store_html(html_to_backfill)
 
     if reverse and item_divs:
         item_divs = item_divs[::-1]
@@ -113,7 +132,9 @@ def process_html_token(token_el):
 
 
 def html_to_db(html_result):
+    backend = get_search_backend()
     html_obj = etree.fromstring(html_result)
+    updates = []
     for el in html_obj.xpath('//*[contains(@class,"annot_wrapper") and contains(@class, "changed")]'):
         elan_name = el.xpath('*[@class="annot"]/@elan')[0]
         tier_name = el.xpath('*[@class="annot"]/@tier_name')[0]
@@ -125,6 +146,8 @@ def html_to_db(html_result):
             word_dict = process_html_token(token)
             words.append(word_dict)
 
-        filter_query = {'elan': elan_name, 'tier': tier_name, 'audio.start': start, 'audio.end': end}
-        update_query = {'$set': {'words': words}}
-        SENTENCE_COLLECTION.update_one(filter_query, update_query)
+        updates.append((elan_name, tier_name, start, end, words))
+
+    # one batch for all changed sentences, searches are cached until something is written
+    if backend.update_sentences_words(updates):
+        backend.bump_write_generation()
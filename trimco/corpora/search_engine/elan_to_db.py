@@ -1,5 +1,8 @@
 import os
+import json
+import hashlib
 from pympi import Eaf
+from pymongo.errors import BulkWriteError
 
 from corpora.utils.db_utils import SENTENCE_COLLECTION
 from corpora.utils.elan_utils import (
@@ -10,6 +13,8 @@ from corpora.utils.format_utils import (
     ANNOTATION_NUM_REGEX, TECH_REGEX
 )
 from trimco.settings import MEDIA_ROOT
+from .token_index import index_sentences
+from .db_to_html import sentence_to_html
 
 
 def process_one_annotation(orig, standartization, annotation):
@@ -51,6 +56,15 @@ def process_one_annotation(orig, standartization, annotation):
     return words
 
 
+def get_sentence_hash(sentence):
+    """
+    hash of everything the stored sentence and its html fragment are made of,
+    used to find sentences that changed when a recording is saved
+    """
+    content = {field: sentence[field] for field in ('words', 'dialect', 'speaker', 'audio')}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
 def process_one_tier(eaf_filename, audio_filename, dialect, speaker, tier_name, orig_tier, standartization_tier, annotation_tier):
     sentences = []
     tier_alignment = get_tier_alignment(orig_tier, standartization_tier, annotation_tier)
@@ -67,6 +81,8 @@ def process_one_tier(eaf_filename, audio_filename, dialect, speaker, tier_name,
                 'end': end
             }
         }
+        sentence['html'] = sentence_to_html(sentence)  # pre-rendered fragment for search results
+        sentence['hash'] = get_sentence_hash(sentence)
         sentences.append(sentence)
 
     return sentences
@@ -102,4 +118,15 @@ def process_one_elan(eaf_filename, audio_filename, dialect):
 
 
 def insert_sentences_in_mongo(sentences):
-    SENTENCE_COLLECTION.insert_many(sentences)
+    if not sentences:
+        return
+
+    # sets `_id` of each sentence, unordered insert does not stop at a bad document
+    try:
+        SENTENCE_COLLECTION.insert_many(sentences, ordered=False)
+    except BulkWriteError as e:
+        failed = {error['index'] for error in e.details['writeErrors']}
+        index_sentences([sentence for i, sentence in enumerate(sentences) if i not in failed])
+        raise
+
+    index_sentences(sentences)
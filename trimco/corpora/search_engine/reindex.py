@@ -0,0 +1,188 @@
+"""
+Streaming rebuild of the search backend from EAF files.
+
+Recordings are parsed in a process pool and their sentences are written
+in bounded batches, so memory does not depend on the size of the corpus:
+at most a few parsed recordings and one batch are held at a time.
+
+Recordings whose EAF and metadata did not change since they were indexed
+(according to utils/manifest.py) are skipped, sentences of deleted recordings are removed.
+Recordings that are already indexed are synced, so that only their changed sentences are written,
+new ones (and all of them with --clear) are inserted in batches.
+"""
+
+import os
+import time
+import concurrent.futures
+from collections import namedtuple
+
+from trimco.settings import MEDIA_ROOT
+from corpora.utils.manifest import (
+    get_file_state, get_entries, is_up_to_date, set_part, unset_part, unset_part_everywhere
+)
+from .elan_to_db import process_one_elan
+from .backends import get_search_backend
+
+
+ParsedRecording = namedtuple('ParsedRecording', ['recording', 'state', 'sentences', 'error', 'seconds'])
+# status is 'indexed', 'unchanged', 'deleted' or 'failed'
+RecordingReport = namedtuple('RecordingReport', ['elan', 'status', 'n_sentences', 'error', 'seconds'])
+BatchError = namedtuple('BatchError', ['elans', 'error'])
+
+
+def parse_recording(recording, state):
+    """
+    runs in a worker process, errors are returned instead of raised
+    so that one broken recording does not stop the others
+    """
+    start = time.perf_counter()
+    try:
+        sentences = process_one_elan(*recording)
+    except Exception as e:
+        return ParsedRecording(recording, state, [], repr(e), time.perf_counter() - start)
+    return ParsedRecording(recording, state, sentences, None, time.perf_counter() - start)
+
+
+def iter_parsed_recordings(recordings, workers):
+    """
+    recordings are (recording, state),
+    yields ParsedRecording in order of completion,
+    no more than 2 * workers recordings are submitted but not yet consumed
+    """
+    recordings = iter(recordings)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while True:
+            for recording, state in recordings:
+                pending.add(executor.submit(parse_recording, recording, state))
+                if len(pending) >= 2 * workers:
+                    break
+
+            if not pending:
+                return
+
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def get_sentences_params(backend, recording):
+    _, audio_filename, dialect = recording
+    return {'backend': backend.name, 'audio': audio_filename, 'dialect': dialect}
+
+
+def select_changed_recordings(backend, recordings, entries, reports):
+    """
+    yields (recording, state) for recordings that have to be reindexed,
+    reports of unchanged and unreadable ones are appended to reports.
+    entries of all passed recordings are removed from entries
+    """
+    for recording in recordings:
+        eaf_filename = recording[0]
+        entry = entries.pop(eaf_filename, None)
+        try:
+            state = get_file_state(os.path.join(MEDIA_ROOT, eaf_filename), entry)
+        except OSError as e:
+            reports.append(RecordingReport(eaf_filename, 'failed', 0, repr(e), 0))
+            continue
+
+        if is_up_to_date(entry, 'sentences', state, **get_sentences_params(backend, recording)):
+            reports.append(RecordingReport(eaf_filename, 'unchanged', entry['sentences']['count'], None, 0))
+            continue
+
+        yield recording, state
+
+
+def reindex_recordings(recordings, workers, batch_size=1000, clear=False):
+    """
+    recordings are (eaf_filename, audio_filename, dialect) of all recordings,
+    yields RecordingReport after sentences of a recording are queued for writing
+    and BatchError for every batch that could not be written completely
+    """
+    backend = get_search_backend()
+    if clear:
+        backend.clear()
+        unset_part_everywhere('sentences')
+
+    entries = get_entries('sentences')
+    reports = []
+    is_changed = clear
+
+    batch = []
+    batch_elans = set()
+    # manifest parts of recordings whose last sentences are in the batch, they are set when it is written
+    batch_parts = []
+    failed_elans = set()
+
+    def write_batch():
+        error = None
+        try:
+            if batch:
+                backend.insert_sentences(batch)
+        except Exception as e:
+            failed_elans.update(batch_elans)  # to be reindexed next time
+            error = BatchError(sorted(batch_elans), repr(e))
+
+        for eaf_filename, state, values in batch_parts:
+            if eaf_filename not in failed_elans:
+                set_part(eaf_filename, 'sentences', state, **values)
+        return error
+
+    try:
+        changed = select_changed_recordings(backend, recordings, entries, reports)
+        for parsed in iter_parsed_recordings(changed, workers):
+            yield from reports
+            reports.clear()
+
+            if parsed.error is not None:
+                yield RecordingReport(parsed.recording[0], 'failed', 0, parsed.error, parsed.seconds)
+                continue
+
+            eaf_filename = parsed.recording[0]
+            values = dict(count=len(parsed.sentences), **get_sentences_params(backend, parsed.recording))
+            if not clear and backend.has_recording(eaf_filename):
+                # the entry describes sentences that are changed now
+                unset_part(eaf_filename, 'sentences')
+                try:
+                    n_written = sum(backend.sync_recording(eaf_filename, parsed.sentences))
+                except Exception as e:
+                    yield RecordingReport(eaf_filename, 'failed', 0, repr(e), parsed.seconds)
+                    continue
+                is_changed = is_changed or n_written > 0
+                set_part(eaf_filename, 'sentences', parsed.state, **values)
+                yield RecordingReport(eaf_filename, 'indexed', len(parsed.sentences), None, parsed.seconds)
+                continue
+
+            is_changed = True
+            if not clear:
+                unset_part(eaf_filename, 'sentences')
+
+            for sentence in parsed.sentences:
+                batch.append(sentence)
+                batch_elans.add(eaf_filename)
+                if len(batch) >= batch_size:
+                    error = write_batch()
+                    if error is not None:
+                        yield error
+                    batch, batch_elans, batch_parts = [], set(), []
+
+            batch_parts.append((eaf_filename, parsed.state, values))
+            yield RecordingReport(eaf_filename, 'indexed', len(parsed.sentences), None, parsed.seconds)
+
+        yield from reports
+
+        if batch or batch_parts:
+            error = write_batch()
+            if error is not None:
+                yield error
+
+        # recordings that are indexed but no longer exist
+        for eaf_filename, entry in entries.items():
+            is_changed = True
+            backend.delete_recording(eaf_filename)
+            unset_part(eaf_filename, 'sentences')
+            yield RecordingReport(eaf_filename, 'deleted', entry['sentences']['count'], None, 0)
+
+    finally:
+        if is_changed:
+            backend.bump_write_generation()
@@ -1,127 +1,264 @@
 import math
+import concurrent.futures
 
-from pymongo import ASCENDING, DESCENDING
-
-from trimco.settings import MONGODB_LIMIT
-from corpora.utils.db_utils import SENTENCE_COLLECTION
-from corpora.utils.format_utils import ANNOTATION_TAG_SEP
+from trimco.settings import MONGODB_LIMIT, SEARCH_CACHE_SIZE, SEARCH_COUNT_CAP, SEARCH_COUNT_WAIT
+from corpora.utils.manifest import get_entry, get_file_state, is_derived_with, is_up_to_date, set_part
 from .db_to_html import db_response_to_html, html_to_db
-from .elan_to_db import process_one_elan, insert_sentences_in_mongo
+from .elan_to_db import process_one_elan, process_one_annotation
+from .search_cache import QueryCache, normalize_query
+from .backends import get_search_backend
+from .reindex import get_sentences_params
+
+
+COUNT_CACHE = QueryCache(max_size=SEARCH_CACHE_SIZE)
+ANCHOR_CACHE = QueryCache(max_size=SEARCH_CACHE_SIZE)  # {page_num: {'min': key, 'max': key}} by query
+COUNT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+
+def get_result_count(query_key, query, generation):
+    """
+    returns future of (count, capped),
+    which is shared by all requests with the same query until sentences are changed
+    """
+    future = COUNT_CACHE.get(query_key, generation)
+    if future is None or (future.done() and future.exception() is not None):
+        future = COUNT_EXECUTOR.submit(get_search_backend().count, query, SEARCH_COUNT_CAP)
+        COUNT_CACHE.set(query_key, future, generation)
+    return future
+
+
+def wait_for_total_pages(count_future, timeout=None):
+    """
+    returns (total_pages, count_status),
+    count_status is 'exact', 'capped' or 'pending' if the count is not ready within timeout
+    """
+    try:
+        count, capped = count_future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        return None, 'pending'
+
+    return math.ceil(count / MONGODB_LIMIT), 'capped' if capped else 'exact'
 
 
-def compile_query(dialect, transcription, standartization, lemma, annotation):
-    query_parts = {}
+def get_sort_key(item):
+    return item['elan'], item['audio']['start'], item['tier'], item['_id']
 
-    if transcription:
-        query_parts['transcription'] = transcription.lower()
 
-    if standartization:
-        query_parts['standartization'] = standartization.lower()
+def page_info_to_key(key_info):
+    return (
+        key_info['elan'], key_info['audio_start'], key_info['tier'],
+        get_search_backend().parse_id(key_info['id'])
+    )
 
-    if annotation:
-        annotation = annotation.lower().replace(ANNOTATION_TAG_SEP, ' ')
-        ann_parts = annotation.split()
-        query_parts['annotation.tags'] = {'$all': ann_parts}
 
-    if lemma:
-        query_parts['annotation.lemma'] = lemma.lower()
+def get_client_anchor(prev_page_info, start_page, anchors):
+    """
+    {page_num: {'min': key, 'max': key}} of the previous page of the client if it is adjacent to start_page
+    and not known to the server, None otherwise. it is only used for the request of this client
+    """
+    if 'min' not in prev_page_info or 'max' not in prev_page_info:
+        return None
 
-    query = {'words': {'$elemMatch': query_parts}}
+    try:
+        page_num = int(prev_page_info['num'])
+        if abs(start_page - page_num) != 1 or page_num in anchors:
+            return None
+        anchor = {
+            'min': page_info_to_key(prev_page_info['min']),
+            'max': page_info_to_key(prev_page_info['max'])
+        }
+    except Exception:  # malformed page info is ignored
+        return None
 
-    if dialect and any(d for d in dialect):
-        query['dialect'] = {'$in': [int(d) for d in dialect]}
-    elif not query_parts:
+    # values are put into queries, so operators like {'$gt': ''} must not pass
+    for elan, audio_start, tier, _ in anchor.values():
+        if not (isinstance(elan, str) and isinstance(audio_start, int) and isinstance(tier, str)):
+            return None
+    return {page_num: anchor}
+
+
+def scan_page_anchors(query, anchors, from_page, from_key, after, n_pages):
+    """
+    walks over sort keys only, starting after the last key (or before the first key) of from_page,
+    records first and last keys of the n_pages passed in anchors.
+    returns the last key seen or None if results ended earlier
+    """
+    if not n_pages:
+        return from_key
+
+    direction = 1 if after else -1
+    results = get_search_backend().find_sentences(
+        query, from_key, after, limit=n_pages * MONGODB_LIMIT, keys_only=True
+    )
+
+    first, last = ('min', 'max') if after else ('max', 'min')
+    key = None
+    n_seen = 0
+    for n_seen, item in enumerate(results, 1):
+        key = get_sort_key(item)
+        page_num = from_page + direction * math.ceil(n_seen / MONGODB_LIMIT)
+        if (n_seen - 1) % MONGODB_LIMIT == 0:
+            anchors.setdefault(page_num, {})[first] = key
+        if n_seen % MONGODB_LIMIT == 0:
+            anchors.setdefault(page_num, {})[last] = key
+
+    if n_seen < n_pages * MONGODB_LIMIT:
         return
+    return key
+
+
+def find_page(query, page_num, anchors):
+    """
+    returns (results, reverse) for page_num using the nearest known page anchor:
+    sort keys between the anchor and the page are scanned through the index,
+    so no skip is ever needed.
+    all pages except the last one are full, which is why
+    the distance from an anchor is known in pages.
+    the scan reads only sort keys, but its length is still linear in the distance:
+    the first jump to page N of a query reads up to N * MONGODB_LIMIT keys,
+    like a skip would, only over the index instead of whole documents.
+    anchors of every page passed are cached for the write generation, so later jumps
+    near any of these pages read at most a few pages of keys
+    """
+    forward = [(page_num - 1, 0, None)]  # (pages to scan, anchor page, key)
+    forward += [
+        (page_num - 1 - k, k, info['max'])
+        for k, info in anchors.items() if k < page_num and 'max' in info
+    ]
+    backward = [
+        (k - page_num - 1, k, info['min'])
+        for k, info in anchors.items() if k > page_num and 'min' in info
+    ]
+    n_pages, from_page, from_key = min(forward, key=lambda x: x[0])
+    after = True
+
+    if backward:
+        n_pages_backward, from_page_backward, from_key_backward = min(backward, key=lambda x: x[0])
+        if n_pages_backward < n_pages:
+            n_pages, from_page, from_key, after = n_pages_backward, from_page_backward, from_key_backward, False
 
-    return query
+    key = scan_page_anchors(query, anchors, from_page, from_key, after, n_pages)
+    if n_pages and key is None:  # page_num is out of range
+        return [], False
+
+    return get_search_backend().find_sentences(query, key, after), not after
 
 
 def search(
         dialect, transcription, standartization, lemma, annotation,
         start_page, prev_page_info, total_pages=None
 ):
-    ascending_sort = [('elan', ASCENDING), ('audio.start', ASCENDING)]
-    descending_sort = [('elan', DESCENDING), ('audio.start', DESCENDING)]
-    query = compile_query(dialect, transcription, standartization, lemma, annotation)
+    backend = get_search_backend()
+    query_key = normalize_query(dialect, transcription, standartization, lemma, annotation)
+    generation = backend.get_write_generation()
+    query = backend.compile_query(dialect, transcription, standartization, lemma, annotation)
     results = None
     reverse = False
+    count_future = None
+    count_status = None
+    anchors = None
+    client_anchor = None
 
     if query is not None:
-        if 'max' in prev_page_info and start_page - prev_page_info['num'] == 1:  # next page
-            limit_query = {
-                '$or': [
-                    {
-                        'elan': {'$eq': prev_page_info['max']['elan']},
-                        'audio.start': {'$gt': prev_page_info['max']['audio_start']}
-                    },
-                    {
-                        'elan': {'$gt': prev_page_info['max']['elan']}
-                    }
-                ]
-            }
-            query = {'$and': [limit_query, query]}
-            results = SENTENCE_COLLECTION.find(query)
-            results = results.sort(ascending_sort)
-            results = results.limit(MONGODB_LIMIT)
-
-        elif 'min' in prev_page_info and start_page - prev_page_info['num'] == -1:  # prev page
-            limit_query = {
-                '$or': [
-                    {
-                        'elan': {'$eq': prev_page_info['min']['elan']},
-                        'audio.start': {'$lt': prev_page_info['min']['audio_start']}
-                    },
-                    {
-                        'elan': {'$lt': prev_page_info['min']['elan']}
-                    }
-                ]
-            }
-            query = {'$and': [limit_query, query]}
-            results = SENTENCE_COLLECTION.find(query)
-            results = results.sort(descending_sort)
-            results = results.limit(MONGODB_LIMIT)
-            reverse = True
+        is_last_page = total_pages is not None and start_page == int(total_pages)
+        if total_pages is None or is_last_page:
+            # counting runs concurrently with fetching and rendering the page
+            count_future = get_result_count(query_key, query, generation)
 
-        elif total_pages is not None and start_page == int(total_pages):  # last page
-            results = SENTENCE_COLLECTION.find(query)
-            n_last_page = results.count() % MONGODB_LIMIT or MONGODB_LIMIT
-            results = results.sort(descending_sort)
-            results = results.limit(n_last_page)
+        # anchors found by this request are added to a copy, which is cached when the page is ready
+        cached_anchors = ANCHOR_CACHE.get(query_key, generation) or {}
+        anchors = {page_num: dict(anchor) for page_num, anchor in cached_anchors.items()}
+        client_anchor = get_client_anchor(prev_page_info, start_page, anchors)
+        if client_anchor is not None:
+            anchors.update(client_anchor)
+
+        if is_last_page and not count_future.result()[1]:  # last page, count is not capped
+            n_last_page = count_future.result()[0] % MONGODB_LIMIT or MONGODB_LIMIT
+            results = backend.find_sentences(query, after=False, limit=n_last_page)
             reverse = True
 
         else:
-            results = SENTENCE_COLLECTION.find(query)
-            if start_page > 1:
-                results = results.skip((start_page-1) * MONGODB_LIMIT)
-            results = results.sort(ascending_sort)
-            results = results.limit(MONGODB_LIMIT)
-
-    if total_pages is None and results is not None:
-        total_pages = math.ceil(results.count() / MONGODB_LIMIT)
-    else:  # do not return total_pages value if we have it as input
-        total_pages = None
+            results, reverse = find_page(query, start_page, anchors)
 
     result_html, page_info = db_response_to_html(results, reverse=reverse)
     page_info['num'] = start_page
 
-    return result_html, page_info, total_pages
+    if anchors is not None and 'min' in page_info:
+        anchors[start_page] = {
+            'min': page_info_to_key(page_info['min']),
+            'max': page_info_to_key(page_info['max'])
+        }
+        # page numbers of keys sent by the client can not be verified, so nothing derived from them is shared
+        if client_anchor is None:
+            ANCHOR_CACHE.update(query_key, anchors, generation)
+
+    if total_pages is None and count_future is not None:
+        total_pages, count_status = wait_for_total_pages(count_future, timeout=SEARCH_COUNT_WAIT)
+    else:  # do not return total_pages value if we have it as input
+        total_pages = None
+
+    return result_html, page_info, total_pages, count_status
+
+
+def search_count(dialect, transcription, standartization, lemma, annotation):
+    """
+    returns (total_pages, count_status) for the query
+    whose count was still pending when its first page was returned
+    """
+    backend = get_search_backend()
+    query_key = normalize_query(dialect, transcription, standartization, lemma, annotation)
+    generation = backend.get_write_generation()
+
+    count_future = COUNT_CACHE.get(query_key, generation)
+    if count_future is None:
+        query = backend.compile_query(dialect, transcription, standartization, lemma, annotation)
+        if query is None:
+            return None, None
+        count_future = get_result_count(query_key, query, generation)
 
+    return wait_for_total_pages(count_future)
 
-def saved_recording_to_db(eaf_path, audio_path, dialect, html=None):
+
+def changed_annotations_to_db(eaf_filename, changed):
+    """
+    changed are (tier, start, end, transcript, standartization, annotation) of annotations saved to the elan
+    """
+    backend = get_search_backend()
+    n_changed = backend.update_sentences_words([
+        (eaf_filename, tier, start, end, process_one_annotation(transcript, standartization, annotation))
+        for tier, start, end, transcript, standartization, annotation in changed
+    ])
+    if n_changed:
+        backend.bump_write_generation()
+
+
+def saved_recording_to_db(eaf_path, audio_path, dialect, html=None, changed=None):
+    backend = get_search_backend()
     eaf_filename = eaf_path.rsplit('/', 1)[-1]
     audio_filename = audio_path.rsplit('/', 1)[-1]
 
-    query = {'elan': eaf_filename}
-    match = SENTENCE_COLLECTION.find_one(query)
+    entry = get_entry(eaf_filename, 'sentences')
+    state = get_file_state(eaf_path, entry)
+    params = get_sentences_params(backend, (eaf_filename, audio_filename, dialect))
+    match = backend.has_recording(eaf_filename)
 
-    if match is not None and html is not None:
-        html_to_db(html)  # update sentences that are pre-selected in html
+    if match and (html is not None or changed is not None):
+        # update only sentences that are pre-selected in html or changed in the editor, bumps write generation if they changed
+        if changed is not None:
+            changed_annotations_to_db(eaf_filename, changed)
+        else:
+            html_to_db(html)
+        if is_derived_with(entry, 'sentences', **params):  # sentences correspond to the saved file now
+            set_part(eaf_filename, 'sentences', state, count=entry['sentences']['count'], **params)
         return
 
-    ### inserting a whole recording
+    if match and is_up_to_date(entry, 'sentences', state, **params):
+        return  # nothing changed since the recording was indexed
 
-    if match is not None:
-        SENTENCE_COLLECTION.delete_many(query)
+    ### syncing a whole recording, only changed sentences are written
 
     sentences = process_one_elan(eaf_filename, audio_filename, dialect)
-    insert_sentences_in_mongo(sentences)
+    n_inserted, n_updated, n_deleted = backend.sync_recording(eaf_filename, sentences)
+    set_part(eaf_filename, 'sentences', state, count=len(sentences), **params)
+    if n_inserted or n_updated or n_deleted:
+        backend.bump_write_generation()
@@ -0,0 +1,78 @@
+"""
+Per-process caches of search data that depend on the whole sentence collection.
+
+Cached values are tagged with the write generation of the search backend.
+The generation is a counter stored next to sentences which is bumped by every write
+to them, so all processes drop their cached values after any change.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+from corpora.utils.format_utils import ANNOTATION_TAG_SEP
+
+
+def normalize_query(dialect, transcription, standartization, lemma, annotation):
+    ann_parts = []
+    if annotation:
+        ann_parts = sorted(set(annotation.lower().replace(ANNOTATION_TAG_SEP, ' ').split()))
+
+    return json.dumps([
+        sorted(int(d) for d in dialect if d) if dialect else [],
+        (transcription or '').lower(),
+        (standartization or '').lower(),
+        (lemma or '').lower(),
+        ann_parts
+    ])
+
+
+class QueryCache:
+    """
+    thread-safe LRU of values by normalized query,
+    which is emptied as soon as a newer write generation is seen
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.generation = None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            self.items.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self.lock:
+            self._check_generation(generation)
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation):
+        with self.lock:
+            self._check_generation(generation)
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def update(self, key, values, generation):
+        """
+        merges values into the dict cached by key. cached dicts are replaced, never changed in place,
+        so readers can use them without the lock
+        """
+        with self.lock:
+            self._check_generation(generation)
+            merged = dict(self.items.get(key) or {})
+            merged.update(values)
+            self.items[key] = merged
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.items.pop(key, None)
@@ -0,0 +1,82 @@
+"""
+Token-level inverted index over SENTENCE_COLLECTION.
+
+Every word of every sentence gets one compact posting in TOKEN_COLLECTION,
+so that search filters hit indexed scalar fields instead of
+scanning the embedded `words` arrays of all sentences.
+"""
+
+from corpora.utils.db_utils import SENTENCE_COLLECTION, TOKEN_COLLECTION
+
+
+def sentence_to_tokens(sentence):
+    tokens = []
+    for word in sentence['words']:
+        token = {
+            'sentence': sentence['_id'],
+            'elan': sentence['elan'],
+            'dialect': sentence['dialect'],
+            'audio_start': sentence['audio']['start'],
+            'tier': sentence['tier'],
+            'transcription': word['transcription']
+        }
+
+        standartization = word.get('standartization')
+        if standartization is not None:
+            token['standartization'] = standartization
+
+        ann = word.get('annotation')
+        if ann is not None:
+            token['lemma'] = ann['lemma']
+            token['tags'] = ann['tags']
+
+        tokens.append(token)
+
+    return tokens
+
+
+def index_sentences(sentences):
+    """
+    sentences should already have their `_id`,
+    which is the case after they are passed to insert_many
+    """
+    tokens = [token for sentence in sentences for token in sentence_to_tokens(sentence)]
+    if tokens:
+        TOKEN_COLLECTION.insert_many(tokens, ordered=False)
+
+
+def reindex_sentence(sentence):
+    TOKEN_COLLECTION.delete_many({'sentence': sentence['_id']})
+    index_sentences([sentence])
+
+
+def remove_sentences_from_index(sentence_ids):
+    if sentence_ids:
+        TOKEN_COLLECTION.delete_many({'sentence': {'$in': sentence_ids}})
+
+
+def remove_elan_from_index(elan):
+    TOKEN_COLLECTION.delete_many({'elan': elan})
+
+
+def count_sentences(token_query):
+    """
+    number of sentences with tokens matching token_query.
+    sentence ids are grouped by the server, so they are never loaded at once
+    """
+    pipeline = [{'$match': token_query}, {'$group': {'_id': '$sentence'}}, {'$count': 'count'}]
+    result = list(TOKEN_COLLECTION.aggregate(pipeline, allowDiskUse=True))
+    return result[0]['count'] if result else 0
+
+
+def rebuild_token_index(batch_size=1000):
+    TOKEN_COLLECTION.delete_many({})
+
+    batch = []
+    for sentence in SENTENCE_COLLECTION.find({}, ['words', 'elan', 'dialect', 'audio.start', 'tier']):
+        batch.append(sentence)
+        if len(batch) >= batch_size:
+            index_sentences(batch)
+            batch = []
+
+    index_sentences(batch)
@@ -1,3 +1,1532 @@
-from django.test import TestCase
+import os
+import sys
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+from pympi import Eaf, Elan
+
+from corpora.models import RecordingLock
+from corpora.search_engine import search_backend, reindex
+from corpora.search_engine.backends.base import diff_sentences
+from corpora.search_engine.backends.mongo import MongoSearchBackend, TokenQuery, TOKEN_SORT_FIELDS
+from corpora.search_engine.backends.sqlite import SQLiteSearchBackend
+from corpora.search_engine.search_backend import find_page
+from corpora.search_engine.db_to_html import db_response_to_html, sentence_to_html, html_to_db
+from corpora.search_engine.elan_to_db import get_sentence_hash, process_one_annotation
+from corpora.search_engine.search_cache import QueryCache, normalize_query
+from corpora.search_engine.token_index import sentence_to_tokens
+from corpora.utils import db_indexes
+from corpora.utils.format_utils import render_transcript
+from corpora.utils import word_list, standartizator, normalizer, jobs, reannotation, locks, editor_sessions, db_utils
+from corpora.utils.morph_cache import MorphCache
+from corpora.utils.elan_utils import ElanObject
+from corpora.utils.elan_to_html import ElanToHTML
+from corpora.utils.format_utils import ANNOTATION_WORD_SEP, ANNOTATION_PART_SEP
+from corpora.utils.annotation_menu import annotation_menu
+from corpora.utils.manifest import get_file_state, is_derived_with, is_up_to_date
+from scripts import benchmark_elan_index
+from scripts.benchmark_tag_ordering import TEST_CASES, legacy_override_abbreviations, make_synthetic_tags, quiet
+from scripts.benchmark_transcript_rendering import collect_inputs, legacy_render_transcript
+from trimco.settings import MEDIA_ROOT
+
+
+class FakeCursor:
+    """
+    documents in place of a pymongo cursor, counts how many of them were read
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.n_read = 0
+        self.closed = False
+        self.sort_spec = None
+
+    def sort(self, sort_spec):
+        self.sort_spec = sort_spec
+        return self
+
+    def __iter__(self):
+        for doc in self.docs:
+            self.n_read += 1
+            yield doc
+
+    def close(self):
+        self.closed = True
+
+
+def make_sentence(
+        start, _id=None, tier='tier_1_n_',
+        transcript='Ну вот', standartization='0:ну|1:вот', annotation='0:ну:PART|1:вот:ADV'
+):
+    sentence = {
+        'elan': 'a.eaf', 'dialect': 1, 'speaker': 'ivan petrov', 'tier': tier,
+        'audio': {'file': 'a.wav', 'start': start, 'end': start + 1000},
+        'words': process_one_annotation(transcript, standartization, annotation)
+    }
+    sentence['hash'] = get_sentence_hash(sentence)
+    if _id is not None:
+        sentence['_id'] = _id
+    return sentence
+
+
+def make_tokens(*keys):
+    return [dict(zip(TOKEN_SORT_FIELDS, key)) for key in keys]
+
+
+def make_eaf(path):
+    """
+    two speaker tiers with _standartization and _annotation tiers,
+    the last child annotation is shorter than its parent, as in files edited by hand
+    """
+    eaf = Eaf()
+    eaf.add_linguistic_type('stndz_clause')
+    eaf.add_linguistic_type('tokenz_and_annot')
+
+    for tier_name in ['tier_1_n_', 'tier_2_n_']:
+        eaf.add_tier(tier_name, part='speaker %s' % tier_name)
+        eaf.add_tier(tier_name + '_standartization', ling='stndz_clause', parent=tier_name)
+        eaf.add_tier(tier_name + '_annotation', ling='tokenz_and_annot', parent=tier_name)
+
+    annotations = [
+        ('tier_1_n_', 0, 1000, 'ну вот'),
+        ('tier_2_n_', 500, 1500, 'пошёл'),
+        ('tier_1_n_', 2000, 3000, 'туда и'),
+        ('tier_2_n_', 4000, 5000, 'корова'),
+    ]
+    for tier_name, start, end, transcript in annotations:
+        eaf.add_annotation(tier_name, start, end, transcript)
+    for tier_name, start, end, transcript in annotations[:3]:
+        words = transcript.split()
+        eaf.add_annotation(tier_name + '_standartization', start, end, ANNOTATION_WORD_SEP.join(
+            ANNOTATION_PART_SEP.join([str(i), word]) for i, word in enumerate(words)
+        ))
+        eaf.add_annotation(tier_name + '_annotation', start, end, ANNOTATION_WORD_SEP.join(
+            ANNOTATION_PART_SEP.join([str(i), word, 'NOUN-m-nom-sg']) for i, word in enumerate(words)
+        ))
+    eaf.add_annotation('tier_2_n__standartization', 4200, 4800, '0:корова')
+
+    Elan.to_eaf(path, eaf, pretty=True)
+    return annotations
+
+
+def legacy_get_value(eaf, tier_name, start, end):
+    # the lookup used before the annotation index
+    try:
+        annot_lst = eaf.get_annotation_data_at_time(tier_name, (start + end) / 2)
+    except KeyError:
+        return None
+    return annot_lst[0][-1] if annot_lst else None
+
+
+def get_child_tiers_data(eaf):
+    eaf.clean_time_slots()
+    return {
+        tier_name: sorted(eaf.get_annotation_data_for_tier(tier_name))
+        for tier_name in eaf.tiers if tier_name.endswith(('_standartization', '_annotation'))
+    }
+
+
+class TempDirTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, ignore_errors=True)
+
+
+class TokenQueryTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = MongoSearchBackend()
+
+    def test_word_filters_query_token_index(self):
+        query = self.backend.compile_query(['1', '3'], 'Вот', 'ВОТ', 'Вот', 'ADV-Pred')
+        self.assertEqual(query, TokenQuery({
+            'transcription': 'вот', 'standartization': 'вот', 'lemma': 'вот',
+            'tags': {'$all': ['adv', 'pred']}, 'dialect': {'$in': [1, 3]}
+        }))
+
+    def test_dialect_only_queries_sentences(self):
+        self.assertEqual(self.backend.compile_query(['2'], '', '', '', ''), {'dialect': {'$in': [2]}})
+
+    def test_empty_query(self):
+        self.assertIsNone(self.backend.compile_query([''], '', '', '', ''))
+        self.assertIsNone(self.backend.compile_query(None, '', '', '', ''))
+
+    def test_postings_have_sort_key_of_sentence(self):
+        sentence = {
+            '_id': 7, 'elan': 'a.eaf', 'dialect': 1, 'tier': 't', 'audio': {'start': 10, 'end': 20},
+            'words': [
+                {'transcription': 'ну'},
+                {'transcription': 'вот', 'standartization': 'вот', 'annotation': {'lemma': 'вот', 'tags': ['adv']}}
+            ]
+        }
+        key = {'sentence': 7, 'elan': 'a.eaf', 'dialect': 1, 'audio_start': 10, 'tier': 't'}
+        self.assertEqual(sentence_to_tokens(sentence), [
+            dict(key, transcription='ну'),
+            dict(key, transcription='вот', standartization='вот', lemma='вот', tags=['adv'])
+        ])
+
+    @mock.patch('corpora.search_engine.backends.mongo.TOKEN_COLLECTION')
+    def test_reading_tokens_stops_after_one_page(self, token_collection):
+        # two matching tokens in sentence 1, the last sentence is never reached
+        cursor = FakeCursor(make_tokens(
+            ('a.eaf', 0, 't', 1), ('a.eaf', 0, 't', 1), ('a.eaf', 0, 'u', 2), ('a.eaf', 5, 't', 3), ('b.eaf', 0, 't', 4)
+        ))
+        token_collection.find.return_value = cursor
+
+        keys = MongoSearchBackend.find_sentence_keys({'lemma': 'вот'}, limit=3)
+        self.assertEqual(keys, [('a.eaf', 0, 't', 1), ('a.eaf', 0, 'u', 2), ('a.eaf', 5, 't', 3)])
+        self.assertEqual(cursor.n_read, 4)
+        self.assertTrue(cursor.closed)
+        self.assertEqual(cursor.sort_spec, [(field, 1) for field in TOKEN_SORT_FIELDS])
+
+    @mock.patch('corpora.search_engine.backends.mongo.TOKEN_COLLECTION')
+    def test_tokens_before_the_key(self, token_collection):
+        cursor = FakeCursor([])
+        token_collection.find.return_value = cursor
+
+        MongoSearchBackend.find_sentence_keys({'lemma': 'вот'}, ('a.eaf', 10, 't', 5), after=False)
+        self.assertEqual(token_collection.find.call_args[0][0], {'$and': [
+            {'$or': [
+                {'elan': {'$lt': 'a.eaf'}},
+                {'elan': 'a.eaf', 'audio_start': {'$lt': 10}},
+                {'elan': 'a.eaf', 'audio_start': 10, 'tier': {'$lt': 't'}},
+                {'elan': 'a.eaf', 'audio_start': 10, 'tier': 't', 'sentence': {'$lt': 5}},
+            ]},
+            {'lemma': 'вот'}
+        ]})
+        self.assertEqual(cursor.sort_spec, [(field, -1) for field in TOKEN_SORT_FIELDS])
+
+
+class IndexRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.existing = {index.collection: {} for index in db_indexes.INDEXES}
+        for index in db_indexes.INDEXES[2:]:
+            self.existing[index.collection][index.name] = {'key': index.keys}
+
+        changed = db_indexes.INDEXES[1]
+        self.existing[changed.collection][changed.name] = {'key': changed.keys, 'unique': not changed.unique}
+        self.existing['words']['word_1'] = {'key': [('word', 1)]}
+
+        patcher = mock.patch.object(db_indexes, 'get_existing_indexes', side_effect=self.existing.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_diff(self):
+        missing, changed, undeclared = db_indexes.diff_indexes()
+        self.assertEqual(missing, db_indexes.INDEXES[:1])
+        self.assertEqual(changed, db_indexes.INDEXES[1:2])
+        self.assertEqual(undeclared, [('words', 'word_1')])
+
+    @mock.patch.object(db_indexes, 'MONGO_DB')
+    def test_changed_indexes_are_dropped_before_they_are_created(self, mongo_db):
+        created, replaced = db_indexes.create_indexes()
+        self.assertEqual(created, db_indexes.INDEXES[:2])
+        self.assertEqual(replaced, [])
+
+        changed = db_indexes.INDEXES[1]
+        collection = mongo_db[changed.collection]
+        self.assertEqual(collection.mock_calls[0], mock.call.drop_index(changed.name))
+        collection.create_index.assert_any_call(changed.keys, name=changed.name, unique=changed.unique)
+
+    @mock.patch.object(db_indexes, 'MONGO_DB')
+    def test_indexes_with_the_same_keys_are_replaced(self, mongo_db):
+        missing = db_indexes.INDEXES[0]
+        auto_name = '_'.join('%s_%s' % key for key in missing.keys)
+        self.existing[missing.collection][auto_name] = {'key': [list(key) for key in missing.keys]}
+
+        created, replaced = db_indexes.create_indexes()
+        self.assertEqual(replaced, [(missing, auto_name)])
+        calls = mongo_db[missing.collection].mock_calls
+        self.assertLess(
+            calls.index(mock.call.drop_index(auto_name)),
+            calls.index(mock.call.create_index(missing.keys, name=missing.name, unique=missing.unique))
+        )
+
+    def test_token_indexes_serve_the_page_sort(self):
+        token_sort = [(field, 1) for field in TOKEN_SORT_FIELDS]
+        for shape in db_indexes.QUERY_SHAPES:
+            if shape.collection == 'tokens' and shape.sort:
+                self.assertEqual(shape.sort, token_sort, shape.description)
+
+
+class SearchCountTests(SimpleTestCase):
+    @mock.patch('corpora.search_engine.backends.mongo.count_sentences')
+    @mock.patch('corpora.search_engine.backends.mongo.TOKEN_COLLECTION')
+    def test_capped_count_stops_reading_tokens(self, token_collection, count_sentences):
+        cursor = FakeCursor(make_tokens(*[('a.eaf', start, 't', start) for start in range(1000)]))
+        token_collection.find.return_value = cursor
+
+        self.assertEqual(MongoSearchBackend().count(TokenQuery({'lemma': 'вот'}), cap=5), (5, True))
+        self.assertEqual(cursor.n_read, 6)
+        count_sentences.assert_not_called()
+
+    @mock.patch('corpora.search_engine.backends.mongo.TOKEN_COLLECTION')
+    def test_count_under_the_cap_is_exact(self, token_collection):
+        token_collection.find.return_value = FakeCursor(make_tokens(('a.eaf', 0, 't', 1), ('a.eaf', 0, 't', 1)))
+        self.assertEqual(MongoSearchBackend().count(TokenQuery({'lemma': 'вот'}), cap=5), (1, False))
+
+    @mock.patch('corpora.search_engine.backends.mongo.SENTENCE_COLLECTION')
+    def test_capped_count_of_sentences(self, sentence_collection):
+        sentence_collection.count_documents.return_value = 6
+        self.assertEqual(MongoSearchBackend().count({'dialect': {'$in': [1]}}, cap=5), (5, True))
+        sentence_collection.count_documents.assert_called_once_with({'dialect': {'$in': [1]}}, limit=6)
+
+    def test_equivalent_queries_share_a_key(self):
+        self.assertEqual(
+            normalize_query(['2', '1', ''], 'Вот', '', None, 'PRED-adv'),
+            normalize_query(['1', '2'], 'вот', None, '', 'adv pred')
+        )
+        self.assertNotEqual(normalize_query(['1'], 'вот', '', '', ''), normalize_query(['1'], '', 'вот', '', ''))
+
+    def test_query_cache(self):
+        cache = QueryCache(max_size=2)
+        cache.set('a', 1, generation=0)
+        cache.set('b', 2, generation=0)
+        cache.get('a', generation=0)
+        cache.set('c', 3, generation=0)  # `b` is the least recently used
+        self.assertEqual([cache.get(key, generation=0) for key in 'abc'], [1, None, 3])
+
+        self.assertIsNone(cache.get('a', generation=1))
+        cache.set('a', 4, generation=1)
+        self.assertEqual(cache.get('a', generation=1), 4)
+
+
+class SortedSentencesBackend:
+    """
+    find_sentences over sort keys kept in memory
+    """
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.n_read = 0
+
+    def find_sentences(self, query, key=None, after=True, limit=None, keys_only=False):
+        keys = self.keys if after else self.keys[::-1]
+        if key is not None:
+            keys = [k for k in keys if (k > key if after else k < key)]
+        keys = keys[:limit or search_backend.MONGODB_LIMIT]
+        self.n_read += len(keys)
+        return [{'elan': elan, 'audio': {'start': start}, 'tier': tier, '_id': _id} for elan, start, tier, _id in keys]
+
+
+@mock.patch.object(search_backend, 'MONGODB_LIMIT', 3)
+class PageAnchorTests(SimpleTestCase):
+    def setUp(self):
+        # sentences of two tiers start at the same time
+        self.keys = sorted(('a.eaf', start // 2 * 10, 't%d' % (start % 2), start) for start in range(11))
+        self.sentences = SortedSentencesBackend(self.keys)
+
+        patcher = mock.patch.object(search_backend, 'get_search_backend', return_value=self.sentences)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_page(self, page_num, anchors):
+        results, reverse = find_page({}, page_num, anchors)
+        keys = [search_backend.get_sort_key(item) for item in results]
+        return keys[::-1] if reverse else keys
+
+    def test_cold_jump_records_anchors_of_the_pages_passed(self):
+        anchors = {}
+        self.assertEqual(self.get_page(3, anchors), self.keys[6:9])
+        self.assertEqual(anchors, {
+            1: {'min': self.keys[0], 'max': self.keys[2]},
+            2: {'min': self.keys[3], 'max': self.keys[5]}
+        })
+
+    def test_pages_are_read_from_the_nearest_anchor(self):
+        anchors = {3: {'min': self.keys[6], 'max': self.keys[8]}}
+
+        self.assertEqual(self.get_page(4, anchors), self.keys[9:])
+        self.assertEqual(self.get_page(2, anchors), self.keys[3:6])
+        self.assertEqual(self.sentences.n_read, 5)
+
+    def test_page_out_of_range(self):
+        self.assertEqual(self.get_page(6, {}), [])
+
+
+class SQLitePaginationTests(TempDirTestCase):
+    """
+    search() over SQLiteSearchBackend, with MONGODB_LIMIT (100) sentences per page
+    """
+    def setUp(self):
+        super().setUp()
+        # 350 sentences in 3 pages and a half, three tiers start at the same time
+        self.backend = SQLiteSearchBackend(os.path.join(self.tmp_dir, 'search.sqlite3'))
+        self.backend.insert_sentences([
+            dict(make_sentence((i // 3) * 1000, tier='tier_%d_n_' % (i % 3)), elan='ab'[i // 200] + '.eaf')
+            for i in range(350)
+        ])
+        query = self.backend.compile_query([''], '', '', 'вот', '')
+        keys = [search_backend.get_sort_key(item) for item in self.backend.find_sentences(query, limit=1000)]
+        self.pages = [keys[i:i + 100] for i in range(0, len(keys), 100)]
+
+        patchers = [
+            mock.patch.object(search_backend, 'get_search_backend', return_value=self.backend),
+            mock.patch('corpora.search_engine.db_to_html.get_search_backend', return_value=self.backend),
+            mock.patch.object(search_backend, 'ANCHOR_CACHE', QueryCache(max_size=10)),
+            mock.patch.object(search_backend, 'COUNT_CACHE', QueryCache(max_size=10)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def search(self, page_num, prev_page_info=None, total_pages=None):
+        html, page_info, total_pages, count_status = search_backend.search(
+            [''], '', '', 'вот', '', page_num, prev_page_info or {}, total_pages
+        )
+        return page_info, html.count('annot_wrapper'), total_pages, count_status
+
+    def assertPage(self, page_info, page_num):
+        page = self.pages[page_num - 1]
+        self.assertEqual(page_info['num'], page_num)
+        self.assertEqual(
+            (search_backend.page_info_to_key(page_info['min']), search_backend.page_info_to_key(page_info['max'])),
+            (page[0], page[-1])
+        )
+
+    def get_cached_anchors(self):
+        return search_backend.ANCHOR_CACHE.get(
+            normalize_query([''], '', '', 'вот', ''), self.backend.get_write_generation()
+        ) or {}
+
+    def test_cold_jump(self):
+        page_info, n_results, total_pages, count_status = self.search(3)
+        self.assertPage(page_info, 3)
+        self.assertEqual((n_results, total_pages, count_status), (100, 4, 'exact'))
+        self.assertEqual(sorted(self.get_cached_anchors()), [1, 2, 3])
+
+    def test_walks_with_pages_of_the_client(self):
+        page_info, _, _, _ = self.search(1)
+        for page_num in [2, 3, 4, 3, 2, 1]:
+            search_backend.ANCHOR_CACHE.items.clear()  # as if the previous page was served by another process
+            with mock.patch.object(self.backend, 'find_sentences', wraps=self.backend.find_sentences) as find:
+                page_info, _, _, _ = self.search(page_num, page_info, total_pages=5)
+            self.assertPage(page_info, page_num)
+            # the page is read right after the anchor of the client, without scanning
+            self.assertEqual([call[1].get('keys_only', False) for call in find.call_args_list], [False])
+
+    def test_client_anchor_is_not_shared(self):
+        page_info, _, _, _ = self.search(1)
+        page_info = dict(page_info, num=2)  # page 1 sent as page 2
+        search_backend.ANCHOR_CACHE.items.clear()
+
+        self.search(3, page_info, total_pages=4)
+        self.assertEqual(self.get_cached_anchors(), {})
+
+        self.assertPage(self.search(3, total_pages=4)[0], 3)
+
+    def test_malformed_client_anchor_is_ignored(self):
+        page_info, _, _, _ = self.search(2)
+        search_backend.ANCHOR_CACHE.items.clear()
+        page_info['min'] = dict(page_info['min'], elan={'$gt': ''})
+
+        self.assertPage(self.search(3, page_info, total_pages=4)[0], 3)
+        self.assertEqual(sorted(self.get_cached_anchors()), [1, 2, 3])
+
+    def test_last_partial_page(self):
+        page_info, n_results, total_pages, _ = self.search(4, total_pages=4)
+        self.assertPage(page_info, 4)
+        self.assertEqual((n_results, total_pages), (50, None))
+        self.assertEqual(self.search(5)[1], 0)
+
+
+class StoredFragmentTests(SimpleTestCase):
+    @mock.patch('corpora.search_engine.db_to_html.get_search_backend')
+    def test_stored_fragments_are_joined_and_missing_ones_backfilled(self, get_search_backend):
+        stored = dict(make_sentence(0, 1), html='<div class="annot_wrapper">stored</div>')
+        legacy = make_sentence(1000, 2)
+
+        html, page_info = db_response_to_html([legacy, stored], reverse=True)
+        self.assertEqual(html, stored['html'] + sentence_to_html(legacy))
+        self.assertEqual((page_info['min']['id'], page_info['max']['id']), ('1', '2'))
+        get_search_backend.return_value.store_html.assert_called_once_with({2: sentence_to_html(legacy)})
+
+    @mock.patch('corpora.search_engine.db_to_html.get_search_backend')
+    def test_nothing_is_backfilled_when_all_fragments_are_stored(self, get_search_backend):
+        db_response_to_html([dict(make_sentence(0, 1), html='<div></div>')])
+        get_search_backend.return_value.store_html.assert_not_called()
+
+
+class HtmlToDbTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = SQLiteSearchBackend(':memory:')
+        self.sentences = [make_sentence(0), make_sentence(1000)]
+        self.backend.insert_sentences(self.sentences)
+
+        patcher = mock.patch('corpora.search_engine.db_to_html.get_search_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_changed_sentences_are_updated_in_one_batch(self):
+        edited = make_sentence(1000, transcript='Ну тут', standartization='0:ну|1:тут', annotation='0:ну:PART|1:тут:ADV')
+        html = sentence_to_html(edited).replace('annot_wrapper', 'annot_wrapper changed', 1)
+
+        with mock.patch.object(self.backend, 'update_sentences_words', wraps=self.backend.update_sentences_words) as update:
+            html_to_db('<div>%s%s</div>' % (sentence_to_html(self.sentences[0]), html))
+        self.assertEqual([len(call[0][0]) for call in update.call_args_list], [1])
+
+        query = self.backend.compile_query([''], '', 'тут', '', '')
+        self.assertEqual([sentence['audio']['start'] for sentence in self.backend.find_sentences(query)], [1000])
+        self.assertEqual(self.backend.get_write_generation(), 1)
+
+    def test_unchanged_sentences_keep_the_write_generation(self):
+        html = sentence_to_html(self.sentences[1]).replace('annot_wrapper', 'annot_wrapper changed', 1)
+        html_to_db('<div>%s</div>' % html)
+        self.assertEqual(self.backend.get_write_generation(), 0)
+
+
+class SaveHtmlExtractsTests(SimpleTestCase):
+    @mock.patch('corpora.utils.elan_to_html.recording_locks')
+    @mock.patch('corpora.utils.elan_to_html.save_html_extracts_to_elan')
+    def test_every_elan_is_saved_once(self, save_html_extracts_to_elan, recording_locks):
+        sentences = [make_sentence(0), dict(make_sentence(0), elan='b.eaf'), make_sentence(1000), make_sentence(2000)]
+        html = ''.join(sentence_to_html(sentence) for sentence in sentences)
+        html = html.replace('annot_wrapper', 'annot_wrapper changed', 3)
+
+        ElanToHTML.save_html_extracts_to_elans('<div>%s</div>' % html, owner='editor')
+        recording_locks.assert_called_once_with(mock.ANY, owner='editor')
+        self.assertEqual(sorted(recording_locks.call_args[0][0]), ['a.eaf', 'b.eaf'])
+        self.assertEqual(
+            [(call[0][0], len(call[0][1])) for call in save_html_extracts_to_elan.call_args_list],
+            [('a.eaf', 2), ('b.eaf', 1)]
+        )
+
+
+class RenderTranscriptTests(SimpleTestCase):
+    def assertRendersAsLegacy(self, transcript, normz_tokens_dict, annot_tokens_dict):
+        self.assertEqual(
+            render_transcript(transcript, normz_tokens_dict, annot_tokens_dict),
+            legacy_render_transcript(transcript, normz_tokens_dict, annot_tokens_dict),
+            transcript
+        )
+
+    def test_special_tokens(self):
+        normz = {0: ['ну'], 2: ['так']}
+        annot = {0: ['ну', 'PART'], 1: ['что', 'PRON'], 3: ['вот', 'ADV']}
+        for transcript in [
+            'ну что? ... таг [unint.] [laugh] [смех] вот! ',
+            'ну [unint] что ? да',
+            'a[b]c[noise.]',
+        ]:
+            self.assertRendersAsLegacy(transcript, normz, annot)
+            self.assertRendersAsLegacy(transcript, normz, {})
+
+    def test_annotations_of_sample_recording(self):
+        inputs = collect_inputs(os.path.join(MEDIA_ROOT, 'MP-BRAR-03-01-01.eaf'))
+        self.assertTrue(inputs)
+        for item in inputs:
+            self.assertRendersAsLegacy(*item)
+
+
+class SQLiteSearchBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.backend = SQLiteSearchBackend(':memory:')
+        self.sentences = [
+            make_sentence(0),
+            make_sentence(0, tier='tier_2_n_'),
+            make_sentence(1000, transcript='Пошёл туда', standartization='0:пошёл|1:туда',
+                          annotation='0:пойти:V-pst|1:туда:ADV-PRO'),
+        ]
+        self.backend.insert_sentences(self.sentences)
+
+    def find_keys(self, query, **kwargs):
+        return [
+            (sentence['elan'], sentence['audio']['start'], sentence['tier'], sentence['_id'])
+            for sentence in self.backend.find_sentences(query, **kwargs)
+        ]
+
+    def test_word_queries(self):
+        compile_query = self.backend.compile_query
+        self.assertEqual(self.backend.count(compile_query(['1'], '', '', 'Вот', '')), (2, False))
+        self.assertEqual(self.backend.count(compile_query(['2'], '', '', 'вот', '')), (0, False))
+        self.assertEqual(self.backend.count(compile_query([''], '', '', '', 'ADV')), (3, False))
+        self.assertEqual(self.backend.count(compile_query([''], '', '', '', 'pro-adv')), (1, False))
+        self.assertEqual(self.backend.count(compile_query([''], 'туда', 'туда', 'туда', 'pro')), (1, False))
+        self.assertEqual(self.backend.count(compile_query([''], '', '', '', 'ADV'), cap=2), (2, True))
+        self.assertIsNone(compile_query([''], '', '', '', ''))
+
+    def test_sentences_are_read_from_the_key(self):
+        query = self.backend.compile_query(['1'], '', '', '', 'adv')
+        keys = sorted(
+            ('a.eaf', sentence['audio']['start'], sentence['tier'], sentence['_id']) for sentence in self.sentences
+        )
+
+        self.assertEqual(self.find_keys(query), keys)
+        self.assertEqual(self.find_keys(query, key=keys[0], limit=1), keys[1:2])
+        self.assertEqual(self.find_keys(query, key=keys[2], after=False), keys[1::-1])
+        self.assertEqual(self.find_keys(query, key=keys[0], keys_only=True), keys[1:])
+
+        sentence = self.backend.find_sentences(query, limit=1)[0]
+        self.assertEqual(sentence['words'], self.sentences[0]['words'])
+
+    def test_tokens_follow_updated_words(self):
+        tier = self.sentences[2]['tier']
+        updates = [
+            ('a.eaf', tier, 1000, 2000, process_one_annotation('Ну', '0:ну', '0:ну:PART')),
+            ('a.eaf', tier, 1000, 2001, []),
+        ]
+        self.assertEqual(self.backend.update_sentences_words(updates), 1)
+        self.assertEqual(self.backend.update_sentences_words(updates), 0)  # words are the same now
+
+        self.assertEqual(self.backend.count(self.backend.compile_query([''], '', '', 'пойти', '')), (0, False))
+        self.assertEqual(self.backend.count(self.backend.compile_query([''], '', '', 'ну', '')), (3, False))
+
+    def test_sync_recording(self):
+        changed = make_sentence(1000, transcript='Ну', standartization='0:ну', annotation='0:ну:PART')
+        added = make_sentence(2000)
+        sentences = [make_sentence(0), changed, added]
+
+        self.assertEqual(self.backend.sync_recording('a.eaf', sentences), (1, 1, 1))
+        self.assertEqual(self.backend.sync_recording('a.eaf', sentences), (0, 0, 0))
+        self.assertEqual(
+            [(key[1], key[2]) for key in self.find_keys(self.backend.compile_query([''], '', '', 'ну', ''))],
+            [(0, 'tier_1_n_'), (1000, 'tier_1_n_'), (2000, 'tier_1_n_')]
+        )
+        self.assertEqual(self.backend.count(self.backend.compile_query([''], '', '', 'пойти', '')), (0, False))
+
+    def test_write_generation(self):
+        self.assertEqual(self.backend.get_write_generation(), 0)
+        self.backend.bump_write_generation()
+        self.backend.bump_write_generation()
+        self.assertEqual(self.backend.get_write_generation(), 2)
+
+
+class ReindexTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = SQLiteSearchBackend(':memory:')
+        self.sentences = {}
+        self.iter_parsed_recordings = reindex.iter_parsed_recordings
+
+        patchers = [
+            mock.patch.object(reindex, 'get_search_backend', return_value=self.backend),
+            mock.patch.object(reindex, 'MEDIA_ROOT', self.tmp_dir),
+            mock.patch.object(reindex, 'iter_parsed_recordings', side_effect=self.parse_recordings),
+            # the manifest of sentences is kept by the backend
+            mock.patch('corpora.search_engine.backends.get_search_backend', return_value=self.backend),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def parse_recordings(self, recordings, workers):
+        for recording, state in recordings:
+            sentences = self.sentences.get(recording[0])
+            if sentences is None:
+                yield reindex.ParsedRecording(recording, state, [], 'IOError()', 0.1)
+            else:
+                yield reindex.ParsedRecording(recording, state, [dict(s) for s in sentences], None, 0.1)
+
+    def add_recording(self, elan, n_sentences, contents='a'):
+        with open(os.path.join(self.tmp_dir, elan), 'w') as f:
+            f.write(contents)
+        if n_sentences is not None:
+            self.sentences[elan] = [dict(make_sentence(start), elan=elan) for start in range(0, n_sentences * 1000, 1000)]
+        return elan, 'a.wav', 1
+
+    def reindex(self, recordings, **kwargs):
+        return [
+            (report.elan, report.status, report.n_sentences) if isinstance(report, reindex.RecordingReport) else report
+            for report in reindex.reindex_recordings(recordings, workers=1, **kwargs)
+        ]
+
+    def count_sentences(self, elan):
+        return self.backend.connection.execute('SELECT COUNT(*) FROM sentences WHERE elan = ?', [elan]).fetchone()[0]
+
+    def test_only_changed_recordings_are_reindexed(self):
+        recordings = [self.add_recording('a.eaf', 3), self.add_recording('b.eaf', 5)]
+        self.assertEqual(self.reindex(recordings, batch_size=2), [('a.eaf', 'indexed', 3), ('b.eaf', 'indexed', 5)])
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'unchanged', 3), ('b.eaf', 'unchanged', 5)])
+        self.assertEqual(self.backend.get_write_generation(), 1)
+
+        recordings = [self.add_recording('a.eaf', 2, contents='ab')]
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'indexed', 2), ('b.eaf', 'deleted', 5)])
+        self.assertEqual((self.count_sentences('a.eaf'), self.count_sentences('b.eaf')), (2, 0))
+        self.assertEqual(list(self.backend.get_manifest().get_all('sentences')), ['a.eaf'])
+
+    def test_failed_recordings_are_not_recorded(self):
+        recordings = [self.add_recording('a.eaf', None), ('missing.eaf', 'a.wav', 1)]
+        reports = self.reindex(recordings)
+        self.assertEqual([report[:2] for report in reports], [('a.eaf', 'failed'), ('missing.eaf', 'failed')])
+        self.assertEqual(self.backend.get_manifest().get_all('sentences'), {})
+
+    def test_failed_batch_is_reindexed_next_time(self):
+        recordings = [self.add_recording('a.eaf', 1)]
+        with mock.patch.object(self.backend, 'insert_sentences', side_effect=ValueError('x')):
+            reports = self.reindex(recordings)
+        self.assertEqual(reports[-1], reindex.BatchError(['a.eaf'], repr(ValueError('x'))))
+
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'indexed', 1)])
+        self.assertEqual(self.count_sentences('a.eaf'), 1)
+
+    def test_recording_is_recorded_after_all_its_batches_are_written(self):
+        recordings = [self.add_recording('a.eaf', 2), self.add_recording('b.eaf', 3)]
+        insert_sentences = self.backend.insert_sentences
+        calls = []
+
+        def fail_last_batch(sentences):
+            calls.append(len(sentences))
+            if len(calls) == 3:
+                raise ValueError('x')
+            insert_sentences(sentences)
+
+        with mock.patch.object(self.backend, 'insert_sentences', side_effect=fail_last_batch):
+            reports = self.reindex(recordings, batch_size=2)
+        self.assertEqual(calls, [2, 2, 1])
+        self.assertEqual(reports[-1], reindex.BatchError(['b.eaf'], repr(ValueError('x'))))
+        self.assertEqual(list(self.backend.get_manifest().get_all('sentences')), ['a.eaf'])
+
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'unchanged', 2), ('b.eaf', 'indexed', 3)])
+        self.assertEqual(self.count_sentences('b.eaf'), 3)
+
+    def test_indexed_recordings_are_synced(self):
+        recordings = [self.add_recording('a.eaf', 3)]
+        self.reindex(recordings)
+        ids = [row[0] for row in self.backend.connection.execute('SELECT id FROM sentences ORDER BY audio_start')]
+
+        # the file changed, its sentences did not
+        recordings = [self.add_recording('a.eaf', 3, contents='ab')]
+        with mock.patch.object(self.backend, 'delete_recording') as delete_recording:
+            self.assertEqual(self.reindex(recordings), [('a.eaf', 'indexed', 3)])
+        delete_recording.assert_not_called()
+        self.assertEqual(self.backend.get_write_generation(), 1)
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'unchanged', 3)])
+
+        recordings = [self.add_recording('a.eaf', 2, contents='abc')]
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'indexed', 2)])
+        self.assertEqual(
+            [row[0] for row in self.backend.connection.execute('SELECT id FROM sentences ORDER BY audio_start')],
+            ids[:2]
+        )
+        self.assertEqual(self.backend.get_write_generation(), 2)
+
+    def test_failed_sync_is_reindexed_next_time(self):
+        self.reindex([self.add_recording('a.eaf', 1)])
+        recordings = [self.add_recording('a.eaf', 2, contents='ab')]
+        with mock.patch.object(self.backend, 'sync_recording', side_effect=ValueError('x')):
+            reports = self.reindex(recordings)
+        self.assertEqual(reports, [('a.eaf', 'failed', 0)])
+        self.assertEqual(self.backend.get_manifest().get_all('sentences'), {})
+
+        self.assertEqual(self.reindex(recordings), [('a.eaf', 'indexed', 2)])
+        self.assertEqual(self.count_sentences('a.eaf'), 2)
+
+    def test_clear(self):
+        self.backend.insert_sentences([dict(make_sentence(0), elan='c.eaf')])
+        recordings = [self.add_recording('a.eaf', 1)]
+        self.reindex(recordings)
+
+        self.assertEqual(self.reindex(recordings, clear=True), [('a.eaf', 'indexed', 1)])
+        self.assertEqual((self.count_sentences('a.eaf'), self.count_sentences('c.eaf')), (1, 0))
+
+    def test_parsing_errors_are_returned_by_workers(self):
+        recording = ('missing.eaf', 'missing.wav', 1)
+        parsed = list(self.iter_parsed_recordings([(recording, {})], workers=1))
+        self.assertEqual([(item.recording, item.sentences) for item in parsed], [(recording, [])])
+        self.assertIsNotNone(parsed[0].error)
+
+
+class DiffSentencesTests(SimpleTestCase):
+    @staticmethod
+    def sentence(tier, start, sentence_hash, _id=None):
+        sentence = {'tier': tier, 'audio': {'start': start, 'end': start + 100}, 'hash': sentence_hash}
+        if _id is not None:
+            sentence['_id'] = _id
+        return sentence
+
+    def test_only_changed_sentences_are_written(self):
+        stored = [self.sentence('t', 0, 'a', 1), self.sentence('t', 100, 'b', 2), self.sentence('t', 200, 'c', 3)]
+        sentences = [self.sentence('t', 0, 'a'), self.sentence('t', 100, 'x'), self.sentence('u', 0, 'd')]
+
+        inserted, updated, deleted = diff_sentences(stored, sentences)
+        self.assertEqual(inserted, [sentences[2]])
+        self.assertEqual(updated, [(2, sentences[1])])
+        self.assertEqual(deleted, [3])
+
+    def test_sentences_with_the_same_key_are_matched_in_order_of_ids(self):
+        stored = [self.sentence('t', 0, 'b', 5), self.sentence('t', 0, 'a', 4)]
+        sentences = [self.sentence('t', 0, 'a')]
+
+        inserted, updated, deleted = diff_sentences(stored, sentences)
+        self.assertEqual((inserted, updated, deleted), ([], [], [5]))
+
+
+class ManifestTests(TempDirTestCase):
+    def test_up_to_date(self):
+        entry = {'_id': 'a.eaf', 'hash': 'h1', 'sentences': {'hash': 'h1', 'backend': 'mongo', 'dialect': 1}}
+
+        self.assertTrue(is_derived_with(entry, 'sentences', backend='mongo', dialect=1))
+        self.assertFalse(is_derived_with(entry, 'sentences', backend='sqlite', dialect=1))
+        self.assertFalse(is_derived_with(entry, 'words', model='m'))
+        self.assertFalse(is_derived_with(None, 'sentences'))
+
+        self.assertTrue(is_up_to_date(entry, 'sentences', {'hash': 'h1'}, backend='mongo', dialect=1))
+        self.assertFalse(is_up_to_date(entry, 'sentences', {'hash': 'h2'}, backend='mongo', dialect=1))
+        self.assertFalse(is_up_to_date(entry, 'sentences', {'hash': 'h1'}, backend='mongo', dialect=2))
+
+    def test_sqlite_manifest(self):
+        manifest = SQLiteSearchBackend(os.path.join(self.tmp_dir, 'search.sqlite3')).get_manifest()
+        state = {'path': 'a.eaf', 'size': 1, 'mtime': 1.0, 'hash': 'h1'}
+
+        manifest.set_part('a.eaf', 'sentences', state, {'hash': 'h1', 'count': 3})
+        self.assertEqual(manifest.get('a.eaf'), dict(state, _id='a.eaf', sentences={'hash': 'h1', 'count': 3}))
+        self.assertEqual(list(manifest.get_all('sentences')), ['a.eaf'])
+        self.assertEqual(manifest.get_all('words'), {})
+
+        manifest.unset_part('a.eaf', 'sentences')
+        self.assertIsNone(manifest.get('a.eaf'))
+
+    def test_file_is_hashed_only_if_its_stat_changed(self):
+        path = os.path.join(self.tmp_dir, 'a.eaf')
+        with open(path, 'w') as f:
+            f.write('a')
+
+        state = get_file_state(path)
+        self.assertEqual(get_file_state(path, dict(state, hash='cached'))['hash'], 'cached')
+
+        with open(path, 'w') as f:
+            f.write('ab')
+        self.assertNotEqual(get_file_state(path, dict(state, hash='cached'))['hash'], 'cached')
+
+
+class WordListWriteTests(SimpleTestCase):
+    def test_requests_are_written_in_batches(self):
+        collection = mock.Mock()
+        n_ops = word_list.bulk_write_in_batches(collection, iter(range(5)), batch_size=2)
+        self.assertEqual(n_ops, 5)
+        self.assertEqual(
+            [call[0][0] for call in collection.bulk_write.call_args_list], [[0, 1], [2, 3], [4]]
+        )
+
+
+class WordListCountsTests(SimpleTestCase):
+    def test_keys_are_encoded_reversibly(self):
+        for value in ['a.b', '$a', '%2E.', 'вот:ADV']:
+            key = word_list.encode_key(value)
+            self.assertNotIn('.', key)
+            self.assertFalse(key.startswith('$'))
+            self.assertEqual(word_list.decode_key(key), value)
+
+    def test_increment_request(self):
+        self.assertEqual(word_list.increment_request('вот', 'm', [['a.b', 2], ['c', -1]]), word_list.UpdateOne(
+            {'model': 'm', 'word': 'вот'}, {'$inc': {'counts.a%2Eb': 2, 'counts.c': -1, 'total': 1}}, upsert=True
+        ))
+
+    def test_top(self):
+        self.assertEqual(word_list.get_top({'a': 1, 'b%2E': 3, 'c': 2}, top_k=2), [['b.', 3], ['c', 2]])
+        self.assertEqual(word_list.update_top([['b', 3], ['c', 2]], 'a', 4, top_k=2), [['a', 4], ['b', 3]])
+        self.assertEqual(word_list.update_top([['b', 3], ['c', 2]], 'c', 5, top_k=2), [['c', 5], ['b', 3]])
+        self.assertEqual(word_list.update_top([['b', 3], ['c', 2]], 'a', 1, top_k=2), [['b', 3], ['c', 2]])
+
+    def test_retracted_values_are_decremented(self):
+        collection = mock.Mock()
+        collection.find.return_value = []
+        items = [{'model': 'm', 'word': 'вот', 'counts': [['a', 2]]}]
+
+        self.assertEqual(word_list.increment_in_mongo(collection, items, sign=-1), 1)
+        collection.bulk_write.assert_called_once_with(
+            [word_list.increment_request('вот', 'm', [['a', -2]])], ordered=False
+        )
+
+    def test_refresh_top_requests(self):
+        collection = mock.Mock()
+        collection.find.return_value = [
+            {'_id': 1, 'counts': {'a': 2, 'b': 0}, 'top': [['b', 1], ['a', 1]], 'total': 2},
+            {'_id': 2, 'counts': {'c': 0}, 'total': 0},
+            {'_id': 3, 'counts': {'c': 1}, 'top': [['c', 1]], 'total': 1},  # top is up to date
+        ]
+
+        requests = list(word_list.iter_refresh_top_requests(collection, [('m', 'вот'), ('m', 'ну'), ('m', 'да')]))
+        self.assertEqual(requests, [
+            word_list.UpdateOne(
+                {'_id': 1, 'top': [['b', 1], ['a', 1]], 'total': 2},
+                {'$set': {'top': [['a', 2]]}, '$unset': {'counts.b': True}}
+            ),
+            word_list.DeleteOne({'_id': 2, 'top': None, 'total': 0}),
+        ])
+
+    def test_top_refreshed_concurrently_is_read_again(self):
+        collection = mock.Mock()
+        collection.find.side_effect = [
+            [{'_id': 1, 'counts': {'a': 2}, 'top': [['a', 1]], 'total': 1}],
+            # another request incremented `b` between the read and the update
+            [{'_id': 1, 'counts': {'a': 2, 'b': 3}, 'top': [['a', 1]], 'total': 4}],
+        ]
+        collection.bulk_write.side_effect = [
+            mock.Mock(matched_count=0, deleted_count=0), mock.Mock(matched_count=1, deleted_count=0)
+        ]
+
+        self.assertEqual(word_list.refresh_top(collection, [('m', 'вот')]), 2)
+        self.assertEqual([call[0][0] for call in collection.bulk_write.call_args_list], [
+            [word_list.UpdateOne({'_id': 1, 'top': [['a', 1]], 'total': 1}, {'$set': {'top': [['a', 2]]}})],
+            [word_list.UpdateOne({'_id': 1, 'top': [['a', 1]], 'total': 4}, {'$set': {'top': [['b', 3], ['a', 2]]}})],
+        ])
+
+    def test_refresh_top_gives_up(self):
+        collection = mock.Mock()
+        collection.find.return_value = [{'_id': 1, 'counts': {'a': 2}, 'top': [['a', 1]], 'total': 1}]
+        collection.bulk_write.return_value = mock.Mock(matched_count=0, deleted_count=0)
+
+        self.assertEqual(word_list.refresh_top(collection, [('m', 'вот')], attempts=3), 3)
+
+    def test_duplicate_words_are_merged(self):
+        collection = mock.Mock()
+        collection.aggregate.return_value = [{'_id': {'model': 'm', 'word': 'вот'}, 'ids': [2, 1], 'n': 2}]
+        collection.find.return_value = [
+            {'_id': 2, 'counts': {'a': 1, 'b': 2}},
+            {'_id': 1, 'annotations': [['вот', 'ADV'], 'a.b']},  # old format
+        ]
+
+        requests = list(word_list.iter_merge_duplicates_requests(collection, 'annotations'))
+        self.assertEqual(requests, [
+            word_list.UpdateOne({'_id': 1}, {
+                '$set': {
+                    'counts': {'вот:ADV': 1, 'a%2Eb': 1, 'a': 1, 'b': 2}, 'total': 5,
+                    'top': [['b', 2], ['вот:ADV', 1], ['a.b', 1], ['a', 1]]
+                },
+                '$unset': {'annotations': True}
+            }),
+            word_list.DeleteOne({'_id': 2}),
+        ])
+
+    def test_top_changed_concurrently_is_merged(self):
+        collection = mock.Mock()
+        collection.find_one_and_update.return_value = {'_id': 1, 'counts': {'a': 2}, 'top': [['a', 1]]}
+        # another request added `b` between the increment and the update of top
+        collection.find_one.return_value = {'_id': 1, 'counts': {'a': 2}, 'top': [['b', 5], ['a', 1]]}
+        collection.update_one.side_effect = [mock.Mock(matched_count=0), mock.Mock(matched_count=1)]
+
+        word_list.increment_one_value(collection, 'вот', 'm', 'a')
+        self.assertEqual(collection.update_one.call_args_list, [
+            mock.call({'_id': 1, 'top': [['a', 1]]}, {'$set': {'top': [['a', 2]]}}),
+            mock.call({'_id': 1, 'top': [['b', 5], ['a', 1]]}, {'$set': {'top': [['b', 5], ['a', 2]]}}),
+        ])
+
+    def test_unchanged_top_is_not_written(self):
+        collection = mock.Mock()
+        collection.find_one_and_update.return_value = {'_id': 1, 'counts': {'a': 1}, 'top': [['b', 5], ['a', 1]]}
+
+        word_list.increment_one_value(collection, 'вот', 'm', 'a')
+        collection.update_one.assert_not_called()
+
+    def test_documents_without_top(self):
+        collection = mock.Mock()
+        collection.find_one.return_value = {'_id': 1, 'counts': {'a': 2}}
+        doc = word_list.with_top(collection, {'_id': 1, 'standartizations': ['b', 'a']}, 'standartizations')
+        self.assertEqual((doc['top'], doc['total']), ([['a', 3], ['b', 1]], 4))
+
+        self.assertIsNone(word_list.with_top(collection, None, 'standartizations'))
+
+
+@mock.patch.object(standartizator.pymorphy2, 'MorphAnalyzer')
+@mock.patch.object(standartizator, 'Standartizator')
+class StandartizatorRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = standartizator.StandartizatorRegistry()
+        self.mtimes = (1, 1)
+        patcher = mock.patch.object(self.registry, 'get_resources_mtimes', side_effect=lambda: self.mtimes)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.generation = None
+        meta_collection = mock.Mock()
+        meta_collection.find_one.side_effect = lambda query: self.generation
+        meta_collection.update_one.side_effect = self.bump_generation
+        patcher = mock.patch.object(standartizator, 'META_COLLECTION', meta_collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def bump_generation(self, query, update, upsert=False):
+        value = self.generation['value'] if self.generation is not None else 0
+        self.generation = {'_id': query['_id'], 'value': value + update['$inc']['value']}
+
+    def test_instances_are_reused(self, Standartizator, MorphAnalyzer):
+        Standartizator.side_effect = lambda dialect, morph_rus: mock.Mock()
+        first = self.registry.get(mock.Mock(pk=1))
+        self.assertIs(self.registry.get(1), first)
+        self.assertIsNot(self.registry.get(2), first)
+        self.assertEqual(MorphAnalyzer.call_count, 1)
+        self.assertEqual(
+            [call[1]['morph_rus'] for call in Standartizator.call_args_list], [MorphAnalyzer.return_value] * 2
+        )
+
+    def test_instances_are_rebuilt_when_resources_change(self, Standartizator, MorphAnalyzer):
+        self.registry.get(1)
+        self.mtimes = (1, 2)
+        self.registry.get(1)
+        self.assertEqual(Standartizator.call_count, 2)
+
+    def test_instances_of_a_model_are_invalidated(self, Standartizator, MorphAnalyzer):
+        Standartizator.side_effect = lambda dialect, morph_rus: mock.Mock(model=mock.Mock(pk=dialect * 10))
+        first, second = self.registry.get(1), self.registry.get(2)
+
+        self.registry.invalidate(10)
+        self.assertNotIn('1', self.registry.instances)
+        self.assertIs(self.registry.instances['2'][0], second)
+        self.assertIsNot(self.registry.get(1), first)
+
+        self.registry.invalidate()
+        self.assertEqual(self.registry.instances, {})
+        self.assertIsNot(self.registry.get(2), second)
+
+    def test_instances_are_rebuilt_after_invalidation_in_another_process(self, Standartizator, MorphAnalyzer):
+        Standartizator.side_effect = lambda dialect, morph_rus: mock.Mock()
+        first = self.registry.get(1)
+
+        other_process_registry = standartizator.StandartizatorRegistry()
+        other_process_registry.invalidate(10)
+        self.assertEqual(self.generation['value'], 1)
+
+        second = self.registry.get(1)
+        self.assertIsNot(second, first)
+        self.assertIs(self.registry.get(1), second)
+
+
+FAKE_NORMALISE_SCRIPT = """
+import sys
+path, model_name = sys.argv[1:3]
+text = open(path, encoding='utf-8').read()
+if text == 'exit':
+    sys.stdout.flush()
+    import os
+    os._exit(1)
+if text == 'fail':
+    sys.exit(2)
+if text == 'sleep':
+    import time
+    time.sleep(60)
+with open(path + '.norm', 'w', encoding='utf-8') as f:
+    f.write('\\n'.join(word + '\\t' + word.upper() for word in text.split()) + '\\n\\n')
+"""
+
+
+class FakeNormaliseTestCase(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.tmp_dir, 'normalise.py'), 'w') as f:
+            f.write(FAKE_NORMALISE_SCRIPT)
+
+        patcher = override_settings(NORMALIZER_PATH=self.tmp_dir, NORMALIZER_PYTHON=sys.executable)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+
+class NormalizerWorkerTests(FakeNormaliseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.worker = normalizer.NormalizerWorker('rus')
+        self.addCleanup(self.worker.stop)
+
+    def test_requests_from_several_threads(self):
+        texts = ['ну вот %d' % i for i in range(20)]
+        with normalizer.concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda text: self.worker.normalize(text, timeout=30), texts))
+
+        self.assertEqual(results[3], 'ну\tНУ\nвот\tВОТ\n3\t3\n\n')
+        self.assertEqual(len(set(results)), len(texts))
+
+    def test_errors(self):
+        with self.assertRaisesRegex(normalizer.NormalizerError, 'exited with code 2'):
+            self.worker.normalize('fail', timeout=30)
+        self.assertEqual(self.worker.normalize('ну', timeout=30), 'ну\tНУ\n\n')
+
+        with self.assertRaisesRegex(normalizer.NormalizerError, 'exited'):
+            self.worker.normalize('exit', timeout=30)
+        self.worker.process.wait(timeout=30)
+        self.assertFalse(self.worker.is_alive())
+
+
+class NormalizeTextTests(FakeNormaliseTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(normalizer, '_WORKERS', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(normalizer.stop_normalizer_workers)
+
+        self.generation = None
+        meta_collection = mock.Mock()
+        meta_collection.find_one.side_effect = lambda query: self.generation
+        meta_collection.update_one.side_effect = self.bump_generation
+        patcher = mock.patch.object(normalizer, 'META_COLLECTION', meta_collection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def bump_generation(self, query, update, upsert=False):
+        value = self.generation['value'] if self.generation is not None else 0
+        self.generation = {'_id': query['_id'], 'value': value + update['$inc']['value']}
+
+    def test_worker_is_reused(self):
+        self.assertEqual(normalizer.normalize_text('rus', 'ну', timeout=30), 'ну\tНУ\n\n')
+        worker = normalizer._WORKERS['rus'][0]
+        self.assertEqual(normalizer.normalize_text('rus', 'вот', timeout=30), 'вот\tВОТ\n\n')
+        self.assertIs(normalizer._WORKERS['rus'][0], worker)
+
+    def test_worker_is_restarted_after_timeout(self):
+        normalizer.normalize_text('rus', 'ну', timeout=30)
+        worker = normalizer._WORKERS['rus'][0]
+
+        with self.assertRaisesRegex(normalizer.NormalizerError, 'did not answer'):
+            normalizer.normalize_text('rus', 'sleep', timeout=0.5)
+        self.assertNotIn('rus', normalizer._WORKERS)
+        self.assertFalse(worker.is_alive())
+
+        self.assertEqual(normalizer.normalize_text('rus', 'ну', timeout=30), 'ну\tНУ\n\n')
+
+    @override_settings(NORMALIZER_TIMEOUT=0.5)
+    def test_default_timeout(self):
+        with self.assertRaisesRegex(normalizer.NormalizerError, 'did not answer in 0.5 seconds'):
+            normalizer.normalize_text('rus', 'sleep')
+
+    def test_worker_is_restarted_after_model_is_retrained_in_another_process(self):
+        normalizer.normalize_text('rus', 'ну', timeout=30)
+        worker = normalizer._WORKERS['rus'][0]
+
+        normalizer.bump_model_generation('rus')
+        self.assertEqual(self.generation['_id'], 'normalizer_model_generation:rus')
+
+        normalizer.normalize_text('rus', 'ну', timeout=30)
+        self.assertIsNot(normalizer._WORKERS['rus'][0], worker)
+        worker.process.wait(timeout=30)
+        self.assertFalse(worker.is_alive())
+
+
+class GrammarAnnotationTests(SimpleTestCase):
+    def setUp(self):
+        self.standartizator = standartizator.Standartizator.__new__(standartizator.Standartizator)
+        self.standartizator.model = 'rus'
+        self.standartizator.manual_words = {'тык': [['так', 'так', 'ADV', 1]]}
+        self.standartizator.get_annotation_options_list_by_parsing = mock.Mock(
+            side_effect=lambda orig, standartization: [[standartization, 'X', 0.5]]
+        )
+        self.from_db = {'вот': {'word': 'вот', 'total': 2, 'top': [['вот:ADV', 2]]}}
+
+    @mock.patch.object(standartizator, 'find_standartization')
+    @mock.patch.object(standartizator, 'find_standartizations')
+    def test_unique_tokens_are_annotated_once(self, find_standartizations, find_standartization):
+        find_standartizations.return_value = self.from_db
+        find_standartization.side_effect = lambda word, model: self.from_db.get(word)
+        nrm_list = [[('Вот', 'вот'), ('тык', 'так'), ('вот', 'вот')], [('Вот', 'вот'), ('ну', 'ну')]]
+
+        annotations = self.standartizator.get_grammar_annotation(nrm_list)
+        self.assertEqual(annotations, [
+            [(word[1], self.standartizator.get_annotation_options_list(word)) for word in nrm] for nrm in nrm_list
+        ])
+        self.assertEqual(annotations[0][0][1], [['вот', 'ADV'], ['вот', 'X']])
+
+        find_standartizations.assert_called_once_with({'вот', 'ну'}, model='rus')
+        self.assertEqual(self.standartizator.get_annotation_options_list_by_parsing.call_count, 3 + 4)
+
+    @override_settings(NORMALIZER_TIMEOUT=7)
+    @mock.patch.object(standartizator, 'normalize_text', return_value='Вот\tвот\n\n')
+    def test_normalization_has_a_timeout(self, normalize_text):
+        self.standartizator.get_auto_standartization = lambda word: tuple(word.split('\t'))
+        self.assertEqual(self.standartizator.normalize('Вот'), [[('Вот', 'вот')]])
+        normalize_text.assert_called_once_with('rus', 'Вот', timeout=7)
+
+
+class MorphCacheTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmp_dir, 'morph_cache.sqlite3')
+        self.compute = mock.Mock(side_effect=lambda word: [word, 'X'])
+
+    def test_least_recently_used_values_are_evicted(self):
+        cache = MorphCache(self.path, max_size=2)
+        for word in ['a', 'b', 'a', 'c']:
+            self.assertEqual(cache.get('parse', 'v1', word, self.compute), [word, 'X'])
+
+        self.assertEqual(list(cache.items), [cache.make_key('parse', 'v1', word) for word in ['a', 'c']])
+        self.assertEqual(self.compute.call_count, 3)
+        self.assertEqual((cache.memory_hits, cache.disk_hits, cache.misses), (1, 0, 3))
+
+        # evicted values not written yet are still found
+        cache.get('parse', 'v1', 'b', self.compute)
+        self.assertEqual(self.compute.call_count, 3)
+
+    def test_values_are_shared_through_sqlite(self):
+        cache = MorphCache(self.path, max_size=10)
+        cache.get('parse', 'v1', 'a', self.compute)
+        cache.flush()
+
+        other = MorphCache(self.path, max_size=10)
+        self.assertEqual(other.get('parse', 'v1', 'a', self.compute), ['a', 'X'])
+        self.assertEqual(other.get('parse', 'v2', 'a', self.compute), ['a', 'X'])
+        self.assertEqual(self.compute.call_count, 2)  # the other version is computed again
+        self.assertEqual(other.format_stats(), '0 memory hits, 1 disk hits, 1 misses (50.0% hit rate)')
+
+    def test_connection_is_not_inherited_by_forked_processes(self):
+        cache = MorphCache(self.path, max_size=10)
+        connection = cache.connection
+        self.assertIs(cache.connection, connection)
+
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            self.assertIsNot(cache.connection, connection)
+
+
+class TagOrderingTests(SimpleTestCase):
+    def test_pymorphy2_tags(self):
+        for tag_str, expected in TEST_CASES.items():
+            self.assertEqual(annotation_menu.override_abbreviations(tag_str), expected, tag_str)
+
+    def test_compiled_tables_order_tags_as_legacy_config_lookups(self):
+        with quiet():
+            for tag_str in set(make_synthetic_tags(annotation_menu, 2000, 500)):
+                self.assertEqual(
+                    annotation_menu._override_abbreviations(tag_str),
+                    legacy_override_abbreviations(annotation_menu, tag_str),
+                    tag_str
+                )
+
+
+def add_two_recordings(context, fail):
+    context.set_total(2)
+    context.run_for_recording('a', lambda: None)
+    context.run_for_recording('b', lambda: 1 / 0 if fail else None)
+    return 'added'
+
+
+@mock.patch.dict(jobs.JOB_HANDLERS, {'test': add_two_recordings})
+class JobTests(TestCase):
+    def test_job_is_claimed_once(self):
+        job = jobs.enqueue_job('test', fail=False)
+        self.assertEqual(jobs.get_job_status(job.pk)['status'], 'queued')
+
+        claimed = jobs.claim_job('host:1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.worker), (job.pk, 'running', 'host:1'))
+        self.assertIsNone(jobs.claim_job('host:2'))
+
+        jobs.run_job(claimed)
+        status = jobs.get_job_status(job.pk)
+        self.assertEqual(
+            (status['status'], status['progress'], status['total'], status['result']), ('done', 2, 2, 'added')
+        )
+        self.assertEqual([item['error'] for item in status['items']], [None, None])
+
+    @mock.patch('builtins.print')
+    def test_errors_are_reported(self, _):
+        job = jobs.enqueue_job('test', fail=True)
+        jobs.run_job(jobs.claim_job('host:1'))
+        status = jobs.get_job_status(job.pk)
+        self.assertEqual(status['status'], 'done')
+        self.assertIn('ZeroDivisionError', status['items'][1]['error'])
+
+        job = jobs.enqueue_job('test')
+        jobs.run_job(jobs.claim_job('host:1'))
+        status = jobs.get_job_status(job.pk)
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('TypeError', status['error'])
+
+    def test_jobs_of_dead_workers_are_requeued(self):
+        alive, dead = jobs.enqueue_job('test', fail=False), jobs.enqueue_job('test', fail=False)
+        hostname = jobs.socket.gethostname()
+        jobs.claim_job('%s:%d' % (hostname, os.getpid()))
+        jobs.claim_job('%s:%d' % (hostname, 2 ** 22 + 1))  # above pid_max
+
+        self.assertEqual(jobs.requeue_abandoned_jobs(), 1)
+        self.assertEqual(jobs.get_job_status(alive.pk)['status'], 'running')
+        self.assertEqual(jobs.get_job_status(dead.pk)['status'], 'queued')
+
+
+class ElanObjectSaveTests(TempDirTestCase):
+    def test_eaf_is_replaced_atomically(self):
+        path = os.path.join(self.tmp_dir, 'a.eaf')
+        shutil.copy(os.path.join(MEDIA_ROOT, 'MP-BRAR-03-01-01.eaf'), path)
+        elan_obj = ElanObject(path)
+        n_annotations = len(elan_obj.annot_data_lst)
+
+        with mock.patch.object(os, 'replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                elan_obj.save()
+        self.assertEqual(os.listdir(self.tmp_dir), ['a.eaf'])
+        self.assertEqual(len(ElanObject(path).annot_data_lst), n_annotations)
+
+        elan_obj.save()
+        self.assertEqual(os.listdir(self.tmp_dir), ['a.eaf'])
+        self.assertEqual(len(ElanObject(path).annot_data_lst), n_annotations)
+
+
+@mock.patch.object(db_utils, '_CLIENT_PID', None)
+@mock.patch.object(db_utils, '_CLIENT', None)
+@mock.patch.object(db_utils.pymongo, 'MongoClient', side_effect=lambda url: mock.MagicMock())
+@mock.patch.object(db_utils.os, 'getpid', return_value=1)
+class MongoClientTests(SimpleTestCase):
+    def test_forked_processes_get_their_own_client(self, getpid, MongoClient):
+        client = db_utils.get_mongo_client()
+        self.assertIs(db_utils.get_mongo_client(), client)
+
+        collection = db_utils.ProcessLocalCollection('words')
+        collection.find_one({'_id': 1})
+        db_utils.MONGO_DB['words'].find_one({'_id': 1})
+        self.assertEqual(MongoClient.call_count, 1)
+
+        getpid.return_value = 2
+        collection.find_one({'_id': 1})
+        self.assertEqual(MongoClient.call_count, 2)
+        self.assertIsNot(db_utils.get_mongo_client(), client)
+        self.assertEqual(
+            collection.collection, db_utils.get_mongo_client()[db_utils.MONGO_DB_NAME]['words']
+        )
+
+    @mock.patch.object(reannotation, '_INITIALIZED_PID', None)
+    @mock.patch.object(reannotation.standartizator_registry, 'get_morph_rus')
+    @mock.patch.object(reannotation, 'connections', mock.Mock(all=lambda: []))
+    def test_reannotation_workers_make_a_client(self, get_morph_rus, getpid, MongoClient):
+        db_utils.get_mongo_client()
+        getpid.return_value = 2
+        reannotation.init_worker()
+        self.assertEqual(MongoClient.call_count, 2)
+
+
+class ReannotationTests(TestCase):
+    def test_errors_are_reported_per_recording(self):
+        report = reannotation.reannotate_recording(-1, 'auto-grammar')
+        self.assertEqual(report.recording, '-1')
+        self.assertIn('DoesNotExist', report.error)
+
+    @mock.patch.object(reannotation, '_INITIALIZED_PID', None)
+    @mock.patch.object(reannotation.standartizator_registry, 'get_morph_rus')
+    @mock.patch.object(reannotation.os, 'getpid')
+    def test_workers_are_initialised_once_per_process(self, getpid, get_morph_rus):
+        getpid.return_value = 1
+        reannotation.init_worker()
+        reannotation.init_worker()
+        self.assertEqual(get_morph_rus.call_count, 1)
+
+        getpid.return_value = 2  # forked from the initialised process
+        reannotation.init_worker()
+        self.assertEqual(get_morph_rus.call_count, 2)
+
+
+class RecordingLockTests(TestCase):
+    def setUp(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir, ignore_errors=True)
+        patcher = mock.patch.object(locks, 'LOCK_DIR', lock_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_locked_recording_is_not_written_concurrently(self):
+        with locks.recording_lock('a.eaf', owner='alice'):
+            self.assertEqual(RecordingLock.objects.get(elan='a.eaf').owner, 'alice')
+            self.assertTrue(locks.is_lock_alive(RecordingLock.objects.get(elan='a.eaf')))
+
+            with self.assertRaises(locks.RecordingLocked) as raised:
+                with locks.recording_lock('a.eaf', owner='bob', timeout=0.2):
+                    pass
+            self.assertEqual(str(raised.exception), 'a.eaf is locked by alice')
+
+            with locks.recording_lock('b.eaf', timeout=0):
+                pass
+
+        self.assertFalse(RecordingLock.objects.exists())
+        with locks.recording_lock('a.eaf', owner='bob', timeout=0):
+            pass
+
+    def test_locks_are_taken_in_sorted_order(self):
+        with mock.patch.object(locks, 'recording_lock', wraps=locks.recording_lock) as recording_lock:
+            with locks.recording_locks(['b.eaf', 'a.eaf', 'b.eaf'], owner='alice'):
+                self.assertEqual(RecordingLock.objects.count(), 2)
+        self.assertEqual([call[0][0] for call in recording_lock.call_args_list], ['a.eaf', 'b.eaf'])
+
+
+class FakeEditorSession:
+    def __init__(self, recording):
+        self.converter = mock.Mock(path=recording.data.path)
+        self.size = recording.size
+
+
+@mock.patch.object(editor_sessions, 'EditorSession', FakeEditorSession)
+class EditorSessionCacheTests(SimpleTestCase):
+    @staticmethod
+    def recording(pk, size, path=None):
+        return mock.Mock(pk=pk, size=size, data=mock.Mock(path=path or '%d.eaf' % pk))
+
+    def test_sessions_are_reused(self):
+        cache = editor_sessions.EditorSessionCache(budget=100)
+        session = cache.get(1, self.recording(1, 10))
+        recording = self.recording(1, 10)
+        self.assertIs(cache.get(1, recording), session)
+        session.converter.set_recording.assert_called_once_with(recording)
+
+        self.assertIsNot(cache.get(2, self.recording(1, 10)), session)  # another user
+        self.assertIsNot(cache.get(1, self.recording(1, 10, path='new.eaf')), session)  # file replaced in the admin
+
+        cache.discard(1, 1)
+        self.assertEqual(list(cache.sessions), [(2, 1)])
+
+    def test_least_recently_used_sessions_are_evicted_over_budget(self):
+        cache = editor_sessions.EditorSessionCache(budget=100)
+        for pk in [1, 2, 3]:
+            cache.get(1, self.recording(pk, 40))
+        self.assertEqual(list(cache.sessions), [(1, 2), (1, 3)])
+
+        cache.get(1, self.recording(2, 40))
+        cache.get(1, self.recording(4, 40))
+        self.assertEqual(list(cache.sessions), [(1, 2), (1, 4)])
+
+        # the last session is kept even if it is larger than the budget
+        cache.get(1, self.recording(5, 200))
+        self.assertEqual(list(cache.sessions), [(1, 5)])
+
+
+class ElanObjectIndexTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmp_dir, 'a.eaf')
+        self.annotations = make_eaf(self.path)
+
+    def test_lookups_match_pympi(self):
+        elan_obj = ElanObject(self.path)
+        legacy_eaf = Eaf(self.path)
+
+        for tier_name, start, end, transcript in self.annotations:
+            self.assertEqual(elan_obj.get_annotation_value(tier_name, start, end), transcript)
+            for child_tier_name in [tier_name + '_standartization', tier_name + '_annotation', 'missing']:
+                self.assertEqual(
+                    elan_obj.get_child_annotation_value(child_tier_name, start, end),
+                    legacy_get_value(legacy_eaf, child_tier_name, start, end),
+                    (child_tier_name, start, end)
+                )
+
+        self.assertIsNone(elan_obj.get_annotation_value('tier_1_n_', 0, 999))
+
+    def test_updates_match_pympi(self):
+        elan_obj = ElanObject(self.path)
+        legacy_eaf = Eaf(self.path)
+
+        for tier_name, start, end, _ in self.annotations:
+            for typ in ['standartization', 'annotation']:
+                value = '0:%s-%d' % (typ, start)
+                elan_obj.add_extra_tags(tier_name, start, end, value, typ)
+
+                try:
+                    legacy_eaf.remove_annotation(tier_name + '_' + typ, (start + end) / 2, clean=True)
+                except KeyError:
+                    pass
+                legacy_eaf.add_annotation(tier_name + '_' + typ, start, end, value)
+
+                # the index is kept up to date between updates
+                self.assertEqual(elan_obj.get_child_annotation_value(tier_name + '_' + typ, start, end), value)
+
+        self.assertEqual(get_child_tiers_data(elan_obj.Eaf), get_child_tiers_data(legacy_eaf))
+
+    def test_synthetic_eaf(self):
+        benchmark_elan_index.make_synthetic_eaf(self.path, n_annotations=300, n_tiers=3)
+        legacy_obj, indexed_obj = ElanObject(self.path), ElanObject(self.path)
+
+        self.assertEqual(
+            benchmark_elan_index.lookup_all(
+                indexed_obj, indexed_obj.get_tier_obj_by_name, indexed_obj.get_child_annotation_value
+            ),
+            benchmark_elan_index.lookup_all(
+                legacy_obj,
+                lambda tier_name: benchmark_elan_index.legacy_get_tier_obj_by_name(legacy_obj, tier_name),
+                lambda *args: benchmark_elan_index.legacy_get_value(legacy_obj, *args)
+            )
+        )
+
+        benchmark_elan_index.update_all(
+            legacy_obj, lambda *args: benchmark_elan_index.legacy_add_extra_tags(legacy_obj, *args)
+        )
+        benchmark_elan_index.update_all(
+            indexed_obj, lambda tier_name, start, end, value: indexed_obj.add_extra_tags(
+                tier_name.rsplit('_', 1)[0], start, end, value, tier_name.rsplit('_', 1)[1]
+            )
+        )
+        self.assertEqual(
+            benchmark_elan_index.get_child_tiers_data(indexed_obj),
+            benchmark_elan_index.get_child_tiers_data(legacy_obj)
+        )
+
+
+@mock.patch('corpora.utils.elan_to_html.saved_recording_to_db')
+@mock.patch('corpora.utils.elan_to_html.recording_lock')
+class SavePatchToElanTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmp_dir, 'a.eaf')
+        make_eaf(self.path)
+
+        # only the parsed file is needed, not a Recording
+        self.converter = ElanToHTML.__new__(ElanToHTML)
+        self.converter.path = self.path
+        self.converter.audio_file_path = 'audio/a.wav'
+        self.converter.dialect = mock.Mock(id=1)
+        self.converter.load_elan()
+
+    def record_sync_and_unlock(self, recording_lock, saved_recording_to_db):
+        calls = mock.Mock()
+        calls.attach_mock(recording_lock.return_value.__exit__, 'unlock')
+        calls.attach_mock(saved_recording_to_db, 'sync')
+        return calls
+
+    def test_patch_is_saved(self, recording_lock, saved_recording_to_db):
+        calls = self.record_sync_and_unlock(recording_lock, saved_recording_to_db)
+        saved = self.converter.save_patch_to_elan([{
+            'tier': 'tier_1_n_', 'start': '2000', 'end': 3000.0,
+            'tokens': [{'nrm': 'туда', 'lemma': 'туда', 'morph': 'ADV'}, {'nrm': 'и'}]
+        }], owner='editor')
+
+        recording_lock.assert_called_once_with('a.eaf', owner='editor')
+        self.assertEqual(saved, [('tier_1_n_', 2000, 3000, 'туда и', '0:туда|1:и', '0:туда:ADV')])
+        self.assertEqual(ElanObject(self.path).get_annotation_values('tier_1_n_', 2000, 3000), saved[0][3:])
+        self.assertEqual([call[0] for call in calls.mock_calls], ['sync', 'unlock'])
+        saved_recording_to_db.assert_called_once_with(
+            eaf_path=self.path, audio_path='audio/a.wav', changed=saved, dialect=1
+        )
+
+    def test_html_is_saved(self, recording_lock, saved_recording_to_db):
+        calls = self.record_sync_and_unlock(recording_lock, saved_recording_to_db)
+        html = '<div class="eaf_display"></div>'
+        self.converter.save_html_to_elan(html, owner='editor')
+
+        recording_lock.assert_called_once_with('a.eaf', owner='editor')
+        self.assertEqual([call[0] for call in calls.mock_calls], ['sync', 'unlock'])
+        saved_recording_to_db.assert_called_once_with(
+            eaf_path=self.path, audio_path='audio/a.wav', html=html, dialect=1
+        )
+
+    def test_unknown_annotation_is_not_saved(self, recording_lock, saved_recording_to_db):
+        with open(self.path, 'rb') as f:
+            contents = f.read()
+
+        with self.assertRaises(KeyError):
+            self.converter.save_patch_to_elan([
+                {'tier': 'tier_1_n_', 'start': 2000, 'end': 3000, 'tokens': [{'nrm': 'туда'}]},
+                {'tier': 'tier_1_n_', 'start': 2000, 'end': 3001, 'tokens': [{'nrm': 'туда'}]},
+            ])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        saved_recording_to_db.assert_not_called()
+
+
+class EditorWindowTests(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        path = os.path.join(self.tmp_dir, 'a.eaf')
+        make_eaf(path)
+
+        self.converter = ElanToHTML.__new__(ElanToHTML)
+        self.converter.path = path
+        self.converter.audio_file_path = '/media/a.wav'
+        self.converter.dialect = mock.Mock(id=1)
+        self.converter.file_obj = mock.Mock()
+        self.converter.load_elan()
+
+    @mock.patch('builtins.print')
+    def test_windows_make_the_whole_page(self, _):
+        self.converter.build_html()
+        windows = [self.converter.build_window(first, 3) for first in [0, 3]]
+        self.assertEqual([window[1:] for window in windows], [(0, 3), (3, 4)])
+        self.assertEqual(
+            self.converter.html, '<div class="eaf_display">%s</div>' % ''.join(window[0] for window in windows)
+        )
+
+        self.converter.build_html_window(1, 2)
+        self.assertTrue(self.converter.html.startswith(
+            '<div class="eaf_display" first="1" last="3" total="4" window="2">'
+        ))
+
+    def test_blocks_are_found_by_time(self):
+        # blocks start at 0, 500, 2000 and 4000
+        self.assertEqual([self.converter.find_block(time) for time in [0, 700, 1700, 2500, 9000]], [0, 1, 2, 2, 3])
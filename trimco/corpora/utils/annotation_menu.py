@@ -1,19 +1,26 @@
 import re
 import os
 import json
+import hashlib
 from collections import defaultdict
 
 from trimco.settings import _STATIC_ROOT
 from .format_utils import ANNOTATION_TAG_SEP
 
 
+TAG_SPLIT_REGEX = re.compile(r'[, ]')
+
+
 class AnnotationMenu:
     tag_sep = ','
 
     def __init__(self, json_name):
         self.config = self._read_config(json_name)
+        # identifies the config in keys of morph_cache
+        self.config_hash = hashlib.sha1(json.dumps(self.config, sort_keys=True).encode('utf-8')).hexdigest()
         self.surface_tags_by_category = self._get_tags_by_category()
         self._parse_config_order()
+        self._compile_config()
 
         lemma_input_str = (
             '<div class="manualAnnotationContainer">'
@@ -56,6 +63,43 @@ class AnnotationMenu:
             order[pos] = {tuple(k.split(self.tag_sep)): v for k, v in orders.items()}
         self.config['order'] = order
 
+    def _compile_config(self):
+        """
+        lookup tables used by override_abbreviations instead of scanning the config for every tag
+        """
+        self.grammeme_lookup = {
+            tag: (tag_dict['category'], tag_dict['surface_tag'])
+            for tag, tag_dict in self.config['grammemes'].items()
+        }
+
+        # bit i of a mask stands for the i-th entry of the facultative config
+        self.facultative_bits = defaultdict(int)
+        self.facultative_entries = []
+        for i, tag_info in enumerate(self.config['facultative']):
+            self.facultative_bits[tag_info['tag']] |= 1 << i
+            self.facultative_entries.append((
+                tag_info['tag'],
+                tag_info['categories'][0] == 'ALLFORMS',
+                [frozenset(cats.split('.')) for cats in tag_info['categories']]
+            ))
+        self.facultative_bits = dict(self.facultative_bits)
+
+        # {pos: ([(restriction, order, compiled order), ...], (default order, compiled default order))},
+        # restrictions are checked in the order of the config,
+        # compiled orders are [(category, always required), ...] without '*' marks
+        self.order_tables = {}
+        for pos, orders in self.config['order'].items():
+            self.order_tables[pos] = (
+                [(frozenset(k), order, self._compile_order(order)) for k, order in orders.items() if k != ('default',)],
+                (orders[('default',)], self._compile_order(orders[('default',)]))
+            )
+
+        self.override_cache = {}  # {pymorphy2 tag string: result of override_abbreviations}
+
+    @staticmethod
+    def _compile_order(order):
+        return [(key[1:], False) if key.startswith('*') else (key, True) for key in order]
+
     def _serialize_config_order(self):
         serialized = {}
         for pos, orders in self.config['order'].items():
@@ -112,78 +156,83 @@ class AnnotationMenu:
             self.menu_html_str_2
         ]
 
-    def get_order_by_tag(self, pos, tags_dict):
-        order_config = self.config['order'][pos]
+    def _find_order(self, pos, tags_dict):
+        """
+        (order, compiled order) of the first restriction satisfied by the tags
+        """
+        rules, default = self.order_tables[pos]
         tag_keyset = set(tags_dict.values())
 
-        order_key = ('default',)
-        for config_order_k in order_config:
-            if not set(config_order_k) - tag_keyset:
-                order_key = config_order_k
-                break
+        for restriction, order, compiled_order in rules:
+            if restriction <= tag_keyset:
+                return order, compiled_order
+
+        return default
 
-        return order_config[order_key]
+    def get_order_by_tag(self, pos, tags_dict):
+        return self._find_order(pos, tags_dict)[0]
 
     def order_compulsory_tags(self, pos, tags_dict, tag_str):
         final_tags = [pos]
 
-        if pos in self.config['order']:
-            order = self.get_order_by_tag(pos, tags_dict)
-            for key in order:
-                key_always_required = True
-                if key.startswith('*'):
-                    key_always_required = False
-                    key = key[1:]
+        if pos in self.order_tables:
+            _, compiled_order = self._find_order(pos, tags_dict)
+            for key, key_always_required in compiled_order:
+                if key in tags_dict:
+                    final_tags.append(tags_dict[key])
 
-                if key not in tags_dict and key_always_required:
+                elif key_always_required:
                     print('WARNING', key + ' not in tags ' + tag_str)
                     final_tags.append('')
-                    continue
-
-                if key in tags_dict or key_always_required:
-                    final_tags.append(tags_dict[key])
 
         return final_tags
 
     def order_facultative_tags(self, facultative_tags, compulsory_tags, word=None):
         all_tags = compulsory_tags + facultative_tags
+        all_tags_set = set(all_tags)
 
-        def tag_suitable(tag_info):
-            tag = tag_info['tag']
-            if tag not in facultative_tags:
-                return False
+        mask = 0
+        for tag in facultative_tags:
+            mask |= self.facultative_bits.get(tag, 0)
 
-            is_for_all = tag_info['categories'][0] == "ALLFORMS"
-            is_in_category = any(
-                all(cat in all_tags for cat in cats.split('.'))
-                for cats in tag_info['categories']
-            )
+        facultative = []
+        while mask:  # lowest bits first to keep the order of the config
+            bit = mask & -mask
+            mask ^= bit
+            tag, is_for_all, categories = self.facultative_entries[bit.bit_length() - 1]
+
+            is_in_category = any(cats <= all_tags_set for cats in categories)
             if not (is_for_all or is_in_category):
                 print("facultative present but is not allowed by category\n", tag, all_tags, word, "\n")
+                continue
 
-            return is_for_all or is_in_category
+            facultative.append(tag)
 
-        facultative = [
-            t["tag"] for t in self.config['facultative']  # iterating through config to keep the order fixed
-            if tag_suitable(t)
-        ]
         return facultative
 
     def override_abbreviations(self, tag_str):
-        tags_lst = [t for t in re.split(r'[, ]', tag_str) if t]
+        """
+        memoized, as the result depends only on the tag string and the config
+        """
+        final_tags = self.override_cache.get(tag_str)
+        if final_tags is None:
+            final_tags = self._override_abbreviations(tag_str)
+            self.override_cache[tag_str] = final_tags
+        return final_tags
+
+    def _override_abbreviations(self, tag_str):
+        tags_lst = [t for t in TAG_SPLIT_REGEX.split(tag_str) if t]
         if not tags_lst:
             return ''
 
-        tags_dict = {
-            self.config['grammemes'][t]['category']: self.config['grammemes'][t]['surface_tag']
-            for t in tags_lst if t in self.config['grammemes']
-        }
-
-        all_facultative_set = set(i['tag'] for i in self.config['facultative'])
-        facultative_lst = [
-            t for t in tags_lst
-            if t in all_facultative_set
-        ]
+        tags_dict = {}
+        facultative_lst = []
+        for t in tags_lst:
+            grammeme = self.grammeme_lookup.get(t)
+            if grammeme is not None:
+                tags_dict[grammeme[0]] = grammeme[1]
+            if t in self.facultative_bits:
+                facultative_lst.append(t)
 
         pos = tags_dict.get('part of speech')
         if pos is None:  # UNKN, LATIN, PNCT
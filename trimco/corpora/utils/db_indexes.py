@@ -0,0 +1,213 @@
+"""
+Registry of every Mongo index the code relies on
+and of the query shapes that must be served by them.
+
+Use `python manage.py mongo_indexes` to create, diff, drop and check them.
+"""
+
+from collections import namedtuple
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from .db_utils import MONGO_DB
+
+
+Index = namedtuple('Index', ['collection', 'name', 'keys', 'unique'])
+QueryShape = namedtuple('QueryShape', ['description', 'collection', 'filter', 'sort'])
+
+
+_SENTENCE_SORT = [('elan', ASCENDING), ('audio.start', ASCENDING), ('tier', ASCENDING), ('_id', ASCENDING)]
+_TOKEN_SORT = [('elan', ASCENDING), ('audio_start', ASCENDING), ('tier', ASCENDING), ('sentence', ASCENDING)]
+
+INDEXES = [
+    # word_list.find_word and upserts of word_list.insert_words_in_mongo,
+    # unique so that concurrent upserts can not create two documents for a word
+    Index('words', 'model_word', [('model', ASCENDING), ('word', ASCENDING)], True),
+
+    # word_list.find_standartization(s) and upserts of word_list.insert_words_in_mongo
+    Index('standartizations', 'model_word', [('model', ASCENDING), ('word', ASCENDING)], True),
+
+    # search_backend.search sort and page anchors, saved_recording_to_db, db_to_html.html_to_db
+    Index('sentences', 'sort_key', _SENTENCE_SORT, False),
+    # search_backend.search with a bare dialect filter
+    Index('sentences', 'dialect_sort_key', [('dialect', ASCENDING)] + _SENTENCE_SORT, False),
+
+    # MongoSearchBackend.find_sentence_keys, tokens are read in the sort order of sentences
+    Index('tokens', 'transcription_sort_key', [('transcription', ASCENDING)] + _TOKEN_SORT, False),
+    Index('tokens', 'standartization_sort_key', [('standartization', ASCENDING)] + _TOKEN_SORT, False),
+    Index('tokens', 'lemma_sort_key', [('lemma', ASCENDING)] + _TOKEN_SORT, False),
+    Index('tokens', 'tags_sort_key', [('tags', ASCENDING)] + _TOKEN_SORT, False),
+    # token_index.reindex_sentence, remove_sentences_from_index, remove_elan_from_index
+    Index('tokens', 'sentence', [('sentence', ASCENDING)], False),
+    Index('tokens', 'elan', [('elan', ASCENDING)], False),
+]
+
+
+_DIALECT = {'$in': [1]}
+
+QUERY_SHAPES = [
+    QueryShape('find_word', 'words', {'model': 'x', 'word': 'x'}, None),
+    QueryShape('find_standartization', 'standartizations', {'model': 'x', 'word': 'x'}, None),
+    QueryShape('find_standartizations', 'standartizations', {'model': 'x', 'word': {'$in': ['x', 'y']}}, None),
+    QueryShape(
+        'retract_words_from_mongo', 'words',
+        {'$or': [{'model': 'x', 'word': 'x'}, {'model': 'x', 'word': 'y'}]}, None
+    ),
+
+    QueryShape('search: transcription', 'tokens', {'transcription': 'x', 'dialect': _DIALECT}, _TOKEN_SORT),
+    QueryShape('search: standartization', 'tokens', {'standartization': 'x'}, _TOKEN_SORT),
+    QueryShape('search: lemma', 'tokens', {'lemma': 'x', 'dialect': _DIALECT}, _TOKEN_SORT),
+    QueryShape('search: tags', 'tokens', {'tags': {'$all': ['x', 'y']}}, _TOKEN_SORT),
+    QueryShape(
+        'search: tokens after anchor', 'tokens',
+        {'$and': [
+            {'$or': [
+                {'elan': {'$gt': 'x'}},
+                {'elan': 'x', 'audio_start': {'$gt': 0}},
+                {'elan': 'x', 'audio_start': 0, 'tier': {'$gt': 'x'}},
+                {'elan': 'x', 'audio_start': 0, 'tier': 'x', 'sentence': {'$gt': ObjectId()}},
+            ]},
+            {'lemma': 'x'}
+        ]},
+        _TOKEN_SORT
+    ),
+    QueryShape('search: sentences by ids', 'sentences', {'_id': {'$in': [ObjectId()]}}, None),
+    QueryShape('search: dialect only', 'sentences', {'dialect': _DIALECT}, _SENTENCE_SORT),
+    QueryShape(
+        'search: page after anchor', 'sentences',
+        {'$and': [
+            {'$or': [
+                {'elan': {'$gt': 'x'}},
+                {'elan': 'x', 'audio.start': {'$gt': 0}},
+                {'elan': 'x', 'audio.start': 0, 'tier': {'$gt': 'x'}},
+                {'elan': 'x', 'audio.start': 0, 'tier': 'x', '_id': {'$gt': ObjectId()}},
+            ]},
+            {'dialect': _DIALECT}
+        ]},
+        _SENTENCE_SORT
+    ),
+
+    QueryShape('saved_recording_to_db', 'sentences', {'elan': 'x'}, None),
+    QueryShape(
+        'html_to_db', 'sentences',
+        {'$or': [
+            {'elan': 'x', 'audio.start': 0, 'tier': 'x', 'audio.end': 0},
+            {'elan': 'y', 'audio.start': 0, 'tier': 'x', 'audio.end': 0},
+        ]},
+        None
+    ),
+    QueryShape('reindex_sentence', 'tokens', {'sentence': ObjectId()}, None),
+    QueryShape('remove_sentences_from_index', 'tokens', {'sentence': {'$in': [ObjectId()]}}, None),
+    QueryShape('remove_elan_from_index', 'tokens', {'elan': 'x'}, None),
+]
+
+
+def _index_spec(keys, unique):
+    return [tuple(k) for k in keys], bool(unique)
+
+
+def get_existing_indexes(collection_name):
+    existing = MONGO_DB[collection_name].index_information()
+    existing.pop('_id_', None)
+    return existing
+
+
+def diff_indexes():
+    """
+    returns (missing, changed, undeclared):
+    declared indexes that do not exist, declared indexes that exist with another spec,
+    and (collection, name) pairs of existing indexes that are not declared
+    """
+    missing, changed, undeclared = [], [], []
+    declared_names = {(index.collection, index.name) for index in INDEXES}
+
+    existing_by_collection = {
+        collection: get_existing_indexes(collection)
+        for collection in sorted({index.collection for index in INDEXES})
+    }
+
+    for index in INDEXES:
+        existing = existing_by_collection[index.collection].get(index.name)
+        if existing is None:
+            missing.append(index)
+        elif _index_spec(existing['key'], existing.get('unique')) != _index_spec(index.keys, index.unique):
+            changed.append(index)
+
+    for collection, existing in existing_by_collection.items():
+        for name in existing:
+            if (collection, name) not in declared_names:
+                undeclared.append((collection, name))
+
+    return missing, changed, undeclared
+
+
+def find_conflicting_indexes(indexes):
+    """
+    returns (index, name) of existing indexes with the keys of declared indexes under other names,
+    e.g. `word_1` made by create_index without a name. Mongo refuses to create an index
+    with the same keys under another name, so they are dropped before the declared ones are created
+    """
+    conflicting = []
+    for index in indexes:
+        keys = [tuple(k) for k in index.keys]
+        for name, existing in get_existing_indexes(index.collection).items():
+            if name != index.name and [tuple(k) for k in existing['key']] == keys:
+                conflicting.append((index, name))
+    return conflicting
+
+
+def create_indexes():
+    """
+    returns (created indexes, (index, name) of existing indexes that they replaced)
+    """
+    missing, changed, _ = diff_indexes()
+    conflicting = find_conflicting_indexes(missing + changed)
+
+    for index in changed:
+        MONGO_DB[index.collection].drop_index(index.name)
+
+    for index, name in conflicting:
+        MONGO_DB[index.collection].drop_index(name)
+
+    for index in missing + changed:
+        MONGO_DB[index.collection].create_index(index.keys, name=index.name, unique=index.unique)
+
+    return missing + changed, conflicting
+
+
+def drop_undeclared_indexes():
+    _, _, undeclared = diff_indexes()
+    for collection, name in undeclared:
+        MONGO_DB[collection].drop_index(name)
+    return undeclared
+
+
+def _plan_stages(plan):
+    yield plan.get('stage')
+    for key in ('inputStage', 'outerStage', 'innerStage'):
+        if key in plan:
+            yield from _plan_stages(plan[key])
+    for sub_plan in plan.get('inputStages', []):
+        yield from _plan_stages(sub_plan)
+
+
+def get_winning_plan_stages(shape):
+    cursor = MONGO_DB[shape.collection].find(shape.filter)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    explanation = cursor.explain()
+    return list(_plan_stages(explanation['queryPlanner']['winningPlan']))
+
+
+def check_query_plans():
+    """
+    returns list of (shape, stages) for every query shape
+    whose winning plan contains a collection scan
+    """
+    failed = []
+    for shape in QUERY_SHAPES:
+        stages = get_winning_plan_stages(shape)
+        if 'COLLSCAN' in stages:
+            failed.append((shape, stages))
+    return failed
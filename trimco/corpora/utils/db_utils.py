@@ -1,18 +1,78 @@
+import os
+import threading
+
 import pymongo
 
 from trimco.settings import MONGO_URL, MONGO_DB_NAME
 
 
-MONGO_CLIENT = pymongo.MongoClient(MONGO_URL)
-MONGO_DB = MONGO_CLIENT[MONGO_DB_NAME]
+_CLIENT = None
+_CLIENT_PID = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_mongo_client():
+    """
+    MongoClient is not fork-safe, so a forked process (e.g. a reannotation worker)
+    connects with its own client instead of the one inherited from its parent
+    """
+    global _CLIENT, _CLIENT_PID
+    with _CLIENT_LOCK:
+        if _CLIENT_PID != os.getpid():
+            _CLIENT = pymongo.MongoClient(MONGO_URL)
+            _CLIENT_PID = os.getpid()
+        return _CLIENT
+
+
+class ProcessLocalDatabase:
+    """
+    the database through the client of the current process
+    """
+    def __getitem__(self, name):
+        return get_mongo_client()[MONGO_DB_NAME][name]
+
+    def __getattr__(self, attr):
+        return getattr(get_mongo_client()[MONGO_DB_NAME], attr)
+
+
+class ProcessLocalCollection:
+    """
+    the collection through the client of the current process
+    """
+    def __init__(self, name):
+        self.name = name
+        self.collection = None
+        self.pid = None
 
-WORD_COLLECTION = MONGO_DB['words']
+    def __getattr__(self, attr):
+        if self.pid != os.getpid():
+            self.collection = get_mongo_client()[MONGO_DB_NAME][self.name]
+            self.pid = os.getpid()
+        return getattr(self.collection, attr)
+
+
+MONGO_DB = ProcessLocalDatabase()
+
+# indexes of all collections are declared in db_indexes.py
+# and created with `python manage.py mongo_indexes --create`
+
+WORD_COLLECTION = ProcessLocalCollection('words')
 # WORD_COLLECTION.drop()
-WORD_COLLECTION.create_index('word')
 
-STANDARTIZATION_COLLECTION = MONGO_DB['standartizations']
+STANDARTIZATION_COLLECTION = ProcessLocalCollection('standartizations')
 # STANDARTIZATION_COLLECTION.drop()
-STANDARTIZATION_COLLECTION.create_index('word')
 
-SENTENCE_COLLECTION = MONGO_DB['sentences']
+SENTENCE_COLLECTION = ProcessLocalCollection('sentences')
 # SENTENCE_COLLECTION.drop()
+
+# one posting per word of every sentence, see search_engine/token_index.py
+TOKEN_COLLECTION = ProcessLocalCollection('tokens')
+# TOKEN_COLLECTION.drop()
+
+# service documents, e.g. write generation counters of search_engine/backends/mongo.py
+META_COLLECTION = ProcessLocalCollection('meta')
+# META_COLLECTION.drop()
+
+# processed EAF files and their contributions, see manifest.py
+MANIFEST_COLLECTION = ProcessLocalCollection('manifest')
+# MANIFEST_COLLECTION.drop()
@@ -0,0 +1,61 @@
+"""
+Per-process cache of editor sessions, keyed by user and recording.
+
+A session keeps the parsed EAF of the recording (in ElanToHTML) between requests of the editor,
+so that saves do not parse the file again. Warm standartizators for suggestions are kept
+per dialect by standartizator.StandartizatorRegistry.
+Before reuse the file is checked for changes made by other sessions or jobs
+(see ElanToHTML.reload_elan_if_changed). Sessions are evicted in LRU order
+when their estimated memory exceeds EDITOR_SESSION_BUDGET.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from trimco.settings import EDITOR_SESSION_BUDGET, EDITOR_SESSION_SIZE_FACTOR
+from .elan_to_html import ElanToHTML
+
+
+class EditorSession:
+    def __init__(self, recording):
+        self.converter = ElanToHTML(recording)
+        self.size = os.path.getsize(recording.data.path) * EDITOR_SESSION_SIZE_FACTOR
+        # requests of one session (e.g. from two tabs) do not use the parsed elan at the same time
+        self.lock = threading.Lock()
+
+
+class EditorSessionCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.sessions = OrderedDict()  # {(user id, recording id): EditorSession}
+        self.lock = threading.Lock()
+
+    def get(self, user_id, recording):
+        key = (user_id, recording.pk)
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is not None and session.converter.path == recording.data.path:
+                self.sessions.move_to_end(key)
+                session.converter.set_recording(recording)  # metadata could be changed in the admin
+                return session
+
+        session = EditorSession(recording)  # parsed outside of the lock
+        with self.lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            self._evict()
+        return session
+
+    def _evict(self):
+        total = sum(session.size for session in self.sessions.values())
+        while total > self.budget and len(self.sessions) > 1:
+            _, session = self.sessions.popitem(last=False)
+            total -= session.size
+
+    def discard(self, user_id, recording_id):
+        with self.lock:
+            self.sessions.pop((user_id, recording_id), None)
+
+
+editor_sessions = EditorSessionCache(EDITOR_SESSION_BUDGET)
@@ -1,171 +1,302 @@
-import datetime
-import os
-from lxml import etree
-from django.conf import settings
-
-from .standartizator import Standartizator
-from .elan_utils import ElanObject, clean_transcription
-from .format_utils import (
-    ANNOTATION_WORD_SEP, ANNOTATION_PART_SEP,
-    get_audio_annot_div, get_annot_div,
-    get_participant_tag_and_status
-)
-from ..search_engine.search_backend import saved_recording_to_db
-
-
-class ElanToHTML:
-    def __init__(self, file_obj, mode='', _format=''):
-        self.file_obj = file_obj  # file_obj is a Recording
-        self.elan_obj = ElanObject(self.file_obj.data.path)
-        self.audio_file_path = self.file_obj.audio.name
-        self.path = self.file_obj.data.path
-        self.format = _format
-        self.mode = mode
-        self.dialect = self.file_obj.to_dialect  # gets 'Dialect' field of recording
-
-    def build_page(self):
-        if self.mode in ['auto-annotation', 'auto-grammar']:
-            do_standartization = True if self.mode == 'auto-annotation' else False
-            # before building html, auto-annotation of the whole elan is performed
-            self.make_backup()
-            self.reannotate_elan(do_standartization=do_standartization)
-            # change 'auto_annotated' status of recording to True after performing automatic annotation
-            self.change_status_and_save()
-            saved_recording_to_db(
-                eaf_path=self.path,
-                audio_path=self.audio_file_path,
-                dialect=self.dialect.id
-            )
-
-        self.build_html()
-
-    def make_backup(self):
-        print('Creating backup of current annotation')
-        now = datetime.datetime.now()
-        cur = now.strftime("%Y-%m-%d_%H%M")
-        new_file = '{}_backup_{}.eaf'.format(str(self.path).split('/')[-1][:-4], cur)
-        os.system('mkdir -p {}/backups'.format(settings.MEDIA_ROOT))
-        os.system('cp {} {}/backups/{}'.format(self.path, settings.MEDIA_ROOT, new_file))
-
-    def change_status_and_save(self):
-        self.elan_obj.save()
-        self.file_obj.auto_annotated = True
-        self.file_obj.save()
-
-    def _get_standartization_for_annot(self, tier_name, annot_data):
-        normz_tokens_dict = self.get_additional_tags_dict(tier_name + '_standartization', annot_data[0], annot_data[1])
-        normz_sorted = sorted(normz_tokens_dict.items())
-        standartization = [item[1][0] for item in normz_sorted]
-        return standartization
-
-    def reannotate_elan(self, do_standartization=True):
-        standartizator = Standartizator(self.dialect)
-
-        tier_names = []
-        starts = []
-        ends = []
-        transcripts = []
-        standartizations = []
-
-        for annot_data in self.elan_obj.annot_data_lst:
-            tier_name = annot_data[3]
-            tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
-            if tier_obj.attributes['TIER_ID'] != 'comment':
-                start, end, transcript = annot_data[0], annot_data[1], clean_transcription(annot_data[2].strip())
-                tier_names.append(tier_name)
-                starts.append(start)
-                ends.append(end)
-                transcripts.append(transcript)
-
-                if not do_standartization:
-                    spl_text = transcript.split() or ['']
-                    standartization = self._get_standartization_for_annot(tier_name, annot_data)
-                    assert standartization, 'do_standartization is False, but no standartizations in eaf'
-                    assert len(standartization) == len(spl_text), \
-                        'transcript and standartizations do not match:' + str(standartization) + ' ' + str(spl_text)
-                    standartizations.append(list(zip(spl_text, standartization)))
-
-        transcript = '\n'.join(transcripts)
-        annotations = standartizator.get_annotation(transcript, standartizations=standartizations or None)
-        self.elan_obj.update_anns(tier_names, starts, ends, annotations)
-
-    def build_html(self):
-        print('Transcription > Standard learning examples:', self.file_obj.data.path)
-
-        i = 0
-        html = ""
-
-        for annot_data in self.elan_obj.annot_data_lst:
-            tier_name = annot_data[3]
-            tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
-            tier_id = tier_obj.attributes['TIER_ID']
-            if tier_id == 'comment':
-                continue
-
-            transcript = annot_data[2]
-            if not transcript:
-                continue
-
-            normz_tokens_dict = self.get_additional_tags_dict(tier_name+'_standartization', annot_data[0], annot_data[1])
-            annot_tokens_dict = self.get_additional_tags_dict(tier_name+'_annotation', annot_data[0], annot_data[1])
-            participant, tier_status = get_participant_tag_and_status(tier_obj.attributes['PARTICIPANT'], tier_id)
-            audio_div = get_audio_annot_div(annot_data[0], annot_data[1], self.audio_file_path)
-            annot_div = get_annot_div(
-                tier_name, self.dialect.id, participant, transcript, normz_tokens_dict, annot_tokens_dict,
-                elan_file=str(self.path).rsplit('/', 1)[-1]
-            )
-            html += '<div class="annot_wrapper %s">%s%s</div>' % (tier_status, audio_div, annot_div)
-            i += 1
-
-        self.html = '<div class="eaf_display">%s</div>' % html
-
-    def collect_examples(self):
-        """
-        collects pairs <transcribed sentence> - <normalized sentence> from elan-file
-        it's needed to retrain normalization models
-        returns list of ('transcription', 'normalization')
-        """
-        examples = []
-
-        for annot_data in self.elan_obj.annot_data_lst:
-            tier_name = annot_data[3]
-            tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
-            if tier_obj.attributes['TIER_ID'] != 'comment':
-                transcription = annot_data[2]
-                normalization = ' '.join(self._get_standartization_for_annot(tier_name, annot_data))
-                examples.append((transcription, normalization))
-
-        return examples
-        
-    def get_additional_tags_dict(self, tier_name, start, end):
-        tokens_dict = {}
-
-        try:
-            nrm_annot_lst = self.elan_obj.Eaf.get_annotation_data_at_time(tier_name, (start+end) / 2)
-            if not nrm_annot_lst:
-                return tokens_dict
-
-            nrm_annot = nrm_annot_lst[0][-1].split(ANNOTATION_WORD_SEP)
-            for el in nrm_annot:
-                el = el.split(ANNOTATION_PART_SEP)
-                tokens_dict[int(el[0])] = el[1:]
-
-        except KeyError:
-            pass
-
-        return tokens_dict
-
-    def save_html_to_elan(self, html):
-        html_obj = etree.fromstring(html)
-        for el in html_obj.xpath('//*[contains(@class,"annot_wrapper")]'):
-            self.elan_obj.process_html_annot(el)
-        self.elan_obj.save()
-
-    @staticmethod
-    def save_html_extracts_to_elans(html):
-        html_obj = etree.fromstring(html)
-        for el in html_obj.xpath('//*[contains(@class, "annot_wrapper") and contains(@class, "changed")]'):
-            elan_name = el.xpath('*[@class="annot"]/@elan')[0]
-            elan_obj = ElanObject(os.path.join(settings.MEDIA_ROOT, elan_name))
-            elan_obj.process_html_annot(el)
-            elan_obj.save()
+import datetime
+import os
+import shutil
+import bisect
+from decimal import Decimal
+from collections import defaultdict
+from lxml import etree
+from django.conf import settings
+
+from .standartizator import get_standartizator
+from .morph_cache import morph_cache
+from .elan_utils import ElanObject, clean_transcription, get_file_stat
+from .locks import recording_lock, recording_locks
+from .format_utils import (
+    ANNOTATION_WORD_SEP, ANNOTATION_PART_SEP,
+    get_audio_annot_div, get_annot_div,
+    get_participant_tag_and_status
+)
+from ..search_engine.search_backend import saved_recording_to_db
+
+
+def save_html_extracts_to_elan(elan_name, extracts):
+    """
+    applies all changed annot_wrapper elements of one elan and saves it once
+    """
+    elan_obj = ElanObject(os.path.join(settings.MEDIA_ROOT, elan_name))
+    for extract in extracts:
+        elan_obj.process_html_annot(extract)
+    elan_obj.save()
+
+
+class ElanToHTML:
+    def __init__(self, file_obj, mode='', _format=''):
+        self.set_recording(file_obj)
+        self.path = self.file_obj.data.path
+        self.format = _format
+        self.mode = mode
+        self.load_elan()
+
+    def set_recording(self, file_obj):
+        self.file_obj = file_obj  # file_obj is a Recording
+        self.audio_file_path = self.file_obj.audio.name
+        self.dialect = self.file_obj.to_dialect  # gets 'Dialect' field of recording
+
+    def load_elan(self):
+        # stat is taken before parsing, so that changes made during parsing are noticed later
+        self.elan_stat = get_file_stat(self.path)
+        self.elan_obj = ElanObject(self.path)
+        self.blocks = None  # see get_blocks
+
+    def reload_elan_if_changed(self):
+        """
+        the parsed elan is kept between requests of the editor (see editor_sessions.py)
+        and parsed again only if the file was written by someone else meanwhile
+        """
+        if self.elan_stat is None or get_file_stat(self.path) != self.elan_stat:
+            self.load_elan()
+
+    def save_elan(self):
+        try:
+            self.elan_obj.save()
+        except Exception:
+            self.elan_stat = None  # the file could be written partially
+            raise
+        self.elan_stat = get_file_stat(self.path)
+
+    def build_page(self):
+        if self.mode in ['auto-annotation', 'auto-grammar']:
+            # before building html, auto-annotation of the whole elan is performed
+            self.auto_annotate()
+
+        self.build_html()
+
+    def auto_annotate(self):
+        do_standartization = True if self.mode == 'auto-annotation' else False
+        # waits for saves of the editor, the file is read again as it could be changed meanwhile
+        with recording_lock(os.path.basename(self.path), owner=self.mode, timeout=None):
+            self.reload_elan_if_changed()
+            self.make_backup()
+            self.reannotate_elan(do_standartization=do_standartization)
+            # change 'auto_annotated' status of recording to True after performing automatic annotation
+            self.change_status_and_save()
+            saved_recording_to_db(
+                eaf_path=self.path,
+                audio_path=self.audio_file_path,
+                dialect=self.dialect.id
+            )
+
+    def make_backup(self):
+        print('Creating backup of current annotation')
+        now = datetime.datetime.now()
+        cur = now.strftime("%Y-%m-%d_%H%M")
+        new_file = '{}_backup_{}.eaf'.format(str(self.path).split('/')[-1][:-4], cur)
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'backups'), exist_ok=True)
+        shutil.copy2(self.path, os.path.join(settings.MEDIA_ROOT, 'backups', new_file))
+
+    def change_status_and_save(self):
+        self.save_elan()
+        self.file_obj.auto_annotated = True
+        self.file_obj.save()
+
+    def _get_standartization_for_annot(self, tier_name, annot_data):
+        normz_tokens_dict = self.get_additional_tags_dict(tier_name + '_standartization', annot_data[0], annot_data[1])
+        normz_sorted = sorted(normz_tokens_dict.items())
+        standartization = [item[1][0] for item in normz_sorted]
+        return standartization
+
+    def reannotate_elan(self, do_standartization=True):
+        standartizator = get_standartizator(self.dialect)
+
+        tier_names = []
+        starts = []
+        ends = []
+        transcripts = []
+        standartizations = []
+
+        for annot_data in self.elan_obj.annot_data_lst:
+            tier_name = annot_data[3]
+            tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
+            if tier_obj.attributes['TIER_ID'] != 'comment':
+                start, end, transcript = annot_data[0], annot_data[1], clean_transcription(annot_data[2].strip())
+                tier_names.append(tier_name)
+                starts.append(start)
+                ends.append(end)
+                transcripts.append(transcript)
+
+                if not do_standartization:
+                    spl_text = transcript.split() or ['']
+                    standartization = self._get_standartization_for_annot(tier_name, annot_data)
+                    assert standartization, 'do_standartization is False, but no standartizations in eaf'
+                    assert len(standartization) == len(spl_text), \
+                        'transcript and standartizations do not match:' + str(standartization) + ' ' + str(spl_text)
+                    standartizations.append(list(zip(spl_text, standartization)))
+
+        transcript = '\n'.join(transcripts)
+        annotations = standartizator.get_annotation(transcript, standartizations=standartizations or None)
+        self.elan_obj.update_anns(tier_names, starts, ends, annotations)
+        print('Morphology cache:', morph_cache.format_stats())
+        morph_cache.flush()  # worker processes of reannotation.py exit without atexit handlers
+
+    def get_blocks(self):
+        """
+        annotations shown in the editor, ordered by start. they are found once per parse of the elan,
+        as saves of the editor only change dependent tiers
+        """
+        if self.blocks is None:
+            self.blocks = []
+            for annot_data in self.elan_obj.annot_data_lst:
+                tier_obj = self.elan_obj.get_tier_obj_by_name(annot_data[3])
+                if tier_obj.attributes['TIER_ID'] == 'comment' or not annot_data[2]:
+                    continue
+                self.blocks.append(annot_data)
+            self.block_starts = [annot_data[0] for annot_data in self.blocks]
+        return self.blocks
+
+    def render_block(self, annot_data):
+        start, end, transcript, tier_name = annot_data
+        tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
+        normz_tokens_dict = self.get_additional_tags_dict(tier_name+'_standartization', start, end)
+        annot_tokens_dict = self.get_additional_tags_dict(tier_name+'_annotation', start, end)
+        participant, tier_status = get_participant_tag_and_status(
+            tier_obj.attributes['PARTICIPANT'], tier_obj.attributes['TIER_ID']
+        )
+        audio_div = get_audio_annot_div(start, end, self.audio_file_path)
+        annot_div = get_annot_div(
+            tier_name, self.dialect.id, participant, transcript, normz_tokens_dict, annot_tokens_dict,
+            elan_file=str(self.path).rsplit('/', 1)[-1]
+        )
+        return '<div class="annot_wrapper %s">%s%s</div>' % (tier_status, audio_div, annot_div)
+
+    def build_html(self):
+        print('Transcription > Standard learning examples:', self.file_obj.data.path)
+        html = ''.join(self.render_block(annot_data) for annot_data in self.get_blocks())
+        self.html = '<div class="eaf_display">%s</div>' % html
+
+    def find_block(self, time):
+        """
+        index of the block spoken at the time (ms) or of the next one
+        """
+        blocks = self.get_blocks()
+        i = bisect.bisect_right(self.block_starts, time) - 1
+        if i < 0:
+            return 0
+        if blocks[i][1] < time:
+            return min(i + 1, len(blocks) - 1)
+        return i
+
+    def build_window(self, first, count):
+        """
+        html of blocks from first to first + count, returns (html, first, last) with last block excluded
+        """
+        blocks = self.get_blocks()
+        first = min(max(first, 0), len(blocks))
+        last = min(first + max(count, 0), len(blocks))
+        return ''.join(self.render_block(annot_data) for annot_data in blocks[first:last]), first, last
+
+    def build_html_window(self, first, count):
+        """
+        like build_html, but only a window of blocks is rendered,
+        the editor loads the others when they are scrolled to (see load_editor_window in trimco.js)
+        """
+        html, first, last = self.build_window(first, count)
+        self.html = '<div class="eaf_display" first="%d" last="%d" total="%d" window="%d">%s</div>' % (
+            first, last, len(self.blocks), count, html
+        )
+
+    def collect_examples(self):
+        """
+        collects pairs <transcribed sentence> - <normalized sentence> from elan-file
+        it's needed to retrain normalization models
+        returns list of ('transcription', 'normalization')
+        """
+        examples = []
+
+        for annot_data in self.elan_obj.annot_data_lst:
+            tier_name = annot_data[3]
+            tier_obj = self.elan_obj.get_tier_obj_by_name(tier_name)
+            if tier_obj.attributes['TIER_ID'] != 'comment':
+                transcription = annot_data[2]
+                normalization = ' '.join(self._get_standartization_for_annot(tier_name, annot_data))
+                examples.append((transcription, normalization))
+
+        return examples
+        
+    def get_additional_tags_dict(self, tier_name, start, end):
+        tokens_dict = {}
+
+        nrm_annot = self.elan_obj.get_child_annotation_value(tier_name, start, end)
+        if not nrm_annot:
+            return tokens_dict
+
+        for el in nrm_annot.split(ANNOTATION_WORD_SEP):
+            el = el.split(ANNOTATION_PART_SEP)
+            tokens_dict[int(el[0])] = el[1:]
+
+        return tokens_dict
+
+    def save_html_to_elan(self, html, owner=''):
+        html_obj = etree.fromstring(html)
+        with recording_lock(os.path.basename(self.path), owner=owner):
+            self.reload_elan_if_changed()
+            try:
+                for el in html_obj.xpath('//*[contains(@class,"annot_wrapper")]'):
+                    self.elan_obj.process_html_annot(el)
+            except Exception:
+                self.elan_stat = None  # the parsed elan is changed partially, it is parsed again next time
+                raise
+            self.save_elan()
+            # sentences are synced before the lock is released, so that saves of the file are indexed in order
+            saved_recording_to_db(
+                eaf_path=self.path,
+                audio_path=self.audio_file_path,
+                html=html,
+                dialect=self.dialect.id
+            )
+
+    def save_patch_to_elan(self, patch, owner=''):
+        """
+        patch is a list of annotations changed in the editor, {'tier', 'start', 'end', 'tokens'} each.
+        returns (tier, start, end, transcript, standartization, annotation) of them after saving
+        """
+        changes = [
+            (annot['tier'], int(Decimal(str(annot['start']))), int(Decimal(str(annot['end']))), annot['tokens'])
+            for annot in patch
+        ]
+        saved = []
+        with recording_lock(os.path.basename(self.path), owner=owner):
+            self.reload_elan_if_changed()
+            for tier_name, start, end, tokens in changes:
+                if self.elan_obj.get_annotation_value(tier_name, start, end) is None:
+                    raise KeyError('%s has no annotation %s %d-%d' % (self.path, tier_name, start, end))
+
+            try:
+                for tier_name, start, end, tokens in changes:
+                    self.elan_obj.process_patch_annot(tier_name, start, end, tokens)
+                    saved.append((tier_name, start, end) + self.elan_obj.get_annotation_values(tier_name, start, end))
+            except Exception:
+                self.elan_stat = None  # the parsed elan is changed partially, it is parsed again next time
+                raise
+            self.save_elan()
+            saved_recording_to_db(
+                eaf_path=self.path,
+                audio_path=self.audio_file_path,
+                changed=saved,
+                dialect=self.dialect.id
+            )
+
+        return saved
+
+    @staticmethod
+    def save_html_extracts_to_elans(html, owner=''):
+        html_obj = etree.fromstring(html)
+        extracts_by_elan = defaultdict(list)
+        for el in html_obj.xpath('//*[contains(@class, "annot_wrapper") and contains(@class, "changed")]'):
+            elan_name = el.xpath('*[@class="annot"]/@elan')[0]
+            extracts_by_elan[elan_name].append(el)
+
+        # every file is parsed and saved once. this runs within a web request,
+        # so files are processed one by one instead of starting worker processes
+        with recording_locks(extracts_by_elan.keys(), owner=owner):
+            for elan_name, extracts in extracts_by_elan.items():
+                save_html_extracts_to_elan(elan_name, extracts)
@@ -1,4 +1,6 @@
 import os
+import bisect
+import threading
 from decimal import Decimal
 from pympi import Eaf, Elan
 from .format_utils import (
@@ -34,6 +36,8 @@ class ElanObject:
         self.path = path_to_file
         self.Eaf = Eaf(path_to_file)
         self.Eaf.clean_time_slots()
+        self.annotation_index = {}  # {tier name: {(start, end): annotation id}}, see get_annotation_index
+        self.interval_index = {}  # {tier name: (starts, [(start, end, annotation id)])}, see get_interval_index
         self.load_tiers()
         self.load_annotation_data()
         self.load_participants()
@@ -56,6 +60,7 @@ class ElanObject:
         for tier_name, tier_info in self.Eaf.tiers.items():
             tiers_lst.append(Tier(tier_name, tier_info))
         self.tiers_lst = sorted(tiers_lst, key=lambda data: data.ordinal)
+        self.tiers_dict = {tier_obj.name: tier_obj for tier_obj in self.tiers_lst}
 
     def load_annotation_data(self):
         annot_data_lst = []
@@ -66,10 +71,49 @@ class ElanObject:
         self.annot_data_lst = sorted(annot_data_lst, key=lambda data: data[0])
 
     def get_tier_obj_by_name(self, tier_name):
-        for tier_obj in self.tiers_lst:
-            if tier_obj.name == tier_name:
-                return tier_obj
-        return None
+        return self.tiers_dict.get(tier_name)
+
+    def get_annotation_index(self, tier_name):
+        """
+        {(start, end): annotation id} of an aligned tier, built on first use and kept up to date by add_extra_tags.
+        annotations of dependent tiers have the times of their parent annotations, so they are found without scans
+        """
+        index = self.annotation_index.get(tier_name)
+        if index is None:
+            timeslots = self.Eaf.timeslots
+            index = {
+                (timeslots[ann[0]], timeslots[ann[1]]): annotation_id
+                for annotation_id, ann in self.Eaf.tiers[tier_name][0].items()
+            }
+            self.annotation_index[tier_name] = index
+        return index
+
+    def get_interval_index(self, tier_name):
+        """
+        annotations of an aligned tier sorted by start, for annotations with times different from their parents
+        """
+        index = self.interval_index.get(tier_name)
+        if index is None:
+            intervals = sorted(
+                (start, end, annotation_id)
+                for (start, end), annotation_id in self.get_annotation_index(tier_name).items()
+            )
+            index = ([interval[0] for interval in intervals], intervals)
+            self.interval_index[tier_name] = index
+        return index
+
+    def remove_annotation(self, tier_name, start, end):
+        """
+        same as Eaf.remove_annotation at the middle of the annotation,
+        unused timeslots are removed once in save instead of after every annotation
+        """
+        annotation_id = self.get_annotation_index(tier_name).pop((start, end), None)
+        if annotation_id is not None:
+            del self.Eaf.tiers[tier_name][0][annotation_id]
+            self.Eaf.annotations.pop(annotation_id, None)
+        elif self.Eaf.remove_annotation(tier_name, (start + end) / 2, clean=False):
+            del self.annotation_index[tier_name]  # built again on next use
+        self.interval_index.pop(tier_name, None)
 
     def add_extra_tags(self, parent_tier_name, start, end, value, typ):
         if typ == 'annotation':
@@ -85,22 +129,25 @@ class ElanObject:
             self.Eaf.add_tier(tier_name, ling=ling, parent=parent_tier_name)
             self.load_tiers()
 
-        try:
-            self.Eaf.remove_annotation(tier_name, (start + end) / 2, clean=True)
-        except KeyError:
-            pass
-
+        self.remove_annotation(tier_name, start, end)
         self.Eaf.add_annotation(tier_name, start, end, value)
+        # the id given by Eaf.generate_annotation_id
+        self.get_annotation_index(tier_name)[(start, end)] = 'a{:d}'.format(self.Eaf.maxaid)
+        self.interval_index.pop(tier_name, None)
 
     def save(self):
+        """
+        the eaf is written to a temporary file which then replaces it,
+        so that readers and concurrent writers never see a partially written file
+        """
         self.Eaf.clean_time_slots()
+        tmp_path = '%s.%d-%d.tmp' % (self.path, os.getpid(), threading.get_ident())
         try:
-            os.remove(self.path + '.bak')
-        except OSError:
-            pass
-
-        Elan.to_eaf(self.path, self.Eaf, pretty=True)
-        os.remove(self.path + '.bak')
+            Elan.to_eaf(tmp_path, self.Eaf, pretty=True)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     def _update_ann(self, tier_name, start, end, annot_value_lst, nrm_value_lst):
         if annot_value_lst:
@@ -143,6 +190,73 @@ class ElanObject:
 
         self._update_ann(tier_name, start, end, annot_value_lst, nrm_value_lst)
 
+    def get_annotation_value(self, tier_name, start, end):
+        """
+        value of the annotation of the tier with exactly these times, None if there is none
+        """
+        if tier_name not in self.Eaf.tiers:
+            return None
+
+        annotation_id = self.get_annotation_index(tier_name).get((start, end))
+        if annotation_id is None:
+            return None
+        return self.Eaf.tiers[tier_name][0][annotation_id][2]
+
+    def get_child_annotation_value(self, tier_name, start, end):
+        """
+        value of the annotation of a dependent tier for the parent annotation from start to end:
+        the one with the same times, else the one at the middle of the parent, None if there is none
+        """
+        value = self.get_annotation_value(tier_name, start, end)
+        if value is not None or tier_name not in self.Eaf.tiers:
+            return value
+
+        time = (start + end) / 2
+        if self.Eaf.tiers[tier_name][1]:  # reference annotations are not indexed
+            annot_lst = self.Eaf.get_annotation_data_at_time(tier_name, time)
+            return annot_lst[0][-1] if annot_lst else None
+
+        starts, intervals = self.get_interval_index(tier_name)
+        i = bisect.bisect_right(starts, time) - 1
+        if i >= 0 and intervals[i][1] >= time:
+            return self.Eaf.tiers[tier_name][0][intervals[i][2]][2]
+        return None
+
+    def get_annotation_values(self, tier_name, start, end):
+        """
+        (transcript, standartization, annotation) of an annotation of a top level tier
+        """
+        return (
+            self.get_annotation_value(tier_name, start, end),
+            self.get_child_annotation_value(tier_name + '_standartization', start, end),
+            self.get_child_annotation_value(tier_name + '_annotation', start, end),
+        )
+
+    def process_patch_annot(self, tier_name, start, end, tokens):
+        """
+        same as process_html_annot for an annotation changed in the editor,
+        tokens are {'nrm', 'lemma', 'morph'} of all tokens of the annotation in order
+        """
+        annot_value_lst = []
+        nrm_value_lst = []
+
+        for t_counter, token in enumerate(tokens):
+            nrm = token.get('nrm')
+            lemma = token.get('lemma')
+            morph = token.get('morph')
+
+            if lemma and morph:
+                annot_value_lst.append(ANNOTATION_PART_SEP.join([str(t_counter), lemma, morph]))
+            elif lemma or morph:
+                print(
+                    'Exception while saving. Normalization: %s,'
+                    'Lemmata: %s, Morphology: %s, Counter: %s' % (nrm, lemma, morph, t_counter)
+                )
+            if nrm:
+                nrm_value_lst.append(ANNOTATION_PART_SEP.join([str(t_counter), nrm]))
+
+        self._update_ann(tier_name, start, end, annot_value_lst, nrm_value_lst)
+
     def update_anns(self, tier_names, starts, ends, annotations):
         for tier_name, start, end, annotation in zip(tier_names, starts, ends, annotations):
             annot_value_lst = []
@@ -166,6 +280,14 @@ class ElanObject:
             self._update_ann(tier_name, start, end, annot_value_lst, nrm_value_lst)
 
 
+def get_file_stat(path):
+    """
+    changes whenever the file is written, as ElanObject.save replaces it with a new file
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
 def clean_transcription(transcription):
     return TECH_REGEX.sub('', transcription).strip()
 
@@ -1,5 +1,5 @@
 import re
-from lxml import etree
+import html
 
 
 ANNOTATION_WORD_SEP = '|'
@@ -12,6 +12,8 @@ STANDARTIZATION_NUM_REGEX = re.compile(r'^(\d+):(.+)')
 ANNOTATION_NUM_REGEX = re.compile(r'(\d+?):(.+?):(.+)')
 
 TECH_REGEX = re.compile(r'(?:\.\.\.|\?|\[|]|\.|!|un\'?int\.?)+')
+BRACKETS_REGEX = re.compile(r'[\[\]]')
+LATIN_REGEX = re.compile('[a-zA-Z]')
 
 
 def get_participant_status(tier_name):
@@ -36,71 +38,104 @@ def get_audio_annot_div(stttime, endtime, audio_file_path):
     )
 
 
-def prettify_transcript(transcript):
+def split_transcript(transcript):
+    """
+    yields (tag, text) for elements of transcript, tag is one of 'token', 'tech' and 'note'
+    """
     if not transcript[-1].strip():
         transcript = transcript[:-1]
 
-    new_transcript = ''
-    tokens_lst = re.split('([ ])', transcript)
-
-    for el in tokens_lst:
+    for el in transcript.split(' '):
         el = el.strip()
         if not el:
             continue
 
         if el in ['...', '?', '!']:
-            new_el = '<tech>%s</tech>' % el
+            yield 'tech', el
 
         elif el[-1] in ['?', '!']:
-            new_el = '<token><trt>%s</trt></token><tech>%s</tech>' % (el[:-1], el[-1])
+            yield 'token', el[:-1]
+            yield 'tech', el[-1]
 
         elif '[' in el and ']' in el:
-            new_el = ''
-
-            for el_2 in re.split(r'[\[\]]', el):  # splitting [ ]
-                if not re.match('[a-zA-Z]', el_2):
+            for el_2 in BRACKETS_REGEX.split(el):  # splitting [ ]
+                if not LATIN_REGEX.match(el_2):
                     continue  # removing non-alphabetic values
 
                 if 'unint' in el_2 or '.' in el_2:
-                    new_el += '<note>%s.</note>' % el_2.strip('.')
+                    yield 'note', el_2.strip('.') + '.'
                 else:
-                    new_el += '<token><trt>%s</trt></token>' % el_2
+                    yield 'token', el_2
 
         else:
-            new_el = '<token><trt>%s</trt></token>' % el
-
-        new_transcript += new_el
+            yield 'token', el
 
-    return new_transcript
 
-
-def add_annotation_to_transcript(transcript, normz_tokens_dict, annot_tokens_dict):
+def prettify_transcript(transcript):
+    buf = []
+    for tag, text in split_transcript(transcript):
+        if tag == 'token':
+            buf.append('<token><trt>%s</trt></token>' % text)
+        else:
+            buf.append('<%s>%s</%s>' % (tag, text, tag))
+    return ''.join(buf)
+
+
+def xml_text(text):
+    """
+    escapes text the same way as lxml does when serializing to ascii
+    """
+    if '&' in text:
+        text = html.unescape(text)
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+    return text.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+
+def xml_element(tag, text):
+    text = xml_text(text)
+    if not text:
+        return '<%s/>' % tag
+    return '<%s>%s</%s>' % (tag, text, tag)
+
+
+def render_transcript(transcript, normz_tokens_dict, annot_tokens_dict):
+    """
+    renders transcript to <token><nrm/><lemma/><morph/><trt/></token>, <tech/> and <note/> elements
+    in one pass. normalizations and annotations are only shown if there are any annotations.
+    the output is the same as it was with parsing and serializing the transcript with lxml,
+    see scripts/benchmark_transcript_rendering.py
+    """
+    if not annot_tokens_dict:
+        return prettify_transcript(transcript)
+
+    buf = []
     i = 0
-    transcript_obj = etree.fromstring('<c>'+transcript+'</c>')
 
-    for tag in transcript_obj.iterchildren():
-        if tag.tag != 'token':
+    for tag, text in split_transcript(transcript):
+        if tag != 'token':
+            buf.append(xml_element(tag, text))
             continue
 
-        if i in annot_tokens_dict.keys():
-            morph = annot_tokens_dict[i][1]
-            tag.insert(0, etree.fromstring('<morph>' + morph + '</morph>'))
+        buf.append('<token>')
 
-            lemma = annot_tokens_dict[i][0]
-            tag.insert(0, etree.fromstring('<lemma>' + lemma + '</lemma>'))
+        normz = normz_tokens_dict.get(i)
+        if normz is not None:
+            buf.append(xml_element('nrm', normz[0]))
 
-        if i in normz_tokens_dict.keys():
-            tag.insert(0, etree.fromstring('<nrm>' + normz_tokens_dict[i][0] + '</nrm>'))
+        annot = annot_tokens_dict.get(i)
+        if annot is not None:
+            buf.append(xml_element('lemma', annot[0]))
+            buf.append(xml_element('morph', annot[1]))
 
+        buf.append(xml_element('trt', text))
+        buf.append('</token>')
         i += 1
 
-    return etree.tostring(transcript_obj)[3:-4].decode('utf-8')
+    return ''.join(buf)
 
 
 def get_annot_div(tier_name, dialect, participant, transcript, normz_tokens_dict, annot_tokens_dict, elan_file=None):
-    transcript = prettify_transcript(transcript)
-    if annot_tokens_dict:
-        transcript = add_annotation_to_transcript(transcript, normz_tokens_dict, annot_tokens_dict)
+    transcript = render_transcript(transcript, normz_tokens_dict, annot_tokens_dict)
 
     participant_div = '<span class="participant">%s</span>' % participant
     transcript_div = '<span class="transcript">%s</span>' % transcript
@@ -0,0 +1,187 @@
+"""
+Job queue for operations that are too long for a request:
+auto-annotation of a recording, reannotation of all unchecked recordings and retraining of a normalizer model.
+
+Jobs are rows of corpora.models.Job in the project database.
+Views enqueue them and poll their status, worker processes of `manage.py run_jobs`
+claim queued jobs with a conditional update, so a job is never run twice.
+"""
+
+import json
+import time
+import socket
+import traceback
+
+from django.db import connections
+from django.utils import timezone
+
+from corpora.models import Job, Recording
+from normalization.models import Model
+from .elan_to_html import ElanToHTML
+from .standartizator import Standartizator
+from .reannotation import reannotate_recordings
+from .locks import get_worker_name, is_process_alive
+
+
+JOB_POLL_INTERVAL = 1  # seconds between checks for new jobs in an idle worker
+
+
+class JobContext:
+    """
+    passed to job handlers to report progress and per-recording results
+    """
+    def __init__(self, job):
+        self.job = job
+        self.items = []
+
+    def set_total(self, total):
+        Job.objects.filter(pk=self.job.pk).update(total=total)
+
+    def add_item(self, recording, seconds, error=None):
+        self.items.append({'recording': recording, 'seconds': round(seconds, 3), 'error': error})
+        Job.objects.filter(pk=self.job.pk).update(progress=len(self.items), items=json.dumps(self.items))
+
+    def run_for_recording(self, recording, func, *args):
+        """
+        calls func, records its time and error if any, returns whether it succeeded
+        """
+        start = time.perf_counter()
+        try:
+            func(*args)
+        except Exception:
+            print(traceback.format_exc())
+            self.add_item(recording, time.perf_counter() - start, traceback.format_exc(limit=3))
+            return False
+
+        self.add_item(recording, time.perf_counter() - start)
+        return True
+
+
+def auto_annotate_recording(context, recording_id, mode):
+    recording = Recording.objects.get(pk=recording_id)
+    context.set_total(1)
+    if not context.run_for_recording(recording.string_id, ElanToHTML(recording, mode=mode).auto_annotate):
+        raise Exception('auto-annotation of %s failed' % recording.string_id)
+    return 'Annotated %s' % recording.string_id
+
+
+def reannotate_grammar_all_unchecked(context):
+    unchecked_recs = Recording.objects.filter(auto_annotated=True, checked=False)
+    context.set_total(unchecked_recs.count())
+
+    n_reannotated = n_failed = 0
+    for report in reannotate_recordings(unchecked_recs, mode='auto-grammar'):
+        context.add_item(report.recording, report.seconds, report.error)
+        if report.error is None:
+            n_reannotated += 1
+        else:
+            n_failed += 1
+
+    return 'Reannotated %d recordings, %d errors' % (n_reannotated, n_failed)
+
+
+def retrain_normalizer_model(context, model_id):
+    model = Model.objects.get(pk=model_id)
+    recordings = [rec for rec in model.recordings_to_retrain.all() if rec.checked]
+    if not recordings:
+        return 'No checked recordings. Add manually checked recordings and try again'
+
+    context.set_total(len(recordings) + 1)
+    examples = []
+    for rec in recordings:
+        context.run_for_recording(rec.string_id, lambda: examples.extend(ElanToHTML(rec).collect_examples()))
+
+    standartizator = Standartizator(model.to_dialect.all()[0])
+    standartizator.make_backup()
+    standartizator.rewrite_files(examples)
+    start = time.perf_counter()
+    standartizator.retrain_model()
+    context.add_item('training of ' + model.name, time.perf_counter() - start)
+
+    # TODO: parse norm log to see success or error
+    return 'Retraining done. Check normalizer log to ensure no errors occurred.'
+
+
+# {kind: handler(context, **params) returning the result shown to the user}
+JOB_HANDLERS = {
+    'auto-annotation': lambda context, recording_id: auto_annotate_recording(context, recording_id, 'auto-annotation'),
+    'auto-grammar': lambda context, recording_id: auto_annotate_recording(context, recording_id, 'auto-grammar'),
+    'reannotate-grammar-all': reannotate_grammar_all_unchecked,
+    'retrain': retrain_normalizer_model,
+}
+
+
+def enqueue_job(kind, **params):
+    assert kind in JOB_HANDLERS, 'unknown job ' + kind
+    return Job.objects.create(kind=kind, params=json.dumps(params))
+
+
+def get_job_status(job_id):
+    job = Job.objects.get(pk=job_id)
+    return {
+        'id': job.pk,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress,
+        'total': job.total,
+        'items': json.loads(job.items),
+        'result': job.result,
+        'error': job.error,
+        'seconds': job.seconds(),
+    }
+
+
+def claim_job(worker):
+    """
+    returns the oldest queued job after marking it as running by the worker, or None
+    """
+    for job_id in Job.objects.filter(status='queued').order_by('created', 'pk').values_list('pk', flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status='queued').update(
+            status='running', worker=worker, started=timezone.now()
+        )
+        if claimed:
+            return Job.objects.get(pk=job_id)
+
+
+def run_job(job):
+    try:
+        result = JOB_HANDLERS[job.kind](JobContext(job), **json.loads(job.params))
+    except Exception:
+        print(traceback.format_exc())
+        Job.objects.filter(pk=job.pk).update(status='failed', error=traceback.format_exc(), finished=timezone.now())
+        return
+
+    Job.objects.filter(pk=job.pk).update(status='done', result=result or '', finished=timezone.now())
+
+
+def requeue_abandoned_jobs():
+    """
+    jobs left running by killed workers of this host are run again, returns their number
+    """
+    prefix = socket.gethostname() + ':'
+    abandoned = [
+        job_id
+        for job_id, worker in Job.objects.filter(status='running', worker__startswith=prefix).values_list('pk', 'worker')
+        if not is_process_alive(int(worker[len(prefix):]))
+    ]
+    return Job.objects.filter(pk__in=abandoned, status='running').update(status='queued', worker='', started=None)
+
+
+def run_worker(once=False):
+    """
+    runs queued jobs one by one, `once` stops the worker when no jobs are left
+    """
+    for connection in connections.all():
+        connection.close()  # connections inherited from the parent process can not be shared
+    worker = get_worker_name()
+
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            if once:
+                return
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+
+        print('%s: running %s' % (worker, job))
+        run_job(job)
@@ -0,0 +1,106 @@
+"""
+Per-recording locks for writes to EAF files.
+
+A lock is an exclusive flock on a file in LOCK_DIR, so it works across threads,
+WSGI worker processes and job workers of one host, and is released by the OS
+if its holder dies. Held locks are also listed in corpora.models.RecordingLock
+for operators; rows of dead holders are overwritten by the next holder.
+
+Reads (editor pages, search, suggestions, audio) take no locks,
+as EAF files are replaced atomically by ElanObject.save.
+"""
+
+import os
+import time
+import fcntl
+import socket
+import contextlib
+
+from django.utils import timezone
+
+from trimco.settings import LOCK_DIR, RECORDING_LOCK_TIMEOUT
+from corpora.models import RecordingLock
+
+
+class RecordingLocked(Exception):
+    def __init__(self, elan, holder=None):
+        self.elan = elan
+        self.holder = holder
+        super().__init__('%s is locked by %s' % (elan, holder or 'another process'))
+
+
+def get_worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_lock_alive(lock):
+    """
+    whether the holder of the RecordingLock row still runs, None if it runs on another host
+    """
+    host, pid = lock.worker.rsplit(':', 1)
+    if host != socket.gethostname():
+        return None
+    return is_process_alive(int(pid))
+
+
+def get_lock_holder(elan):
+    lock = RecordingLock.objects.filter(elan=elan).first()
+    if lock is None:
+        return None
+    return lock.owner or lock.worker
+
+
+def acquire_flock(f, elan, timeout):
+    if timeout is None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                raise RecordingLocked(elan, get_lock_holder(elan))
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def recording_lock(elan, owner='', timeout=RECORDING_LOCK_TIMEOUT):
+    """
+    exclusive lock of the eaf file name, raises RecordingLocked after timeout seconds (None to wait forever)
+    """
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    with open(os.path.join(LOCK_DIR, elan + '.lock'), 'a') as f:
+        acquire_flock(f, elan, timeout)
+        worker = get_worker_name()
+        try:
+            RecordingLock.objects.update_or_create(
+                elan=elan, defaults={'owner': owner, 'worker': worker, 'acquired': timezone.now()}
+            )
+            yield
+        finally:
+            RecordingLock.objects.filter(elan=elan, worker=worker).delete()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def recording_locks(elans, owner='', timeout=RECORDING_LOCK_TIMEOUT):
+    """
+    locks of several files, taken in sorted order so that two writers can not deadlock
+    """
+    with contextlib.ExitStack() as stack:
+        for elan in sorted(set(elans)):
+            stack.enter_context(recording_lock(elan, owner, timeout))
+        yield
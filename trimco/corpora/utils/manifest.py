@@ -0,0 +1,123 @@
+"""
+Manifest of EAF files that were processed into the database.
+
+One entry per EAF, keyed by the file name:
+    {'_id': eaf_filename, 'path', 'size', 'mtime', 'hash',
+     'sentences': {'hash', 'backend', 'audio', 'dialect', 'count'},
+     'words': {'hash', 'model', 'words', 'standartizations'}}
+
+Each part describes what was derived from the file and from which version of it,
+so that reindexing can skip unchanged files and retract exactly
+the contributions of changed or deleted ones.
+
+The 'sentences' part is kept by the search backend next to the sentences it describes
+(see SearchBackend.get_manifest), the 'words' part is kept in MANIFEST_COLLECTION
+together with the word list. An entry returned for a part has only the parts kept in the same place.
+"""
+
+import os
+import hashlib
+
+from .db_utils import MANIFEST_COLLECTION
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_file_state(path, entry=None):
+    """
+    returns {'path', 'size', 'mtime', 'hash'},
+    the file is not read again if its size and mtime are the same as in the entry
+    """
+    stat = os.stat(path)
+    state = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    if entry is not None and entry.get('size') == state['size'] and entry.get('mtime') == state['mtime']:
+        state['hash'] = entry['hash']
+    else:
+        state['hash'] = file_hash(path)
+
+    return state
+
+
+MANIFEST_PARTS = ('sentences', 'words')
+
+
+class MongoManifest:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, elan):
+        return self.collection.find_one({'_id': elan})
+
+    def get_all(self, part):
+        return {entry['_id']: entry for entry in self.collection.find({part: {'$exists': True}})}
+
+    def set_part(self, elan, part, state, values):
+        self.collection.update_one({'_id': elan}, {'$set': dict(state, **{part: values})}, upsert=True)
+
+    def unset_part(self, elan, part):
+        self.collection.update_one({'_id': elan}, {'$unset': {part: True}})
+        self.collection.delete_one(dict({'_id': elan}, **self.no_parts_filter()))
+
+    def unset_part_everywhere(self, part):
+        self.collection.update_many({}, {'$unset': {part: True}})
+        self.collection.delete_many(self.no_parts_filter())
+
+    @staticmethod
+    def no_parts_filter():
+        return {p: {'$exists': False} for p in MANIFEST_PARTS}
+
+
+MONGO_MANIFEST = MongoManifest(MANIFEST_COLLECTION)
+
+
+def get_manifest(part):
+    if part == 'sentences':
+        from corpora.search_engine.backends import get_search_backend  # backends use this module
+        return get_search_backend().get_manifest()
+    return MONGO_MANIFEST
+
+
+def get_entry(elan, part):
+    return get_manifest(part).get(elan)
+
+
+def get_entries(part):
+    return get_manifest(part).get_all(part)
+
+
+def is_derived_with(entry, part, **params):
+    """
+    whether the part of the entry was derived with the same params
+    """
+    if entry is None or part not in entry:
+        return False
+
+    derived = entry[part]
+    return all(derived.get(k) == v for k, v in params.items())
+
+
+def is_up_to_date(entry, part, state, **params):
+    """
+    whether the part of the entry was derived from the same file contents with the same params
+    """
+    return is_derived_with(entry, part, **params) and entry[part]['hash'] == state['hash']
+
+
+def set_part(elan, part, state, **values):
+    values['hash'] = state['hash']
+    get_manifest(part).set_part(elan, part, state, values)
+
+
+def unset_part(elan, part):
+    get_manifest(part).unset_part(elan, part)
+
+
+def unset_part_everywhere(part):
+    get_manifest(part).unset_part_everywhere(part)
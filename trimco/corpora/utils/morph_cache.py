@@ -0,0 +1,129 @@
+"""
+Memo of morphological analyses which are pure functions of a word,
+the version of the analyzer and the grammeme config (see annotation_menu.py).
+
+Values are kept in a bounded in-process LRU backed by an SQLite table,
+so they survive restarts and are shared by processes of reannotation runs.
+Keys include the analyzer version and the config hash,
+so values made with an older dictionary or config are never returned.
+"""
+
+import os
+import json
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import pymorphy2
+
+from trimco.settings import MORPH_CACHE_PATH, MORPH_CACHE_SIZE
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS memo (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+'''
+
+FLUSH_SIZE = 500  # new values are written to disk in batches
+
+
+def get_analyzer_version(morph):
+    meta = getattr(morph.dictionary, 'meta', None) or {}
+    return '%s/%s' % (pymorphy2.__version__, meta.get('compiled_at', ''))
+
+
+class MorphCache:
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.pending = {}  # {key: value} not written to disk yet
+        self.lock = threading.Lock()
+        self.local = threading.local()  # sqlite connections can not be shared between threads
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+    @property
+    def connection(self):
+        # a connection inherited by a forked worker process is not reused
+        pid, connection = getattr(self.local, 'connection', (None, None))
+        if connection is None or pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.executescript(SCHEMA)
+            self.local.connection = (os.getpid(), connection)
+        return connection
+
+    @staticmethod
+    def make_key(namespace, version, word):
+        return json.dumps([namespace, version, word], ensure_ascii=False)
+
+    def _remember(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def get(self, namespace, version, word, compute):
+        """
+        value of compute(word), which must be json serializable
+        """
+        key = self.make_key(namespace, version, word)
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.memory_hits += 1
+                return self.items[key]
+            stored = self.pending.get(key)
+
+        if stored is None:
+            row = self.connection.execute('SELECT value FROM memo WHERE key = ?', (key,)).fetchone()
+            stored = row[0] if row is not None else None
+
+        if stored is not None:
+            value = json.loads(stored)
+            with self.lock:
+                self.disk_hits += 1
+                self._remember(key, value)
+            return value
+
+        value = compute(word)
+        with self.lock:
+            self.misses += 1
+            self._remember(key, value)
+            self.pending[key] = json.dumps(value, ensure_ascii=False)
+            flush = len(self.pending) >= FLUSH_SIZE
+        if flush:
+            self.flush()
+        return value
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO memo (key, value) VALUES (?, ?)', pending.items())
+
+    def get_stats(self):
+        with self.lock:
+            n_lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / n_lookups if n_lookups else 0,
+            }
+
+    def format_stats(self):
+        return '{memory_hits} memory hits, {disk_hits} disk hits, {misses} misses ({hit_rate:.1%} hit rate)'.format(
+            **self.get_stats()
+        )
+
+
+morph_cache = MorphCache(MORPH_CACHE_PATH, MORPH_CACHE_SIZE)
+atexit.register(morph_cache.flush)
@@ -0,0 +1,167 @@
+"""
+Persistent csmtiser workers (see normalizer_worker.py), one per model.
+
+Requests to a worker can be sent from several threads at once:
+they are written to the worker's stdin with a unique id
+and responses are matched to them by a reader thread.
+
+Workers are keyed by the generation of their model stored in META_COLLECTION,
+so a model retrained in one process is reloaded by the workers of every process.
+"""
+
+import os
+import json
+import uuid
+import atexit
+import threading
+import subprocess
+import concurrent.futures
+
+from django.conf import settings
+
+from .db_utils import META_COLLECTION
+
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'normalizer_worker.py')
+
+
+class NormalizerError(Exception):
+    pass
+
+
+class NormalizerWorker:
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.process = subprocess.Popen(
+            [settings.NORMALIZER_PYTHON, WORKER_SCRIPT, settings.NORMALIZER_PATH, model_name],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=settings.NORMALIZER_PATH
+        )
+        self.write_lock = threading.Lock()
+        self.pending = {}  # {request id: future}
+        self.pending_lock = threading.Lock()
+
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def read_responses(self):
+        for line in self.process.stdout:
+            response = json.loads(line.decode('utf-8'))
+            with self.pending_lock:
+                future = self.pending.pop(response['id'], None)
+            if future is None:
+                continue
+
+            if 'error' in response:
+                future.set_exception(NormalizerError(response['error']))
+            else:
+                future.set_result(response['result'])
+
+        # worker exited, nobody is going to answer the remaining requests
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(NormalizerError('normalizer worker of %s exited' % self.model_name))
+
+    def normalize(self, text, timeout=None):
+        request_id = uuid.uuid4().hex
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending[request_id] = future
+
+        request = json.dumps({'id': request_id, 'text': text}, ensure_ascii=True) + '\n'
+        try:
+            with self.write_lock:
+                self.process.stdin.write(request.encode('utf-8'))
+                self.process.stdin.flush()
+        except OSError:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise NormalizerError('normalizer worker of %s is not running' % self.model_name)
+
+        return future.result(timeout=timeout)
+
+    def stop(self, kill=False):
+        """
+        kill is for a worker that hangs and would not notice its stdin is closed
+        """
+        if not kill:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+                return
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.process.kill()
+        self.process.wait()
+
+
+_WORKERS = {}  # {model name: (worker, model generation)}
+_WORKERS_LOCK = threading.Lock()
+
+
+def get_model_generation(model_name):
+    generation = META_COLLECTION.find_one({'_id': 'normalizer_model_generation:' + model_name})
+    return generation['value'] if generation is not None else 0
+
+
+def bump_model_generation(model_name):
+    """
+    workers of all processes load the model again on their next request, e.g. after it is retrained
+    """
+    META_COLLECTION.update_one(
+        {'_id': 'normalizer_model_generation:' + model_name}, {'$inc': {'value': 1}}, upsert=True
+    )
+
+
+def get_normalizer_worker(model_name):
+    generation = get_model_generation(model_name)
+    outdated = None
+
+    with _WORKERS_LOCK:
+        worker, worker_generation = _WORKERS.get(model_name, (None, None))
+        if worker is None or not worker.is_alive() or worker_generation != generation:
+            outdated = worker
+            worker = NormalizerWorker(model_name)
+            _WORKERS[model_name] = (worker, generation)
+
+    if outdated is not None:
+        outdated.stop()
+    return worker
+
+
+def stop_normalizer_worker(model_name, worker=None, kill=False):
+    """
+    the next request starts a new worker.
+    if worker is given, it is stopped only while it is still the current worker of the model
+    """
+    with _WORKERS_LOCK:
+        current = _WORKERS.get(model_name, (None, None))[0]
+        if current is None or worker is not None and current is not worker:
+            return
+        del _WORKERS[model_name]
+    current.stop(kill=kill)
+
+
+@atexit.register
+def stop_normalizer_workers():
+    for model_name in list(_WORKERS):
+        stop_normalizer_worker(model_name)
+
+
+def normalize_text(model_name, text, timeout=None):
+    """
+    returns contents of the .norm file made by csmtiser for the text.
+    a worker that does not answer in time (settings.NORMALIZER_TIMEOUT by default) is restarted
+    """
+    if timeout is None:
+        timeout = settings.NORMALIZER_TIMEOUT
+
+    worker = get_normalizer_worker(model_name)
+    try:
+        return worker.normalize(text, timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        stop_normalizer_worker(model_name, worker, kill=True)
+        raise NormalizerError('normalizer worker of %s did not answer in %s seconds' % (model_name, timeout))
@@ -0,0 +1,79 @@
+"""
+Long-lived csmtiser worker for one model, started by normalizer.py.
+
+Runs under the interpreter of csmtiser (python2) as well as python3
+and must not import anything from the project.
+
+Usage: normalizer_worker.py <path to csmtiser> <model name>
+
+Reads requests from stdin, one json object per line: {"id": ..., "text": ...}
+and writes responses to stdout: {"id": ..., "result": ...} or {"id": ..., "error": ...}.
+normalise.py is executed inside this process, so the interpreter and csmtiser modules
+are loaded once; every request gets its own temporary directory.
+"""
+
+import io
+import os
+import sys
+import json
+import runpy
+import shutil
+import tempfile
+import traceback
+
+
+def run_normalise(normalise_script, path, model_name):
+    cwd = os.getcwd()
+    argv = sys.argv
+    sys.argv = [normalise_script, path, model_name]
+    try:
+        runpy.run_path(normalise_script, run_name='__main__')
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError('normalise.py exited with code %s' % e.code)
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+
+
+def process_request(normalise_script, model_name, request):
+    tmp_dir = tempfile.mkdtemp(prefix='normalizer-')
+    try:
+        path = os.path.join(tmp_dir, 'text')
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(request['text'])
+
+        run_normalise(normalise_script, path, model_name)
+
+        with io.open(path + '.norm', encoding='utf-8') as f:
+            return {'id': request['id'], 'result': f.read()}
+
+    except Exception:
+        return {'id': request['id'], 'error': traceback.format_exc()}
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def main():
+    normalizer_path, model_name = sys.argv[1:3]
+    normalise_script = os.path.join(normalizer_path, 'normalise.py')
+    sys.path.insert(0, normalizer_path)
+
+    # responses go to the original stdout, everything printed by csmtiser
+    # and its subprocesses goes to stderr
+    responses = io.open(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+
+        request = json.loads(line)
+        response = process_request(normalise_script, model_name, request)
+        responses.write(u'%s\n' % json.dumps(response, ensure_ascii=True))
+        responses.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Parallel grammar reannotation of many recordings.
+
+Recordings are sharded across a process pool. Each worker process keeps one
+pymorphy2 analyzer, the grammeme config and one Standartizator per dialect
+(see standartizator.StandartizatorRegistry) for all recordings it gets.
+EAF files are backed up and written atomically (see ElanObject.save),
+errors are returned to the caller per recording instead of being raised.
+"""
+
+import os
+import time
+import traceback
+import concurrent.futures
+from collections import namedtuple
+
+from django.db import connections
+
+from corpora.models import Recording
+from .db_utils import get_mongo_client
+from .elan_to_html import ElanToHTML
+from .standartizator import standartizator_registry
+
+
+ReannotationReport = namedtuple('ReannotationReport', ['recording', 'seconds', 'error'])
+
+_INITIALIZED_PID = None  # pid of the process in which init_worker ran, forked workers inherit the parent's
+
+
+def init_worker():
+    """
+    runs once per worker process, before its first recording
+    (ProcessPoolExecutor has no initializer before python 3.7)
+    """
+    global _INITIALIZED_PID
+    if _INITIALIZED_PID == os.getpid():
+        return
+
+    for connection in connections.all():
+        connection.close()  # connections inherited from the parent process can not be shared
+    get_mongo_client()  # the same for the MongoClient, this one is made for the worker
+    standartizator_registry.get_morph_rus()
+    _INITIALIZED_PID = os.getpid()
+
+
+def reannotate_recording(recording_id, mode):
+    """
+    runs in a worker process
+    """
+    init_worker()
+    start = time.perf_counter()
+    name = str(recording_id)
+    try:
+        recording = Recording.objects.get(pk=recording_id)
+        name = recording.string_id
+        ElanToHTML(recording, mode=mode).auto_annotate()
+    except Exception:
+        return ReannotationReport(name, time.perf_counter() - start, traceback.format_exc(limit=3))
+    return ReannotationReport(name, time.perf_counter() - start, None)
+
+
+def reannotate_recordings(recordings, workers=None, mode='auto-grammar'):
+    """
+    recordings is a queryset, yields ReannotationReport in order of completion.
+    mode is 'auto-grammar' to keep standartizations or 'auto-annotation' to normalize again
+    """
+    workers = workers or os.cpu_count() or 1
+    # recordings of a dialect are submitted together, so that workers mostly reuse the same Standartizator
+    recording_ids = list(recordings.order_by('to_dialect', 'pk').values_list('pk', flat=True))
+
+    for connection in connections.all():
+        connection.close()  # not to be inherited by forked workers
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reannotate_recording, recording_id, mode) for recording_id in recording_ids]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
@@ -1,13 +1,19 @@
 import os
 import pymorphy2
 import datetime
-from collections import defaultdict, OrderedDict, Counter
+import threading
+from collections import defaultdict, OrderedDict
 
 from django.conf import settings
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 
 from normalization.models import Model, Word
-from .word_list import find_word, find_standartization
+from .db_utils import META_COLLECTION
+from .word_list import find_word, find_standartization, find_standartizations
+from .normalizer import normalize_text, bump_model_generation
 from .annotation_menu import annotation_menu
+from .morph_cache import morph_cache, get_analyzer_version
 from .format_utils import UNKNOWN_PREFIX, ANNOTATION_TAG_SEP, ANNOTATION_PART_SEP
 from .annotation_utils import (
     correct_reflexive,
@@ -17,8 +23,12 @@ from .annotation_utils import (
 )
 
 
+WORDS_PRED_PATH = os.path.join(settings.DATA_DIR, 'static', 'words_PRED.txt')
+AUTOMATIC_OVERRIDEN_PATH = os.path.join(settings.DATA_DIR, 'static', 'automatic_overriden.csv')
+
+
 class Standartizator:
-    def __init__(self, dialect=''):
+    def __init__(self, dialect='', morph_rus=None):
         self.dialect = dialect
 
         # gets appropriate model by dialect's name
@@ -30,12 +40,14 @@ class Standartizator:
             self.manual_words[x.transcription].append([x.normalization, x.lemma, x.annotation, 1])
 
         self.path = settings.NORMALIZER_PATH  # specified in the last line of trimco.settings.py
-        self.morph_rus = pymorphy2.MorphAnalyzer()  # TODO: replace with some context-dependent analyser, i.e. mystem
+        # TODO: replace with some context-dependent analyser, i.e. mystem
+        self.morph_rus = morph_rus if morph_rus is not None else pymorphy2.MorphAnalyzer()
+        self.analyzer_version = get_analyzer_version(self.morph_rus)
 
-        with open(os.path.join(settings.DATA_DIR, 'static', 'words_PRED.txt'), encoding='utf-8') as f:
+        with open(WORDS_PRED_PATH, encoding='utf-8') as f:
             self.words_pred = f.read().split('\n')
 
-        with open(os.path.join(settings.DATA_DIR, 'static', 'automatic_overriden.csv'), encoding='utf-8') as f:
+        with open(AUTOMATIC_OVERRIDEN_PATH, encoding='utf-8') as f:
             self.automatic_overriden = {line.split()[0]: line.split()[1] for line in f}
 
     def get_manual_standartizations(self, orig):
@@ -46,9 +58,8 @@ class Standartizator:
 
         saved_word = find_word(orig, model=str(self.model))
         if saved_word is not None:
-            standartization_counts = Counter(saved_word['standartizations'])
-            standartizations_by_freq = [s[0] for s in standartization_counts.most_common()]
-            return standartizations_by_freq
+            # top is kept sorted by frequency in the word list
+            return [standartization for standartization, _ in saved_word['top']]
 
     def get_auto_standartization(self, word):
         orig, standartization = word.split('\t')
@@ -57,19 +68,20 @@ class Standartizator:
             standartization = manual_standartizations[0]
 
         else:
-            standartization = correct_reflexive(standartization.lower(), parser=self.morph_rus)
+            standartization = morph_cache.get(
+                'reflexive', self.analyzer_version, standartization.lower(),
+                lambda norm: correct_reflexive(norm, parser=self.morph_rus)
+            )
 
         return orig, standartization.lower()
 
     def normalize(self, text_to_normalize):
-        with open(os.path.join(settings.BASE_DIR, 'tmp'), 'w', encoding='utf-8') as f:
-            f.write(text_to_normalize)
-
-        os.system('python2 ' + self.path + 'normalise.py ' + os.path.join(settings.BASE_DIR, 'tmp') + ' ' + str(self.model))
+        # the model is loaded once by a persistent worker, see normalizer.py
+        normalized = normalize_text(str(self.model), text_to_normalize, timeout=settings.NORMALIZER_TIMEOUT)
 
         try:
             # clauses are separated by '\n\n', words inside clause are separated by '\n'
-            clauses = open(os.path.join(settings.BASE_DIR, 'tmp.norm'), encoding='utf-8').read().split('\n\n')
+            clauses = normalized.split('\n\n')
             lines = [clause.split('\n') for clause in clauses if clause]
             # an element of lines looks like:
             # ['I\tИ', 'stálo\tстало', 'užó\tужо', "n'a\tне", "óz'erъm\tозером"]
@@ -94,14 +106,17 @@ class Standartizator:
         return []
 
     @staticmethod
-    def unify_annotations(annotations):
+    def unify_annotations(annotations, counts=None):
         """
         remove tag duplicates from different sources.
         preserves original order of unique annotations
-        but counts occurrences of each so it's possible to sort by them later
+        but counts occurrences of each (or sums their counts) so it's possible to sort by them later
         """
+        if counts is None:
+            counts = [1] * len(annotations)
+
         unified_annotations = OrderedDict()
-        for raw_annotation in annotations:
+        for raw_annotation, count in zip(annotations, counts):
             if not isinstance(raw_annotation, list):
                 lemma, annotation = raw_annotation.split(ANNOTATION_PART_SEP, 1)
             else:
@@ -112,13 +127,16 @@ class Standartizator:
             spl_annotation = tuple([lemma] + sorted(set(annotation.split(ANNOTATION_TAG_SEP))))
             if spl_annotation not in unified_annotations:
                 unified_annotations[spl_annotation] = [[lemma, annotation], 0]
-            unified_annotations[spl_annotation][1] += 1
+            unified_annotations[spl_annotation][1] += count
 
         return unified_annotations
 
-    def get_annotaton_options_list_from_db(self, annots_from_db):
-        total_anns = len(annots_from_db)
-        unique_anns = self.unify_annotations(annots_from_db)
+    def get_annotaton_options_list_from_db(self, standartization_from_db):
+        total_anns = standartization_from_db['total']
+        unique_anns = self.unify_annotations(
+            [annotation for annotation, _ in standartization_from_db['top']],
+            counts=[count for _, count in standartization_from_db['top']]
+        )
         result_list = []
 
         for full_tag, count in sorted(unique_anns.values(), key=lambda x: x[1], reverse=True):
@@ -128,7 +146,10 @@ class Standartizator:
 
         return result_list
 
-    def get_annotation_options_list_by_parsing(self, orig, standartization):
+    def parse_standartization(self, standartization):
+        """
+        [[lemma, tag, score], ...] of pymorphy2 analyses with tags in the order of the grammeme config
+        """
         result_list = []
 
         for annot in self.morph_rus.parse(standartization):
@@ -141,15 +162,30 @@ class Standartizator:
             methods = {str(x[0]) for x in annot.methods_stack}
             lemma = annot.normal_form if methods == {'<DictionaryAnalyzer>'} else UNKNOWN_PREFIX + annot.normal_form
 
+            result_list.append([lemma, tag, annot.score])
+
+        return result_list
+
+    def get_annotation_options_list_by_parsing(self, orig, standartization):
+        parsed = morph_cache.get(
+            'parse', self.analyzer_version + '/' + annotation_menu.config_hash, standartization,
+            self.parse_standartization
+        )
+
+        result_list = []
+        for lemma, tag, score in parsed:
             tag = correct_antp(self.model.name, orig, tag)
             tag = check_for_pred(standartization, tag, self.words_pred)
             tag = override_tag(standartization, tag, self.automatic_overriden)
 
-            result_list.append([lemma, tag, annot.score])
+            result_list.append([lemma, tag, score])
 
         return result_list
 
-    def get_annotation_options_list(self, token):
+    def get_annotation_options_list(self, token, standartization_from_db=False):
+        """
+        standartization_from_db can be passed if it was already looked up (None if not found)
+        """
         orig, standartization = token
 
         manual_corr = self.manual_words.get(orig.lower())
@@ -157,9 +193,10 @@ class Standartizator:
             return self.get_annotation_options_list_from_manual_words(standartization, manual_corr)
 
         final_list = []
-        standartization_from_db = find_standartization(standartization, model=str(self.model))
+        if standartization_from_db is False:
+            standartization_from_db = find_standartization(standartization, model=str(self.model))
         if standartization_from_db is not None:
-            final_list += self.get_annotaton_options_list_from_db(standartization_from_db['annotations'])
+            final_list += self.get_annotaton_options_list_from_db(standartization_from_db)
 
         final_list += self.get_annotation_options_list_by_parsing(orig, standartization)
 
@@ -168,11 +205,25 @@ class Standartizator:
         return final_list
 
     def get_grammar_annotation(self, nrm_list):
+        """
+        options are computed once per unique (orig, standartization) pair
+        and shared by all its occurrences
+        """
+        tokens = {(word[0], word[1]) for nrm in nrm_list for word in nrm}
+        from_db = find_standartizations(
+            {standartization for orig, standartization in tokens if orig.lower() not in self.manual_words},
+            model=str(self.model)
+        )
+        options = {
+            token: self.get_annotation_options_list(token, standartization_from_db=from_db.get(token[1]))
+            for token in tokens
+        }
+
         annotations = []
         for nrm in nrm_list:
             annotation = []
             for word in nrm:
-                annotation.append((word[1], self.get_annotation_options_list(word)))
+                annotation.append((word[1], options[(word[0], word[1])]))
             annotations.append(annotation)
         return annotations
 
@@ -217,3 +268,91 @@ class Standartizator:
     def retrain_model(self):
         os.system('python2 ' + self.path + 'preprocess.py ' + str(self.model))
         os.system('python2 ' + self.path + 'train.py ' + str(self.model))
+        bump_model_generation(str(self.model))  # workers of all processes still have the old model loaded
+
+
+STANDARTIZATORS_GENERATION_ID = 'standartizators_generation'
+
+
+def get_standartizators_generation():
+    """
+    counter that changes after manual words or models are changed in any process
+    """
+    generation = META_COLLECTION.find_one({'_id': STANDARTIZATORS_GENERATION_ID})
+    return generation['value'] if generation is not None else 0
+
+
+def bump_standartizators_generation():
+    META_COLLECTION.update_one({'_id': STANDARTIZATORS_GENERATION_ID}, {'$inc': {'value': 1}}, upsert=True)
+
+
+class StandartizatorRegistry:
+    """
+    keeps one warm Standartizator per dialect in the process,
+    so that requests do not load manual words, resource files and pymorphy2 dictionaries again.
+    instances are rebuilt after manual words or models are changed (see signal receivers below),
+    which other processes learn from the generation counter in META_COLLECTION,
+    or resource files are modified
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instances = {}  # {dialect pk: (standartizator, (resource mtimes, generation))}
+        self.morph_rus = None  # shared by all instances, its dictionaries are read-only
+
+    def get_morph_rus(self):
+        if self.morph_rus is None:
+            self.morph_rus = pymorphy2.MorphAnalyzer()
+        return self.morph_rus
+
+    @staticmethod
+    def get_resources_mtimes():
+        return tuple(os.stat(path).st_mtime for path in (WORDS_PRED_PATH, AUTOMATIC_OVERRIDEN_PATH))
+
+    def get(self, dialect):
+        key = str(getattr(dialect, 'pk', dialect))
+        version = (self.get_resources_mtimes(), get_standartizators_generation())
+
+        with self.lock:
+            cached = self.instances.get(key)
+            if cached is not None and cached[1] == version:
+                return cached[0]
+
+            standartizator = Standartizator(dialect, morph_rus=self.get_morph_rus())
+            self.instances[key] = (standartizator, version)
+            return standartizator
+
+    def invalidate(self, model_pk=None):
+        """
+        drops instances of this process at once, other processes rebuild theirs on the next get
+        """
+        bump_standartizators_generation()
+        with self.lock:
+            if model_pk is None:
+                self.instances.clear()
+                return
+
+            for key, (standartizator, _) in list(self.instances.items()):
+                if standartizator.model.pk == model_pk:
+                    del self.instances[key]
+
+
+standartizator_registry = StandartizatorRegistry()
+
+
+def get_standartizator(dialect):
+    return standartizator_registry.get(dialect)
+
+
+@receiver([post_save, post_delete], sender=Word)
+def invalidate_standartizators_of_word(sender, instance, **kwargs):
+    standartizator_registry.invalidate(instance.to_model_id)
+
+
+@receiver([post_save, post_delete], sender=Model)
+def invalidate_standartizators_of_model(sender, instance, **kwargs):
+    standartizator_registry.invalidate()  # dialects of the model could change as well
+
+
+@receiver(m2m_changed, sender=Model.to_dialect.through)
+def invalidate_standartizators_of_dialects(sender, **kwargs):
+    standartizator_registry.invalidate()
@@ -1,8 +1,12 @@
-from collections import defaultdict
+import os
+import heapq
+from collections import defaultdict, Counter
 
 from pympi import Eaf
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
 
-from .db_utils import WORD_COLLECTION, STANDARTIZATION_COLLECTION
+from .db_utils import WORD_COLLECTION, STANDARTIZATION_COLLECTION, MANIFEST_COLLECTION
+from .manifest import get_entry, get_file_state, is_up_to_date, set_part, unset_part
 from .elan_utils import (
     clean_transcription, get_tier_alignment,
     get_annotation_alignment
@@ -13,6 +17,11 @@ from .format_utils import (
 )
 
 
+WORD_BATCH_SIZE = 1000  # operations per bulk_write
+LEXICON_TOP_K = 20  # most frequent values kept in `top` of words and standartizations
+TOP_UPDATE_ATTEMPTS = 5  # reads of a batch whose top is changed concurrently, see refresh_top
+
+
 def process_one_tier(eaf_filename, words, orig_tier, standartization_tier, annotation_tier):
     tier_alignment = get_tier_alignment(orig_tier, standartization_tier, annotation_tier)
     for orig, standartization, annotation in tier_alignment.values():
@@ -32,19 +41,22 @@ def process_one_tier(eaf_filename, words, orig_tier, standartization_tier, annot
                 print('WARNING: ' + eaf_filename, 'no ann for word ' + str(i), orig, annotation, '', sep='\n')
                 continue
 
-            words['standartizations'][std].append(ann)
+            words['standartizations'][std].append(annotation_to_value(ann))
 
     return words
 
 
 def reformat_words_for_db(words, model_name):
+    """
+    counts are lists of [value, count], as values can not be used as keys in the manifest
+    """
     new_words = {
         'words': [
-            {'word': k, 'model': model_name, 'standartizations': list(v)}
+            {'word': k, 'model': model_name, 'counts': [list(item) for item in Counter(v).items()]}
             for k, v in words['words'].items()
         ],
         'standartizations': [
-            {'word': k, 'model': model_name, 'annotations': v}
+            {'word': k, 'model': model_name, 'counts': [list(item) for item in Counter(v).items()]}
             for k, v in words['standartizations'].items()
         ]
     }
@@ -77,48 +89,333 @@ def process_one_elan(eaf_filename, model_name):
     return reformat_words_for_db(words, model_name)
 
 
-def insert_one_word_in_mongo(word, model, standartizations):
-    WORD_COLLECTION.find_one_and_update(
-        {'word': word, 'model': model},
-        {'$push': {'standartizations': {'$each': standartizations}}},
-        upsert=True
-    )
+def bulk_write_in_batches(collection, requests, batch_size=WORD_BATCH_SIZE):
+    """
+    returns number of operations written
+    """
+    n_ops = 0
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) >= batch_size:
+            collection.bulk_write(batch, ordered=False)
+            n_ops += len(batch)
+            batch = []
+
+    if batch:
+        collection.bulk_write(batch, ordered=False)
+        n_ops += len(batch)
+
+    return n_ops
+
+
+def encode_key(value):
+    """
+    values are keys of `counts`, mongo keys can not contain '.' and start with '$'
+    """
+    return value.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def decode_key(key):
+    return key.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+
+def annotation_to_value(ann):
+    """
+    (lemma, tags) from elan or 'lemma-tags' string from the editor
+    """
+    if isinstance(ann, str):
+        return ann
+    return ANNOTATION_PART_SEP.join(ann)
+
+
+def get_top(counts, top_k=LEXICON_TOP_K):
+    """
+    [[value, count], ...] of the top_k most frequent values
+    """
+    top = [[decode_key(key), count] for key, count in counts.items()]
+    return heapq.nlargest(top_k, top, key=lambda item: (item[1], item[0]))
+
+
+def update_top(top, value, count, top_k=LEXICON_TOP_K):
+    """
+    top after count of the value was increased
+    """
+    top = [item for item in top if item[0] != value] + [[value, count]]
+    top.sort(key=lambda item: (item[1], item[0]), reverse=True)
+    return top[:top_k]
 
 
-def insert_one_standartization_in_mongo(standartization, model, annotations):
-    STANDARTIZATION_COLLECTION.find_one_and_update(
-        {'word': standartization, 'model': model},
-        {'$push': {'annotations': {'$each': annotations}}},
-        upsert=True
+def increment_request(word, model, counts):
+    """
+    counts are [[value, count], ...], negative counts retract values
+    """
+    inc = {'counts.' + encode_key(value): count for value, count in counts}
+    inc['total'] = sum(count for _, count in counts)
+    return UpdateOne({'model': model, 'word': word}, {'$inc': inc}, upsert=True)
+
+
+def iter_refresh_top_requests(collection, keys, batch_size=WORD_BATCH_SIZE):
+    """
+    recomputes top of documents after their counts were changed by bulk increments,
+    drops values whose count fell to zero and documents without values.
+    requests are conditional on top and total that were read,
+    so that a top computed from counts changed meanwhile is not written
+    """
+    keys = list(keys)
+    for i in range(0, len(keys), batch_size):
+        query = {'$or': [{'model': model, 'word': word} for model, word in keys[i:i + batch_size]]}
+        for doc in collection.find(query, projection=['counts', 'top', 'total']):
+            read = {'_id': doc['_id'], 'top': doc.get('top'), 'total': doc.get('total')}
+            counts = {key: count for key, count in doc.get('counts', {}).items() if count > 0}
+            if not counts:
+                yield DeleteOne(read)
+                continue
+
+            top = get_top(counts)
+            dropped = set(doc['counts']) - set(counts)
+            if top == doc.get('top') and not dropped:
+                continue
+
+            update = {'$set': {'top': top}}
+            if dropped:
+                update['$unset'] = {'counts.' + key: True for key in dropped}
+            yield UpdateOne(read, update)
+
+
+def refresh_top(collection, keys, batch_size=WORD_BATCH_SIZE, attempts=TOP_UPDATE_ATTEMPTS):
+    """
+    writes requests of iter_refresh_top_requests, documents of a batch are read again
+    while some of them were changed concurrently. returns number of write operations
+    """
+    keys = list(keys)
+    n_ops = 0
+    for i in range(0, len(keys), batch_size):
+        for _ in range(attempts):
+            requests = list(iter_refresh_top_requests(collection, keys[i:i + batch_size], batch_size))
+            if not requests:
+                break
+            result = collection.bulk_write(requests, ordered=False)
+            n_ops += len(requests)
+            if result.matched_count + result.deleted_count == len(requests):
+                break
+    return n_ops
+
+
+def increment_in_mongo(collection, items, sign=1):
+    """
+    items are {'word', 'model', 'counts'}, returns number of write operations
+    """
+    items = list(items)
+    n_ops = bulk_write_in_batches(collection, (
+        increment_request(item['word'], item['model'], [[value, sign * count] for value, count in item['counts']])
+        for item in items
+    ))
+    n_ops += refresh_top(collection, [(item['model'], item['word']) for item in items])
+    return n_ops
+
+
+def increment_one_value(collection, word, model, value):
+    """
+    increments count of the value and updates top of the document without reading all counts
+    """
+    key = encode_key(value)
+    doc = collection.find_one_and_update(
+        {'model': model, 'word': word},
+        {'$inc': {'counts.' + key: 1, 'total': 1}},
+        projection={'counts.' + key: True, 'top': True},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
     )
 
+    # top is not overwritten if it was changed concurrently,
+    # the value is merged into the changed top with its count read again instead
+    while doc is not None and key in doc.get('counts', {}):
+        top = doc.get('top')
+        new_top = update_top(top or [], value, doc['counts'][key])
+        if new_top == top:
+            return
+
+        result = collection.update_one({'_id': doc['_id'], 'top': top}, {'$set': {'top': new_top}})
+        if result.matched_count:
+            return
+        doc = collection.find_one({'_id': doc['_id']}, projection={'counts.' + key: True, 'top': True})
+
+
+def insert_one_word_in_mongo(word, model, standartization):
+    increment_one_value(WORD_COLLECTION, word, model, standartization)
+
+
+def insert_one_standartization_in_mongo(standartization, model, annotation):
+    increment_one_value(STANDARTIZATION_COLLECTION, standartization, model, annotation)
+
 
 def insert_words_in_mongo(words):
-    for word_info in words['words']:
-        insert_one_word_in_mongo(
-            word_info['word'],
-            word_info['model'],
-            word_info['standartizations']
-        )
+    """
+    returns number of write operations
+    """
+    n_ops = increment_in_mongo(WORD_COLLECTION, words['words'])
+    n_ops += increment_in_mongo(STANDARTIZATION_COLLECTION, words['standartizations'])
+    return n_ops
+
+
+def retract_words_from_mongo(words):
+    """
+    the opposite of insert_words_in_mongo, returns number of write operations
+    """
+    n_ops = increment_in_mongo(WORD_COLLECTION, words['words'], sign=-1)
+    n_ops += increment_in_mongo(STANDARTIZATION_COLLECTION, words['standartizations'], sign=-1)
+    return n_ops
+
+
+def iter_convert_requests(collection, old_field):
+    for doc in collection.find({old_field: {'$exists': True}}, projection=[old_field]):
+        counts = Counter(encode_key(annotation_to_value(value)) for value in doc[old_field])
+        yield UpdateOne({'_id': doc['_id']}, {
+            '$set': {'counts': dict(counts), 'total': sum(counts.values()), 'top': get_top(counts)},
+            '$unset': {old_field: True}
+        })
+
+
+def iter_merge_duplicates_requests(collection, old_field):
+    """
+    documents of the same (model, word) are merged into the oldest one,
+    values of `old_field` arrays are converted to counts on the way
+    """
+    pipeline = [
+        {'$group': {'_id': {'model': '$model', 'word': '$word'}, 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+        {'$match': {'n': {'$gt': 1}}}
+    ]
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        docs = sorted(collection.find({'_id': {'$in': group['ids']}}), key=lambda doc: doc['_id'])
+        counts = Counter()
+        for doc in docs:
+            counts.update(doc.get('counts', {}))
+            counts.update(encode_key(annotation_to_value(value)) for value in doc.get(old_field, []))
+
+        yield UpdateOne({'_id': docs[0]['_id']}, {
+            '$set': {'counts': dict(counts), 'total': sum(counts.values()), 'top': get_top(counts)},
+            '$unset': {old_field: True}
+        })
+        for doc in docs[1:]:
+            yield DeleteOne({'_id': doc['_id']})
+
+
+def merge_duplicate_words():
+    """
+    merges documents of the same word made by concurrent upserts before the unique
+    model_word indexes existed, which can not be created while duplicates remain.
+    returns number of write operations
+    """
+    n_ops = bulk_write_in_batches(
+        WORD_COLLECTION, iter_merge_duplicates_requests(WORD_COLLECTION, 'standartizations')
+    )
+    n_ops += bulk_write_in_batches(
+        STANDARTIZATION_COLLECTION, iter_merge_duplicates_requests(STANDARTIZATION_COLLECTION, 'annotations')
+    )
+    return n_ops
+
 
-    for st_info in words['standartizations']:
-        insert_one_standartization_in_mongo(
-            st_info['word'],
-            st_info['model'],
-            st_info['annotations']
-        )
+def iter_convert_manifest_requests():
+    for entry in MANIFEST_COLLECTION.find({'words.words.standartizations': {'$exists': True}}, projection=['words']):
+        update = {}
+        for part, old_field in [('words', 'standartizations'), ('standartizations', 'annotations')]:
+            update['words.' + part] = [
+                {
+                    'word': item['word'], 'model': item['model'],
+                    'counts': [list(count) for count in Counter(map(annotation_to_value, item[old_field])).items()]
+                }
+                for item in entry['words'][part]
+            ]
+        yield UpdateOne({'_id': entry['_id']}, {'$set': update})
+
+
+def convert_word_list_to_counts():
+    """
+    converts documents with `standartizations` and `annotations` arrays made by $push
+    (and contributions of elans in the manifest) to `counts` maps with `top`,
+    returns number of converted documents
+    """
+    n_docs = bulk_write_in_batches(WORD_COLLECTION, iter_convert_requests(WORD_COLLECTION, 'standartizations'))
+    n_docs += bulk_write_in_batches(
+        STANDARTIZATION_COLLECTION, iter_convert_requests(STANDARTIZATION_COLLECTION, 'annotations')
+    )
+    n_docs += bulk_write_in_batches(MANIFEST_COLLECTION, iter_convert_manifest_requests())
+    return n_docs
+
+
+def sync_elan_words(eaf_path, model_name):
+    """
+    replaces words contributed by the elan if the file or its model changed since the last sync,
+    returns number of write operations or None if they are up to date
+    """
+    elan = os.path.basename(eaf_path)
+    entry = get_entry(elan, 'words')
+    state = get_file_state(eaf_path, entry)
+    if is_up_to_date(entry, 'words', state, model=model_name):
+        return
+
+    words = process_one_elan(eaf_path, model_name)
+    n_ops = 0
+    if entry is not None and 'words' in entry:
+        n_ops += retract_words_from_mongo(entry['words'])
+
+    n_ops += insert_words_in_mongo(words)
+    set_part(elan, 'words', state, model=model_name, **words)
+    return n_ops
+
+
+def remove_elan_words(elan, entry):
+    """
+    retracts words of the elan which is deleted or no longer used for the word list,
+    returns number of write operations
+    """
+    n_ops = retract_words_from_mongo(entry['words'])
+    unset_part(elan, 'words')
+    return n_ops
 
 
 def insert_manual_annotation_in_mongo(model, word, standartization, lemma, grammar):
     standartization = standartization.lower()
     annotation = lemma.lower() + ANNOTATION_PART_SEP + grammar
-    insert_one_word_in_mongo(word.lower(), model, [standartization])
-    insert_one_standartization_in_mongo(standartization, model, [annotation])
+    insert_one_word_in_mongo(word.lower(), model, standartization)
+    insert_one_standartization_in_mongo(standartization, model, annotation)
+
+
+def with_top(collection, doc, old_field):
+    """
+    sets top and total of a document that has none yet:
+    one that was not converted by convert_word_list_to_counts or whose top is still being written
+    """
+    if doc is None or 'top' in doc:
+        return doc
+
+    saved = collection.find_one({'_id': doc['_id']}, projection=['counts']) or {}
+    counts = Counter(saved.get('counts', {}))
+    counts.update(encode_key(annotation_to_value(value)) for value in doc.get(old_field, []))
+    doc['top'] = get_top(counts)
+    doc.setdefault('total', sum(counts.values()))
+    return doc
 
 
 def find_word(word, model):
-    return WORD_COLLECTION.find_one({'word': word, 'model': model})
+    doc = WORD_COLLECTION.find_one({'model': model, 'word': word}, projection={'counts': False})
+    return with_top(WORD_COLLECTION, doc, 'standartizations')
 
 
 def find_standartization(word, model):
-    return STANDARTIZATION_COLLECTION.find_one({'word': word, 'model': model})
+    doc = STANDARTIZATION_COLLECTION.find_one({'model': model, 'word': word}, projection={'counts': False})
+    return with_top(STANDARTIZATION_COLLECTION, doc, 'annotations')
+
+
+def find_standartizations(words, model, batch_size=WORD_BATCH_SIZE):
+    """
+    {word: document} of the words found, looked up with one query per batch
+    """
+    words = list(words)
+    found = {}
+    for i in range(0, len(words), batch_size):
+        query = {'model': model, 'word': {'$in': words[i:i + batch_size]}}
+        for doc in STANDARTIZATION_COLLECTION.find(query, projection={'counts': False}):
+            found[doc['word']] = with_top(STANDARTIZATION_COLLECTION, doc, 'annotations')
+    return found
@@ -32,9 +32,13 @@
 
                 alert('Something went wrong. Try again later. If the error persists, please contact developers and describe the problem.')
                 processing_request = false;
-                if (req_type == 'save_elan_req') {
+                if (req_type == 'save_elan_req' || req_type == 'save_elan_patch') {
                     $('#save_to_file').removeClass('fa-spinner off').addClass('fa-floppy-o');
                 };
+                if (req_type == 'save_elan_patch') {
+                    // not saved, sent annotations are sent again with the next save
+                    $('.annot_wrapper.saving').removeClass('saving').addClass('changed');
+                };
             },
             success: function(response) {
                 result = $.parseJSON(response);  // Get the results sent from ajax to here
@@ -64,16 +68,30 @@
                     else if (req_type == 'save_elan_req') {
                         $('#save_to_file').removeClass('fa-spinner off').addClass('fa-floppy-o');
                     }
+                    else if (req_type == 'save_elan_patch') {
+                        $('.annot_wrapper.saving').removeClass('saving');
+                        $('#save_to_file').removeClass('fa-spinner off').addClass('fa-floppy-o');
+                    }
                     else if (req_type == 'search') {
                         $('#replace_warning').show();
                         $('#search_result').html(result.result);
                         prev_page_info = result.page_info;
                         if (result.total_pages != null) {
-                            construct_page_section(1, result.total_pages);
+                            construct_page_section(1, result.total_pages, result.count_status);
                         };
                         $('#search_button').html('Search');
                         adjust_DOM_spacing();
                         $(".audiofragment .fa-spinner").removeClass('fa-spinner off').addClass('fa-play');
+                        if (result.count_status == 'pending') {
+                            // the page is shown first, total pages are requested when counted
+                            $('#page_nums').empty().append('<i class="fa fa-spinner fa-spin"></i>');
+                            setTimeout(function () { ajax_request('search_count', req_data, search=true); }, 0);
+                        };
+                    }
+                    else if (req_type == 'search_count') {
+                        if (result.total_pages != null) {
+                            construct_page_section(1, result.total_pages, result.count_status);
+                        };
                     }
                 }
             }
@@ -404,8 +422,9 @@
     }
 
     /* ADJUST SPACING FOR DOM ON INITIAL LOAD */
-    function adjust_DOM_spacing() {
-        $('token').each(function( index ) {
+    function adjust_DOM_spacing(container) {
+        var tokens = container ? container.find('token') : $('token');
+        tokens.each(function( index ) {
             if ( $(this).children('morph').length ) {
                 var len_transcript = getTextWidth( $(this).children('trt') );
                 var len_morph = getTextWidth( $(this).children('morph') );
@@ -424,6 +443,73 @@
         });
     }
 
+    /* EDITOR WINDOWS: only a window of annotations is rendered, neighbouring ones are loaded on scroll */
+    var EDITOR_PREFETCH_MARGIN = 2000;  // px between the viewport and the edge of loaded annotations
+    var loading_window = false;
+
+    function load_editor_window(first, count, prepend) {
+        if (loading_window || count <= 0) { return; }
+        loading_window = true;
+
+        $.ajax({
+            url: "../../ajax/",
+            type: 'POST',
+            data: {'request_type' : 'editor_window', 'request_data' : {'first': first, 'count': count}},
+            success: function(response) {
+                var result = $.parseJSON(response).result;
+                var display = $('.eaf_display');
+                var blocks = $(result.html);
+                if (prepend) {
+                    var height = $(document).height();
+                    display.prepend(blocks);
+                    // the annotations on screen stay in place
+                    $(window).scrollTop($(window).scrollTop() + $(document).height() - height);
+                    display.attr('first', result.first);
+                }
+                else {
+                    display.append(blocks);
+                    display.attr('last', result.last);
+                };
+                display.attr('total', result.total);
+                adjust_DOM_spacing(blocks);
+                blocks.find(".audiofragment .fa-spinner").removeClass('fa-spinner off').addClass('fa-play');
+            },
+            complete: function() {
+                loading_window = false;
+                setTimeout(prefetch_editor_windows, 0);
+            }
+        });
+    }
+
+    function prefetch_editor_windows() {
+        var display = $('.eaf_display');
+        if (!display.attr('window')) { return; }
+        var first = parseInt(display.attr('first'));
+        var last = parseInt(display.attr('last'));
+        var total = parseInt(display.attr('total'));
+        var size = parseInt(display.attr('window'));
+        var top = $(window).scrollTop();
+        var bottom = top + $(window).height();
+
+        if (last < total && bottom > display.offset().top + display.height() - EDITOR_PREFETCH_MARGIN) {
+            load_editor_window(last, size, false);
+        }
+        else if (first > 0 && top < display.offset().top + EDITOR_PREFETCH_MARGIN) {
+            load_editor_window(Math.max(first - size, 0), first - Math.max(first - size, 0), true);
+        };
+    }
+
+    function prefetch_after_fragment(audio_fragment) {
+        /* playing one of the last loaded annotations loads the next window */
+        var display = $('.eaf_display');
+        var size = parseInt(display.attr('window'));
+        var last = parseInt(display.attr('last'));
+        if (last < parseInt(display.attr('total')) &&
+                audio_fragment.closest('.annot_wrapper').nextAll('.annot_wrapper').length < size / 2) {
+            load_editor_window(last, size, false);
+        };
+    }
+
     /* PLAY SOUND */
     function audiofragment_click(audio_fragment, is_search_mode) {
         var active_button = audio_fragment.find(">:first-child");
@@ -451,6 +537,7 @@
             active_button.removeClass('fa-spinner off').addClass('fa-exclamation');
         };
         audio.play();
+        if (!is_search_mode) { prefetch_after_fragment(audio_fragment) };
     }
 
     function check_search_mode() {
@@ -509,6 +596,29 @@
         };
     }
 
+    function get_changes_patch() {
+        /* annotations of the editor changed since the last save, they are marked as being saved */
+        var patch = [];
+        $('.eaf_display .annot_wrapper.changed').each(function() {
+            var tokens = [];
+            $(this).find('token').each(function() {
+                tokens.push({
+                    'nrm': $(this).children('nrm').text(),
+                    'lemma': $(this).children('lemma').text(),
+                    'morph': $(this).children('morph').text()
+                });
+            });
+            patch.push({
+                'tier': $(this).find('.annot').attr('tier_name'),
+                'start': $(this).find('.audiofragment').attr('starttime'),
+                'end': $(this).find('.audiofragment').attr('endtime'),
+                'tokens': tokens
+            });
+            $(this).removeClass('changed').addClass('saving');
+        });
+        return patch;
+    }
+
     function save_replace_annotations() {
         $('token.changed_by_replace').each( function() {
             var save_annotation_params = {
@@ -563,10 +673,12 @@
         if (page_num == max_page_num) { $('.page_num.current').addClass('last'); }
     }
 
-    function construct_page_section(page_num, max_page_num) {
+    function construct_page_section(page_num, max_page_num, count_status) {
         $('#page_nums').empty();
         if (max_page_num <= 30) { construct_small_page_section(page_num, max_page_num); }
         else { construct_large_page_section(page_num, max_page_num); }
+        // counting stopped at the cap: there are more results than pages shown
+        if (count_status == 'capped') { $('#page_nums').append('<div class="ellipsis capped">+</div>'); }
     }
 
 
@@ -589,6 +701,8 @@
             adjust_DOM_spacing();
             $(".audiofragment .fa-spinner").removeClass('fa-spinner off').addClass('fa-play');
             // create_audio();
+            prefetch_editor_windows();
+            $(window).scroll(prefetch_editor_windows);
         };
 
         $("#grp-context-navigation").append(
@@ -661,17 +775,22 @@
 
                 // delay is required for spinner icon to load
                 setTimeout(function () {
-                    var div_id = '.eaf_display';
-                    var is_search_mode = check_search_mode();
-                    if (is_search_mode) {
-                        div_id = '#search_result';
+                    if (check_search_mode()) {
                         save_replace_annotations();
+                        ajax_request(
+                            'save_elan_req',
+                            {'html' : '<div>'+$('#search_result').html()+'</div>',},
+                            search=true
+                        );
+                    }
+                    else {
+                        // only changed annotations are sent, not the whole recording
+                        var patch = JSON.stringify(get_changes_patch());
+                        if (ajax_request('save_elan_patch', {'patch': patch}) === false) {
+                            $('.annot_wrapper.saving').removeClass('saving').addClass('changed');
+                            $('#save_to_file').removeClass('fa-spinner off').addClass('fa-floppy-o');
+                        };
                     };
-                    ajax_request(
-                        'save_elan_req',
-                        {'html' : '<div>'+$(div_id).html()+'</div>',},
-                        search=is_search_mode
-                    );
                 }, 100)
             }
         });
@@ -751,8 +870,10 @@
                 $('.page_num').removeClass('current');
                 $(this).addClass('current');
             } else {
+                var is_capped = $('#page_nums .capped').length > 0;
                 $('#page_nums').empty();
                 construct_large_page_section(page_num, max_page_num);
+                if (is_capped) { $('#page_nums').append('<div class="ellipsis capped">+</div>'); }
             }
 
             var formdata = {
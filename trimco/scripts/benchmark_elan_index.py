@@ -0,0 +1,163 @@
+import sys
+sys.path.append('..')
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+from pympi import Eaf, Elan
+
+from corpora.utils.elan_utils import ElanObject
+from corpora.utils.format_utils import ANNOTATION_WORD_SEP, ANNOTATION_PART_SEP
+
+
+WORDS = ['ну', 'вот', 'он', 'пошёл', 'туда', 'и', 'там', 'была', 'корова', 'дак', 'говорят', 'ходили']
+
+
+def make_synthetic_eaf(path, n_annotations, n_tiers, seed=0):
+    """
+    eaf with n_annotations spread over n_tiers speaker tiers,
+    each with _standartization and _annotation tiers like the ones made by auto-annotation
+    """
+    rnd = random.Random(seed)
+    eaf = Eaf()
+    eaf.add_linguistic_type('stndz_clause')
+    eaf.add_linguistic_type('tokenz_and_annot')
+
+    tier_names = ['tier_%d_n_' % i for i in range(n_tiers)]
+    for tier_name in tier_names:
+        eaf.add_tier(tier_name, part='speaker %s' % tier_name)
+        eaf.add_tier(tier_name + '_standartization', ling='stndz_clause', parent=tier_name)
+        eaf.add_tier(tier_name + '_annotation', ling='tokenz_and_annot', parent=tier_name)
+
+    time_ms = 0
+    for _ in range(n_annotations):
+        start = time_ms + rnd.randint(0, 500)
+        end = start + rnd.randint(500, 5000)
+        time_ms = end
+        tier_name = rnd.choice(tier_names)
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(1, 10))]
+
+        eaf.add_annotation(tier_name, start, end, ' '.join(words))
+        if rnd.random() < 0.9:  # some annotations are not annotated yet
+            eaf.add_annotation(tier_name + '_standartization', start, end, ANNOTATION_WORD_SEP.join(
+                ANNOTATION_PART_SEP.join([str(i), word]) for i, word in enumerate(words)
+            ))
+            eaf.add_annotation(tier_name + '_annotation', start, end, ANNOTATION_WORD_SEP.join(
+                ANNOTATION_PART_SEP.join([str(i), word, 'NOUN-m-nom-sg']) for i, word in enumerate(words)
+            ))
+
+    Elan.to_eaf(path, eaf, pretty=True)
+
+
+def legacy_get_tier_obj_by_name(elan_obj, tier_name):
+    for tier_obj in elan_obj.tiers_lst:
+        if tier_obj.name == tier_name:
+            return tier_obj
+    return None
+
+
+def legacy_get_value(elan_obj, tier_name, start, end):
+    # the lookup of ElanToHTML.get_additional_tags_dict before the annotation index
+    try:
+        annot_lst = elan_obj.Eaf.get_annotation_data_at_time(tier_name, (start + end) / 2)
+    except KeyError:
+        return None
+    return annot_lst[0][-1] if annot_lst else None
+
+
+def legacy_add_extra_tags(elan_obj, tier_name, start, end, value):
+    try:
+        elan_obj.Eaf.remove_annotation(tier_name, (start + end) / 2, clean=True)
+    except KeyError:
+        pass
+    elan_obj.Eaf.add_annotation(tier_name, start, end, value)
+
+
+def lookup_all(elan_obj, get_tier_obj, get_value):
+    """
+    lookups made by build_html, collect_examples and reannotate_elan for every annotation
+    """
+    values = []
+    for start, end, transcript, tier_name in elan_obj.annot_data_lst:
+        get_tier_obj(tier_name)
+        values.append((
+            get_value(tier_name + '_standartization', start, end),
+            get_value(tier_name + '_annotation', start, end),
+        ))
+    return values
+
+
+def update_all(elan_obj, add_extra_tags):
+    """
+    writes of reannotate_elan, every annotation gets a new standartization and annotation
+    """
+    for start, end, transcript, tier_name in elan_obj.annot_data_lst:
+        n_words = len(transcript.split())
+        add_extra_tags(tier_name + '_standartization', start, end, ANNOTATION_WORD_SEP.join(
+            ANNOTATION_PART_SEP.join([str(i), 'std']) for i in range(n_words)
+        ))
+        add_extra_tags(tier_name + '_annotation', start, end, ANNOTATION_WORD_SEP.join(
+            ANNOTATION_PART_SEP.join([str(i), 'lemma', 'ADV']) for i in range(n_words)
+        ))
+
+
+def get_child_tiers_data(elan_obj):
+    elan_obj.Eaf.clean_time_slots()
+    return {
+        tier_name: sorted(elan_obj.Eaf.get_annotation_data_for_tier(tier_name))
+        for tier_name in elan_obj.Eaf.tiers
+        if tier_name.endswith(('_standartization', '_annotation'))
+    }
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares scans and the annotation index of ElanObject')
+    parser.add_argument('--annotations', type=int, default=5000, help='number of annotations of synthetic eaf')
+    parser.add_argument('--tiers', type=int, default=4, help='number of speaker tiers of synthetic eaf')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        eaf_path = os.path.join(tmp_dir, 'synthetic.eaf')
+        make_synthetic_eaf(eaf_path, args.annotations, args.tiers)
+
+        legacy_obj = ElanObject(eaf_path)
+        indexed_obj = ElanObject(eaf_path)
+
+        legacy_values, legacy_lookup_time = timed(
+            lookup_all, legacy_obj,
+            lambda tier_name: legacy_get_tier_obj_by_name(legacy_obj, tier_name),
+            lambda tier_name, start, end: legacy_get_value(legacy_obj, tier_name, start, end)
+        )
+        indexed_values, indexed_lookup_time = timed(
+            lookup_all, indexed_obj, indexed_obj.get_tier_obj_by_name, indexed_obj.get_child_annotation_value
+        )
+        print('annotations:', len(legacy_obj.annot_data_lst), 'lookup mismatches:', sum(
+            legacy != indexed for legacy, indexed in zip(legacy_values, indexed_values)
+        ))
+        print('lookups: scans %.3fs, index %.3fs (%.1fx)' % (
+            legacy_lookup_time, indexed_lookup_time, legacy_lookup_time / indexed_lookup_time
+        ))
+
+        _, legacy_update_time = timed(
+            update_all, legacy_obj,
+            lambda tier_name, start, end, value: legacy_add_extra_tags(legacy_obj, tier_name, start, end, value)
+        )
+        _, indexed_update_time = timed(
+            update_all, indexed_obj,
+            lambda tier_name, start, end, value: indexed_obj.add_extra_tags(
+                tier_name.rsplit('_', 1)[0], start, end, value, tier_name.rsplit('_', 1)[1]
+            )
+        )
+        print('updated tiers match:', get_child_tiers_data(legacy_obj) == get_child_tiers_data(indexed_obj))
+        print('updates: scans %.3fs, index %.3fs (%.1fx)' % (
+            legacy_update_time, indexed_update_time, legacy_update_time / indexed_update_time
+        ))
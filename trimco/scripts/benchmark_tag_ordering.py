@@ -0,0 +1,192 @@
+import sys
+sys.path.append('..')
+
+import re
+import os
+import time
+import contextlib
+import random
+import argparse
+
+from corpora.utils.annotation_menu import AnnotationMenu
+from corpora.utils.format_utils import ANNOTATION_TAG_SEP
+
+
+# tags of pymorphy2 for the test cases of annotation_menu.py
+TEST_CASES = {
+    'NOUN,inan,masc sing,nomn': 'NOUN-m-nom-sg-inan',
+    'NOUN,inan,masc sing,gen2': 'NOUN-m-gen2-sg-inan',
+    'ADJF,Qual femn,sing,nomn': 'ADJF-f-nom-sg',
+    'ADJF,Qual plur,nomn': 'ADJF-nom-pl',
+    'VERB,impf,intr plur,3per,pres,indc': 'VERB-ipfv-prs-ind-3-pl',
+    'VERB,perf,intr plur,past,indc': 'VERB-pfv-pst-ind-pl',
+    'ADVB': 'ADV',
+    'VERB,impf,tran sing,impr,excl': 'VERB-ipfv-imp-sg',
+    'VERB,impf,intr femn,sing,past,indc': 'VERB-ipfv-pst-ind-sg-f',
+    'NUMR gent': 'NUMR-gen',
+    'NUMR femn,nomn': 'NUMR-f-nom',
+    'INFN,impf,intr': 'INF-ipfv',
+    'NPRO,femn,3per,Anph sing,nomn': 'NPRO-f-nom-3-sg',
+    'NPRO,1per sing,nomn': 'NPRO-nom-1-sg',
+    'NOUN,inan,masc,Geox sing,accs': 'NOUN-m-acc-sg-inan-Geox',
+    'NOUN,anim,masc,Name sing,gent': 'NOUN-m-gen-sg-anim-Name',
+    'NOUN,inan,neut,Sgtm,Fixd,Abbr sing,gent': 'NOUN-n-gen-sg-inan-Abbr-Sgtm-Fixd',
+    'UNKN': 'UNKN',
+}
+
+
+def legacy_get_order_by_tag(menu, pos, tags_dict):
+    order_config = menu.config['order'][pos]
+    tag_keyset = set(tags_dict.values())
+
+    order_key = ('default',)
+    for config_order_k in order_config:
+        if not set(config_order_k) - tag_keyset:
+            order_key = config_order_k
+            break
+
+    return order_config[order_key]
+
+
+def legacy_order_compulsory_tags(menu, pos, tags_dict, tag_str):
+    final_tags = [pos]
+
+    if pos in menu.config['order']:
+        order = legacy_get_order_by_tag(menu, pos, tags_dict)
+        for key in order:
+            key_always_required = True
+            if key.startswith('*'):
+                key_always_required = False
+                key = key[1:]
+
+            if key not in tags_dict and key_always_required:
+                final_tags.append('')
+                continue
+
+            if key in tags_dict or key_always_required:
+                final_tags.append(tags_dict[key])
+
+    return final_tags
+
+
+def legacy_order_facultative_tags(menu, facultative_tags, compulsory_tags):
+    all_tags = compulsory_tags + facultative_tags
+
+    def tag_suitable(tag_info):
+        tag = tag_info['tag']
+        if tag not in facultative_tags:
+            return False
+
+        is_for_all = tag_info['categories'][0] == "ALLFORMS"
+        is_in_category = any(
+            all(cat in all_tags for cat in cats.split('.'))
+            for cats in tag_info['categories']
+        )
+        return is_for_all or is_in_category
+
+    return [t["tag"] for t in menu.config['facultative'] if tag_suitable(t)]
+
+
+def legacy_override_abbreviations(menu, tag_str):
+    # AnnotationMenu.override_abbreviations before the config was compiled, without warnings
+    tags_lst = [t for t in re.split(r'[, ]', tag_str) if t]
+    if not tags_lst:
+        return ''
+
+    tags_dict = {
+        menu.config['grammemes'][t]['category']: menu.config['grammemes'][t]['surface_tag']
+        for t in tags_lst if t in menu.config['grammemes']
+    }
+
+    all_facultative_set = set(i['tag'] for i in menu.config['facultative'])
+    facultative_lst = [
+        t for t in tags_lst
+        if t in all_facultative_set
+    ]
+
+    pos = tags_dict.get('part of speech')
+    if pos is None:
+        return tag_str
+
+    final_tags = legacy_order_compulsory_tags(menu, pos, tags_dict, tag_str)
+    final_tags.extend(legacy_order_facultative_tags(menu, facultative_lst, final_tags))
+
+    return ANNOTATION_TAG_SEP.join(final_tags).replace(';-', '; ')
+
+
+def make_synthetic_tags(menu, n_tags, n_distinct, seed=0):
+    """
+    tag strings in the format of pymorphy2 made of random grammemes of the config,
+    n_distinct of them are repeated to get n_tags, as pymorphy2 returns a limited set of tags
+    """
+    rnd = random.Random(seed)
+    by_category = {}
+    for tag, tag_dict in menu.config['grammemes'].items():
+        by_category.setdefault(tag_dict['category'], []).append(tag)
+    pos_tags = by_category.pop('part of speech')
+    facultative = [tag_info['tag'] for tag_info in menu.config['facultative']]
+
+    distinct = []
+    for _ in range(n_distinct):
+        grammemes = [rnd.choice(tags) for tags in by_category.values() if rnd.random() < 0.7]
+        grammemes += rnd.sample(facultative, rnd.randint(0, 3))
+        rnd.shuffle(grammemes)
+        distinct.append(rnd.choice(pos_tags) + ',' + ' '.join(grammemes))
+
+    return [rnd.choice(distinct) for _ in range(n_tags)]
+
+
+def benchmark(func, inputs, n_runs):
+    best = None
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        for item in inputs:
+            func(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+@contextlib.contextmanager
+def quiet():
+    # warnings about incomplete tags are printed for some synthetic tags
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares legacy and compiled ordering of pymorphy2 tags')
+    parser.add_argument('--tags', type=int, default=200000, help='number of synthetic tags')
+    parser.add_argument('--distinct', type=int, default=3000, help='number of distinct synthetic tags')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    menu = AnnotationMenu('annotation_grammemes.json')
+
+    with quiet():
+        errors = [
+            (tag_str, true_res, menu.override_abbreviations(tag_str))
+            for tag_str, true_res in TEST_CASES.items()
+            if menu.override_abbreviations(tag_str) != true_res
+        ]
+    for error in errors:
+        print('ERROR', *error, sep='\t')
+
+    inputs = make_synthetic_tags(menu, args.tags, args.distinct)
+    with quiet():
+        mismatches = [
+            tag_str for tag_str in set(inputs)
+            if legacy_override_abbreviations(menu, tag_str) != menu._override_abbreviations(tag_str)
+        ]
+    print('tags:', len(inputs), 'distinct:', len(set(inputs)), 'mismatches:', len(mismatches))
+    for tag_str in mismatches[:5]:
+        print('MISMATCH', tag_str)
+
+    with quiet():
+        legacy_time = benchmark(lambda tag_str: legacy_override_abbreviations(menu, tag_str), inputs, args.runs)
+        compiled_time = benchmark(menu._override_abbreviations, inputs, args.runs)
+        menu.override_cache.clear()
+        memoized_time = benchmark(menu.override_abbreviations, inputs, args.runs)
+    print('legacy: %.3fs, compiled: %.3fs (%.1fx), memoized: %.3fs (%.1fx)' % (
+        legacy_time, compiled_time, legacy_time / compiled_time, memoized_time, legacy_time / memoized_time
+    ))
@@ -0,0 +1,145 @@
+import sys
+sys.path.append('..')
+
+import re
+import time
+import argparse
+
+from lxml import etree
+
+from corpora.utils.elan_utils import ElanObject
+from corpora.utils.format_utils import (
+    ANNOTATION_WORD_SEP, ANNOTATION_PART_SEP, render_transcript
+)
+
+
+def legacy_prettify_transcript(transcript):
+    if not transcript[-1].strip():
+        transcript = transcript[:-1]
+
+    new_transcript = ''
+    tokens_lst = re.split('([ ])', transcript)
+
+    for el in tokens_lst:
+        el = el.strip()
+        if not el:
+            continue
+
+        if el in ['...', '?', '!']:
+            new_el = '<tech>%s</tech>' % el
+
+        elif el[-1] in ['?', '!']:
+            new_el = '<token><trt>%s</trt></token><tech>%s</tech>' % (el[:-1], el[-1])
+
+        elif '[' in el and ']' in el:
+            new_el = ''
+
+            for el_2 in re.split(r'[\[\]]', el):  # splitting [ ]
+                if not re.match('[a-zA-Z]', el_2):
+                    continue  # removing non-alphabetic values
+
+                if 'unint' in el_2 or '.' in el_2:
+                    new_el += '<note>%s.</note>' % el_2.strip('.')
+                else:
+                    new_el += '<token><trt>%s</trt></token>' % el_2
+
+        else:
+            new_el = '<token><trt>%s</trt></token>' % el
+
+        new_transcript += new_el
+
+    return new_transcript
+
+
+def legacy_add_annotation_to_transcript(transcript, normz_tokens_dict, annot_tokens_dict):
+    i = 0
+    transcript_obj = etree.fromstring('<c>'+transcript+'</c>')
+
+    for tag in transcript_obj.iterchildren():
+        if tag.tag != 'token':
+            continue
+
+        if i in annot_tokens_dict.keys():
+            morph = annot_tokens_dict[i][1]
+            tag.insert(0, etree.fromstring('<morph>' + morph + '</morph>'))
+
+            lemma = annot_tokens_dict[i][0]
+            tag.insert(0, etree.fromstring('<lemma>' + lemma + '</lemma>'))
+
+        if i in normz_tokens_dict.keys():
+            tag.insert(0, etree.fromstring('<nrm>' + normz_tokens_dict[i][0] + '</nrm>'))
+
+        i += 1
+
+    return etree.tostring(transcript_obj)[3:-4].decode('utf-8')
+
+
+def legacy_render_transcript(transcript, normz_tokens_dict, annot_tokens_dict):
+    transcript = legacy_prettify_transcript(transcript)
+    if annot_tokens_dict:
+        transcript = legacy_add_annotation_to_transcript(transcript, normz_tokens_dict, annot_tokens_dict)
+    return transcript
+
+
+def get_tags_dict(elan_obj, tier_name, start, end):
+    # the lookup of ElanToHTML.get_additional_tags_dict before the annotation index, see benchmark_elan_index.py
+    tokens_dict = {}
+    try:
+        annot_lst = elan_obj.Eaf.get_annotation_data_at_time(tier_name, (start + end) / 2)
+    except KeyError:
+        return tokens_dict
+
+    if annot_lst:
+        for el in annot_lst[0][-1].split(ANNOTATION_WORD_SEP):
+            el = el.split(ANNOTATION_PART_SEP)
+            tokens_dict[int(el[0])] = el[1:]
+
+    return tokens_dict
+
+
+def collect_inputs(eaf_path):
+    elan_obj = ElanObject(eaf_path)
+    inputs = []
+
+    for start, end, transcript, tier_name in elan_obj.annot_data_lst:
+        if not transcript:
+            continue
+
+        normz_tokens_dict = get_tags_dict(elan_obj, tier_name + '_standartization', start, end)
+        annot_tokens_dict = get_tags_dict(elan_obj, tier_name + '_annotation', start, end)
+        inputs.append((transcript, normz_tokens_dict, annot_tokens_dict))
+
+    return inputs
+
+
+def benchmark(func, inputs, n_runs):
+    best = None
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        for item in inputs:
+            func(*item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares lxml-based and single-pass transcript rendering')
+    parser.add_argument('eaf', nargs='?', default='../data/media/MP-BRAR-03-01-01.eaf')
+    parser.add_argument('--repeat', type=int, default=20, help='how many times annotations of eaf are repeated')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    inputs = collect_inputs(args.eaf) * args.repeat
+
+    mismatches = [
+        item for item in inputs
+        if legacy_render_transcript(*item) != render_transcript(*item)
+    ]
+    print('annotations:', len(inputs), 'mismatches:', len(mismatches))
+    for transcript, _, _ in mismatches[:5]:
+        print('MISMATCH', transcript)
+
+    legacy_time = benchmark(legacy_render_transcript, inputs, args.runs)
+    new_time = benchmark(render_transcript, inputs, args.runs)
+    print('lxml: %.3fs, single pass: %.3fs, speedup: %.1fx' % (legacy_time, new_time, legacy_time / new_time))
@@ -4,6 +4,8 @@ sys.path.append('..')
 import re
 import os
 import json
+import functools
+import concurrent.futures
 from collections import defaultdict, Counter
 
 import django
@@ -53,6 +55,7 @@ def get_recordings():
     return recs
 
 
+@functools.lru_cache(maxsize=None)  # called for every word
 def reverse_tags():
     reverse_compulsory = {v['surface_tag']: v for k, v in grammeme_config['grammemes'].items()}
     assert len(reverse_compulsory) == len(grammeme_config['grammemes'])
@@ -289,35 +292,54 @@ def reorder_tags_for_word(rec, tags, std, lemma, annotation_menu, errors):
     return final_tags, errors
 
 
-def reorder_tags_for_recs(annotation_menu, recs):
+def reorder_tags_for_rec(annotation_menu, rec):
+    """
+    runs in a worker process, returns errors of the recording
+    """
+    errors = defaultdict(list)
+    clean_rec, rec_full_path = get_correct_rec_path(rec)
+    elan_obj = ElanObject(rec_full_path)
+
+    tier_names, starts, ends, all_anns = [], [], [], []
+    print(clean_rec)
+
+    for speaker_tier_name, orig_tier, standartization_tier, annotation_tier in get_tiers(rec_full_path):
+        for start, end, standartizations, annotations in get_annotations(orig_tier, standartization_tier, annotation_tier):
+            anns = parse_anns_from_annotation(standartizations, annotations)
+            new_anns = []
+            for token in anns:
+                std, lemma, token_ann = token
+                tags = token_ann.split(ANNOTATION_TAG_SEP)
+                final_tags, errors = reorder_tags_for_word(
+                    clean_rec, tags, std, lemma, annotation_menu, errors
+                )
+                new_anns.append((std, [(lemma, ANNOTATION_TAG_SEP.join(final_tags))]))
+
+            tier_names.append(speaker_tier_name)
+            starts.append(start)
+            ends.append(end)
+            all_anns.append(new_anns)
+
+    elan_obj.update_anns(tier_names, starts, ends, all_anns)
+    elan_obj.save()
+    return dict(errors)
+
+
+def reorder_tags_for_recs(annotation_menu, recs, workers=None):
     errors = defaultdict(list)
 
-    for rec in recs:
-        clean_rec, rec_full_path = get_correct_rec_path(rec)
-        elan_obj = ElanObject(rec_full_path)
-
-        tier_names, starts, ends, all_anns = [], [], [], []
-        print(clean_rec)
-
-        for speaker_tier_name, orig_tier, standartization_tier, annotation_tier in get_tiers(rec_full_path):
-            for start, end, standartizations, annotations in get_annotations(orig_tier, standartization_tier, annotation_tier):
-                anns = parse_anns_from_annotation(standartizations, annotations)
-                new_anns = []
-                for token in anns:
-                    std, lemma, token_ann = token
-                    tags = token_ann.split(ANNOTATION_TAG_SEP)
-                    final_tags, errors = reorder_tags_for_word(
-                        clean_rec, tags, std, lemma, annotation_menu, errors
-                    )
-                    new_anns.append((std, [(lemma, ANNOTATION_TAG_SEP.join(final_tags))]))
-
-                tier_names.append(speaker_tier_name)
-                starts.append(start)
-                ends.append(end)
-                all_anns.append(new_anns)
-
-        elan_obj.update_anns(tier_names, starts, ends, all_anns)
-        elan_obj.save()
+    # recordings are independent, each is read, reordered and saved by one of the worker processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = {executor.submit(reorder_tags_for_rec, annotation_menu, rec): rec for rec in recs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                rec_errors = future.result()
+            except Exception as e:
+                print('ERROR in ' + futures[future][0], repr(e))
+                continue
+
+            for k, vs in rec_errors.items():
+                errors[k].extend(vs)
 
     # print_errors(errors)
 
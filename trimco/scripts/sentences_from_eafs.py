@@ -1,9 +1,10 @@
 import sys
 sys.path.append('..')
 
+import os
 import sqlite3
 
-from corpora.search_engine.elan_to_db import process_one_elan, insert_sentences_in_mongo
+from corpora.search_engine.reindex import reindex_recordings, BatchError
 
 
 conn = sqlite3.connect('../db.sqlite3')
@@ -19,23 +20,19 @@ def get_recordings():
 
 
 def insert_sentences():
-    recs = get_recordings()
-    sentences = []
-
-    for rec in recs:
-        eaf_filename, audio_filename, dialect = rec
-        eaf_filename = eaf_filename.rsplit('/', 1)[-1]
-        audio_filename = audio_filename.rsplit('/', 1)[-1]
-        print(eaf_filename)
-        try:
-            curr_sentences = process_one_elan(eaf_filename, audio_filename, dialect)
-            sentences.extend(curr_sentences)
-        except Exception as e:
-            print('ERROR', e)
-            print()
-
-    if sentences:
-        insert_sentences_in_mongo(sentences)
+    recs = [
+        (eaf_filename.rsplit('/', 1)[-1], audio_filename.rsplit('/', 1)[-1], dialect)
+        for eaf_filename, audio_filename, dialect in get_recordings()
+    ]
+
+    # the same as `python manage.py reindex_sentences`
+    for report in reindex_recordings(recs, workers=os.cpu_count() or 1):
+        if isinstance(report, BatchError):
+            print('ERROR', report.elans, report.error)
+        elif report.status == 'failed':
+            print('ERROR', report.elan, report.error)
+        elif report.status != 'unchanged':
+            print(report.elan, report.status, report.n_sentences)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,8 @@
+import sys
+sys.path.append('..')
+
+from corpora.search_engine.token_index import rebuild_token_index
+
+
+if __name__ == '__main__':
+    rebuild_token_index()
@@ -2,9 +2,11 @@ import sys
 sys.path.append('..')
 
 import os
+import time
 import sqlite3
 
-from corpora.utils.word_list import process_one_elan, insert_words_in_mongo
+from corpora.utils.word_list import sync_elan_words, remove_elan_words
+from corpora.utils.manifest import get_entries
 
 
 conn = sqlite3.connect('../db.sqlite3')
@@ -43,9 +45,16 @@ def insert_wordlist():
     models = get_models()
     dialect_to_model_mapping = get_dialect_to_model_mapping()
 
+    # words of files that were processed before and are not processed now are retracted
+    entries = get_entries('words')
+    start = time.perf_counter()
+    total_ops = 0
+
     for rec in recs:
         print(rec)
         rec_path = os.path.join(media_dir, rec[0])
+        # words of the recording are kept even if it can not be processed now
+        entries.pop(os.path.basename(rec_path), None)
 
         model_id = dialect_to_model_mapping.get(rec[1])
         if model_id is None:
@@ -56,12 +65,26 @@ def insert_wordlist():
 
         try:
             model_name = models[model_id]
-            words = process_one_elan(rec_path, model_name)
-            insert_words_in_mongo(words)
+            file_start = time.perf_counter()
+            n_ops = sync_elan_words(rec_path, model_name)
+            if n_ops is None:
+                print('unchanged')
+                continue
+
+            total_ops += n_ops
+            elapsed = time.perf_counter() - file_start
+            print('%d operations in %.2fs (%.0f ops/s)' % (n_ops, elapsed, n_ops / elapsed if elapsed else 0))
         except Exception as e:
             print('ERROR', e)
             print()
 
+    for elan, entry in entries.items():
+        print('removing words of', elan)
+        total_ops += remove_elan_words(elan, entry)
+
+    elapsed = time.perf_counter() - start
+    print('%d operations in %.1fs (%.0f ops/s)' % (total_ops, elapsed, total_ops / elapsed if elapsed else 0))
+
 
 if __name__ == '__main__':
     insert_wordlist()
@@ -157,7 +157,24 @@ else:
 GRAPPELLI_ADMIN_TITLE = 'BaltSlavDialects 0.1'
 
 NORMALIZER_PATH = '/data/csmtiser/'
+NORMALIZER_PYTHON = 'python2'  # interpreter of csmtiser, runs corpora/utils/normalizer_worker.py
+NORMALIZER_TIMEOUT = 120  # seconds to wait for csmtiser before its worker is restarted
+
+MORPH_CACHE_PATH = os.path.join(BASE_DIR, 'morph_cache.sqlite3')  # see corpora/utils/morph_cache.py
+MORPH_CACHE_SIZE = 100000  # number of analyses kept in memory of each process
+
+LOCK_DIR = os.path.join(BASE_DIR, 'locks')  # lock files of EAF files which are written, see corpora/utils/locks.py
+RECORDING_LOCK_TIMEOUT = 10  # seconds a request waits for a locked recording before 409 Conflict
+
+EDITOR_SESSION_BUDGET = 512 * 1024 * 1024  # bytes of parsed EAF files kept for open editors in each process
+EDITOR_SESSION_SIZE_FACTOR = 20  # a parsed EAF takes about this many times the size of the file
+EDITOR_WINDOW_SIZE = 100  # annotations rendered at once in the editor, the others are loaded on scroll
 
 MONGO_URL = 'mongodb://localhost:27017/'
 MONGO_DB_NAME = 'dialecta'
 MONGODB_LIMIT = 100
+SEARCH_CACHE_SIZE = 1000  # number of queries for which result counts are cached in each process
+SEARCH_COUNT_CAP = None  # e.g. 1000 to stop counting at "1000+" results
+SEARCH_COUNT_WAIT = 0.5  # seconds to wait for the count after the page is rendered
+SEARCH_BACKEND = 'mongo'  # or 'sqlite' to run search without Mongo
+SEARCH_SQLITE_PATH = os.path.join(BASE_DIR, 'search.sqlite3')